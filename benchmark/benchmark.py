@@ -0,0 +1,211 @@
+"""
+Runs the three step pipeline of demo/demo.py against an in-memory repository and reports throughput, latency and
+memory usage. No MongoDB server is needed, so the numbers show the overhead of MongoProcessing itself.
+
+Example: python benchmark/benchmark.py --documents 5000 --rate 1000 --shared-stream
+"""
+import argparse
+import datetime
+import json
+import os
+import resource
+import sys
+import time
+from threading import Event, Lock, Thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mongoprocessing import MemoryMongoRepository, Metrics, MongoWatch, OperationTypeDependency, ProcessDependency, \
+    SharedScheduler
+from mongoprocessing.memory import MemoryCollection
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the demo pipeline on an in-memory repository')
+    parser.add_argument('--documents', type=int, default=2000, help='Number of documents to insert')
+    parser.add_argument('--rate', type=float, default=0, help='Inserts per second (0 inserts as fast as possible)')
+    parser.add_argument('--threads', type=int, default=5, help='Number of threads per worker')
+    parser.add_argument('--shared-stream', action='store_true', help='Let all workers share one change stream')
+    parser.add_argument('--write-buffer', action='store_true', help='Buffer writes and send them as bulk writes')
+    parser.add_argument('--batched', action='store_true', help='Use batched workers')
+    parser.add_argument('--fuse', action='store_true', help='Run steps two and three inline after their predecessor')
+    parser.add_argument('--client-filter', action='store_true', help='Evaluate $expr conditions on the client')
+    parser.add_argument('--raw', action='store_true', help='Receive change events as RawBSONDocument')
+    parser.add_argument('--scheduler', type=int, default=0,
+                        help='Run all workers in a shared scheduler with this many threads, step one first')
+    parser.add_argument('--queue', action='store_true', help='Lease pending processes from a job queue collection')
+    parser.add_argument('--metrics', action='store_true', help='Also report the mean duration of every stage')
+    parser.add_argument('--timeout', type=float, default=300, help='Give up after this many seconds')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    return parser.parse_args()
+
+
+def percentile(values, fraction):
+    if len(values) == 0:
+        return None
+
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return round(values[index], 3)
+
+
+def process_one(doc):
+    return True, {'a': doc['x'] % 10}
+
+
+def process_two(doc):
+    a = doc['one']['a']
+    return True, {'b': 2 * a, 'c': doc['x'] % 7}
+
+
+class Benchmark(object):
+    def __init__(self, args):
+        self.args = args
+        self.repo = MemoryMongoRepository()
+        self.metrics = Metrics() if args.metrics else None
+        if self.metrics is not None:
+            self.repo.set_metrics(self.metrics)
+        if args.write_buffer:
+            self.repo.enable_write_buffer()
+        if args.queue:
+            self.repo.enable_job_queue(MemoryCollection('queue'), poll_interval=0.05)
+
+        self.scheduler = SharedScheduler(args.scheduler) if args.scheduler > 0 else None
+        self.watches = []
+        self.lock = Lock()
+        self.finished = 0
+        self.all_finished = Event()
+
+    def process_three(self, doc):
+        results = {'sum': doc['one']['a'] + doc['two']['b'] + doc['two']['c']}
+
+        with self.lock:
+            self.finished += 1
+            if self.finished == self.args.documents:
+                self.all_finished.set()
+
+        return True, results
+
+    def start_workers(self):
+        steps = [
+            ('one', OperationTypeDependency(['insert']), process_one),
+            ('two', ProcessDependency('one'), process_two),
+            ('three', ProcessDependency('two', ['update'], True, 'c'), self.process_three)
+        ]
+
+        for name, dependency, process in steps:
+            watch = MongoWatch(self.repo)
+            watch.add_dependency(dependency)
+
+            if self.args.batched:
+                watch.start_worker_batched(name, lambda doc: True,
+                                           lambda docs, process=process: [process(doc) for doc in docs],
+                                           max_wait_ms=10, shared_stream=self.args.shared_stream,
+                                           num_threads=self.args.threads, client_filter=self.args.client_filter,
+                                           raw=self.args.raw, scheduler=self.scheduler,
+                                           priority=1 if name == 'one' else 0)
+            else:
+                watch.start_worker(name, lambda doc: True, process, shared_stream=self.args.shared_stream,
+                                   num_threads=self.args.threads, fuse=self.args.fuse and name != 'one',
+                                   client_filter=self.args.client_filter, raw=self.args.raw, queue=self.args.queue,
+                                   scheduler=self.scheduler, priority=1 if name == 'one' else 0)
+
+            self.watches.append(watch)
+
+    def insert_documents(self):
+        interval = 1.0 / self.args.rate if self.args.rate > 0 else 0
+        started = time.time()
+
+        for index in range(self.args.documents):
+            if interval > 0:
+                delay = started + index * interval - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+            self.repo.insert(index, {'x': index, 'createdAt': datetime.datetime.utcnow()})
+
+    def run(self):
+        self.start_workers()
+        # Give the change streams time to open
+        time.sleep(0.5)
+
+        started = time.time()
+        producer = Thread(target=self.insert_documents)
+        producer.start()
+
+        completed = self.all_finished.wait(self.args.timeout)
+        self.repo.flush()
+        duration = time.time() - started
+        producer.join()
+
+        latencies = self.get_latencies()
+
+        for watch in self.watches:
+            watch.stop_all()
+
+        report = {
+            'documents': self.args.documents,
+            'completed': completed,
+            'finished': self.finished,
+            'seconds': round(duration, 3),
+            'throughput': round(self.finished / duration, 1),
+            'latency_p50_ms': percentile(latencies, 0.5),
+            'latency_p99_ms': percentile(latencies, 0.99),
+            # ru_maxrss is reported in kilobytes on Linux
+            'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)
+        }
+
+        if self.metrics is not None:
+            report['stages_ms'] = self.get_stage_durations()
+
+        return report
+
+    def get_latencies(self):
+        # Wait for the last end_process writes
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            documents = list(self.repo.coll.documents.values())
+            if all('endTime' in document.get('three', {}) for document in documents):
+                break
+            time.sleep(0.1)
+
+        latencies = []
+        for document in documents:
+            end_time = document.get('three', {}).get('endTime')
+            if end_time is not None:
+                latencies.append((end_time - document['createdAt']).total_seconds() * 1000)
+
+        return latencies
+
+    def get_stage_durations(self):
+        stages = {}
+
+        for name, labels in sorted(self.metrics.histograms.keys()):
+            count, total = self.metrics.get_histogram(name, dict(labels))
+            label = '/'.join([name] + [str(value) for _, value in labels])
+            stages[label] = round(total / count * 1000, 3) if count > 0 else None
+
+        return stages
+
+
+def main():
+    args = parse_args()
+    report = Benchmark(args).run()
+
+    if args.json:
+        print(json.dumps(report, sort_keys=True))
+    else:
+        for key in sorted(report.keys()):
+            if key == 'stages_ms':
+                for stage, value in sorted(report[key].items()):
+                    print('  {:<45} {}'.format(stage, value))
+            else:
+                print('{:<16} {}'.format(key, report[key]))
+
+    # The change stream threads of workers without a shared stream keep the process alive
+    sys.stdout.flush()
+    os._exit(0 if report['completed'] else 1)
+
+
+if __name__ == '__main__':
+    main()
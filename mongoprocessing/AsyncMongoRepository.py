@@ -0,0 +1,241 @@
+import time
+
+try:
+    from motor.motor_asyncio import AsyncIOMotorClient
+except ImportError:
+    AsyncIOMotorClient = None
+
+from .MongoRepository import MongoRepository
+
+
+class _OpenedChangeStream(object):
+    def __init__(self, stream, doc):
+        """
+        A Motor change stream whose first event has already been read, see AsyncMongoRepository.watch.
+        :param stream: The Motor change stream
+        :param doc: The first event or None if there was none yet
+        """
+        self.stream = stream
+        self.doc = doc
+
+    @property
+    def alive(self):
+        return self.doc is not None or self.stream.alive
+
+    async def try_next(self):
+        doc, self.doc = self.doc, None
+        if doc is not None:
+            return doc
+
+        return await self.stream.try_next()
+
+    async def next(self):
+        doc, self.doc = self.doc, None
+        if doc is not None:
+            return doc
+
+        return await self.stream.next()
+
+    async def close(self):
+        await self.stream.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.alive:
+            raise StopAsyncIteration()
+
+        return await self.next()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+
+class AsyncMongoRepository(MongoRepository):
+    def __init__(self, connection_string, database, collection, resume_token_path='resume_token.bin', logger_name=None,
+                 *time_fields):
+        """
+        asyncio flavour of MongoRepository based on Motor. All methods that write to the database return awaitables.
+        Use AsyncMongoRepository.from_collection to wrap any object with the interface of a Motor collection.
+        :param connection_string: MongoDB connection string
+        :param database: Database to use
+        :param collection: Collection to use
+        :param resume_token_path: See MongoRepository
+        :param time_fields: Any timeFields that should be set to the current time whenever the collection is updated
+        """
+        if AsyncIOMotorClient is None:
+            raise ImportError('AsyncMongoRepository requires the motor package')
+
+        client = AsyncIOMotorClient(connection_string, document_class=dict)
+        db = client[database]
+        self._init_collection(db[collection], resume_token_path, logger_name, *time_fields)
+
+    def enable_write_buffer(self, batch_size=500, flush_interval=0.5):
+        raise Exception('AsyncMongoRepository does not support the write buffer')
+
+    def enable_read_cache(self, max_entries=10000, max_bytes=64 * 1024 * 1024, ttl=None, refresh=False):
+        raise Exception('AsyncMongoRepository does not support the read cache')
+
+    def enable_job_queue(self, collection, lease_time=300, batch_size=100, poll_interval=0.5, produce=True):
+        raise Exception('AsyncMongoRepository does not support the job queue')
+
+    async def get_by_id(self, doc_id):
+        """
+        Gets a document from the collection by ID.
+        :param doc_id: The document ID
+        :return: The document (if it exists)
+        """
+        return await self.coll.find_one({'_id': doc_id})
+
+    async def get_multiple_by_ids(self, ids, projection=None):
+        """
+        See MongoRepository.get_multiple_by_ids
+        """
+        documents = await self.coll.find({'_id': {'$in': ids}}, projection).to_list(None)
+        return self._order_by_ids(documents, ids)
+
+    async def insert(self, doc_id, doc):
+        """
+        Insert a document into the collection.
+        :param doc_id: ID of the document
+        :param doc: A dictionary representing a document
+        """
+        if '_id' not in doc:
+            doc['_id'] = doc_id
+
+        await self.coll.insert_one(doc)
+
+    async def watch(self, match, resume=True, resume_token=None, projection=None, raw=False, fallback=True):
+        """
+        See MongoRepository.watch. Motor opens change streams lazily, so the stream is opened here by reading its
+        first event. Errors like a resume token that is no longer in the oplog are raised here and trigger the
+        fallback instead of surfacing in the worker.
+        :return: A stream that can be used with async with and async for
+        """
+        coll, pipeline = self._get_watch_pipeline(match, projection, raw)
+
+        if resume_token is not None:
+            try:
+                return await self._open_stream(coll, pipeline, resume_token)
+            except Exception:
+                if not fallback:
+                    raise
+                self.logger.warning('Unable to resume after the given token. Trying the resume token file...')
+
+        if resume:
+            resume_token = self._load_resume_token()
+            if resume_token is not None:
+                try:
+                    self.logger.info('Successfully loaded resume token')
+                    stream = await self._open_stream(coll, pipeline, resume_token)
+                    self.logger.info('Successfully resumed watch')
+                    return stream
+
+                except Exception:
+                    self.logger.warning('Unable to resume, probably because the oplog is too small. Trying again '
+                                        'without resuming...')
+
+                    return await self.watch(match, resume=False, projection=projection, raw=raw)
+
+        stream = await self._open_stream(coll, pipeline)
+        self.logger.info('Successfully started watch')
+        return stream
+
+    async def claim_process(self, doc_id, process_name, owner, lease_time=300, *time_fields):
+        """
+        See MongoRepository.claim_process
+        """
+        query, update_dict = self._get_claim_update(doc_id, process_name, owner, lease_time, *time_fields)
+
+        self._invalidate_cache([doc_id])
+        started = time.time()
+        claimed = await self.coll.find_one_and_update(query, update_dict, projection={'_id': True})
+        self._observe_write('find_one_and_update', started)
+
+        return claimed is not None
+
+    async def start_process_if(self, doc_id, process_name, query, owner=None, lease_time=300):
+        """
+        See MongoRepository.start_process_if
+        """
+        start_query, update_dict = self._get_start_if_update(doc_id, process_name, query, owner, lease_time)
+
+        self._invalidate_cache([doc_id])
+        started = time.time()
+        document = await self.coll.find_one_and_update(start_query, update_dict, projection={'_id': True})
+        self._observe_write('find_one_and_update', started)
+
+        return document is not None
+
+    async def reset_processes(self, doc_ids, process_name, owner=None):
+        """
+        See MongoRepository.reset_processes
+        """
+        query, update_dict = self._get_reset_update(doc_ids, process_name, owner)
+
+        self._invalidate_cache(doc_ids)
+        started = time.time()
+        await self.coll.update_many(query, update_dict)
+        self._observe_write('update_many', started)
+
+    async def dead_letter(self, doc_id, process_name, attempts, error=None, results=None):
+        """
+        See MongoRepository.dead_letter
+        """
+        if self.dead_letters is None:
+            self.logger.error('Process "{}" failed {} time(s) on document {}, but there is no dead letter collection'
+                              .format(process_name, attempts, doc_id))
+            return False
+
+        record = self._get_dead_letter(doc_id, process_name, attempts, error, results)
+
+        started = time.time()
+        await self.dead_letters.replace_one({'process': process_name, 'documentId': doc_id}, record, upsert=True)
+        self._observe_write('dead_letter', started)
+
+        return True
+
+    async def delete_dead_letters(self, process_name, doc_ids):
+        """
+        See MongoRepository.delete_dead_letters
+        """
+        started = time.time()
+        await self.dead_letters.delete_many({'process': process_name, 'documentId': {'$in': list(doc_ids)}})
+        self._observe_write('delete_many', started)
+
+    async def _open_stream(self, coll, pipeline, resume_token=None):
+        stream = coll.watch(pipeline, full_document='updateLookup', resume_after=resume_token,
+                            max_await_time_ms=self.max_await_time_ms)
+        try:
+            doc = await stream.try_next()
+        except:
+            await stream.close()
+            raise
+
+        return _OpenedChangeStream(stream, doc)
+
+    async def _update_one(self, doc_id, update_dict, upsert=False, query=None):
+        if query is None:
+            query = {'_id': doc_id}
+
+        self._invalidate_cache([doc_id])
+        started = time.time()
+        await self.coll.update_one(query, update_dict, upsert=upsert)
+        self._observe_write('update_one', started)
+
+    async def _update_many(self, doc_ids, update_dict):
+        self._invalidate_cache(doc_ids)
+        started = time.time()
+        await self.coll.update_many({'_id': {'$in': list(doc_ids)}}, update_dict)
+        self._observe_write('update_many', started)
+
+    async def _bulk_write(self, operations):
+        self._invalidate_cache([doc_id for doc_id, _ in operations])
+        if len(operations) > 0:
+            started = time.time()
+            await self.coll.bulk_write([operation for _, operation in operations], ordered=False)
+            self._observe_write('bulk_write', started)
@@ -0,0 +1,57 @@
+import asyncio
+
+from .AsyncRunningWorker import AsyncRunningWorker
+from .MongoWatch import MongoWatch
+
+
+class AsyncMongoWatch(MongoWatch):
+    def __init__(self, mongo_repository):
+        """
+        asyncio flavour of MongoWatch. Workers run as tasks on the event loop instead of threads.
+        :param mongo_repository: An AsyncMongoRepository
+        """
+        MongoWatch.__init__(self, mongo_repository)
+
+    async def start_worker(self, name, acknowledge_callback, process_callback, resume=True, max_concurrency=100,
+                           claim=False, lease_time=300, partition=None, fields=None):
+        """
+        Start a new worker on the running event loop.
+        :param name: Name of the worker
+        :param acknowledge_callback: A function or coroutine function that takes a document as a parameter and returns
+        True if the process should run on the document, False otherwise
+        :param process_callback: A function or coroutine function that takes a document as a parameter and returns two
+        values: A boolean indicating whether the process executed successfully and a dictionary containing all results
+        :param resume: Whether to resume the stream from where it stopped last time
+        :param max_concurrency: Maximum number of documents processed concurrently per worker
+        :param claim: See MongoWatch.start_worker
+        :param lease_time: See MongoWatch.start_worker
+        :param partition: See MongoWatch.start_worker
+        :param fields: See MongoWatch.start_worker
+        """
+
+        def create_worker(key, match, projection, stream_match):
+            return AsyncRunningWorker(name, acknowledge_callback, process_callback, self.mongo_repository, match,
+                                      resume, max_concurrency, key=key, claim=claim, lease_time=lease_time,
+                                      projection=projection)
+
+        self._start_workers(name, create_worker, partition, fields)
+
+    async def stop_all(self, drain_timeout=None):
+        """
+        Stop all workers concurrently and save their resume tokens.
+        :param drain_timeout: See AsyncRunningWorker.stop
+        """
+        self.logger.info('Stopping all workers')
+
+        workers = list(self.running_workers.values())
+        self.running_workers = {}
+
+        await asyncio.gather(*[worker.stop(drain_timeout) for worker in workers])
+
+        self.logger.info('Successfully stopped all workers')
+
+    def start_worker_batched(self, *args, **kwargs):
+        raise Exception('AsyncMongoWatch does not support batched workers')
+
+    def backfill(self, name, num_partitions=4, batch_size=1000):
+        raise Exception('AsyncMongoWatch does not support backfills')
@@ -0,0 +1,206 @@
+import asyncio
+import inspect
+import os
+import socket
+import time
+import uuid
+
+
+async def _call(callback, *args):
+    result = callback(*args)
+    if inspect.isawaitable(result):
+        result = await result
+
+    return result
+
+
+class AsyncRunningWorker(object):
+    def __init__(self, name, acknowledge_callback, process_callback, mongo_repository, match, resume=True,
+                 max_concurrency=100, key=None, claim=False, lease_time=300, projection=None):
+        """
+        A worker that consumes a change stream and processes documents as tasks on the running event loop.
+        :param acknowledge_callback: A function or coroutine function, see MongoWatch.start_worker
+        :param process_callback: A function or coroutine function, see MongoWatch.start_worker
+        :param mongo_repository: An AsyncMongoRepository
+        :param max_concurrency: Maximum number of documents in flight. The change stream is not consumed any further
+        while this many documents are being processed.
+        :param projection: Only receive these fields of the change events (see MongoRepository.create_projection)
+        """
+        self.name = name
+        self.key = key if key is not None else name
+        self.acknowledge_callback = acknowledge_callback
+        self.process_callback = process_callback
+        self.mongo_repository = mongo_repository
+        self.match = match
+        self.resume = resume
+        self.claim = claim
+        self.lease_time = lease_time
+        self.projection = projection
+        self.owner = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+        self.logger = mongo_repository.logger
+        self.metrics = mongo_repository.metrics
+        self.metric_labels = {'worker': self.key}
+
+        self.abort = False
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.tasks = set()
+        self.task = None
+        self.started_ids = {}
+
+        self.checkpointer = mongo_repository.create_checkpointer(self.key)
+
+    @property
+    def queue_depth(self):
+        return len(self.tasks)
+
+    def start(self):
+        self.logger.info('Starting task for worker "{}"'.format(self.name))
+        self.checkpointer.start()
+        self.task = asyncio.ensure_future(self._run_watch_task())
+
+    async def stop(self, drain_timeout=None):
+        """
+        Stop the worker and save the resume token.
+        :param drain_timeout: If given, wait at most drain_timeout seconds for the documents that are being processed
+        before cancelling them. Cancelled documents are marked as not running and received again after a restart. If
+        None, wait for all documents that are being processed without a timeout.
+        """
+        self.logger.info('Stopping worker "{}"'.format(self.name))
+        self.abort = True
+
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+        tasks = list(self.tasks)
+        if len(tasks) > 0:
+            await asyncio.wait(tasks, timeout=drain_timeout)
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        await self._reset_started()
+
+        self.checkpointer.stop()
+        self.logger.info('Successfully stopped worker "{}"'.format(self.name))
+
+    async def _reset_started(self):
+        doc_ids = list(self.started_ids.keys())
+        if len(doc_ids) == 0:
+            return
+
+        self.logger.warning('Worker "{}" cancelled documents {} while stopping'.format(self.name, doc_ids))
+        try:
+            await self.mongo_repository.reset_processes(doc_ids, self.name, self.owner if self.claim else None)
+        except Exception:
+            self.logger.exception('Unable to reset the running processes of worker "{}"'.format(self.name))
+
+    async def _run_watch_task(self):
+        resume_token = self.checkpointer.load() if self.resume else None
+
+        stream = await self.mongo_repository.watch(self.match, resume=self.resume, resume_token=resume_token,
+                                                   projection=self.projection)
+        async with stream:
+            self.logger.info('Worker task "{}" started successfully'.format(self.name))
+            async for doc in stream:
+                if self.abort:
+                    return
+
+                if doc is not None:
+                    position = self.checkpointer.received(doc.get('_id'))
+                    self.metrics.increment('events_received_total', self.metric_labels)
+                    await self.semaphore.acquire()
+
+                    task = asyncio.ensure_future(self._run_process_task(doc, position))
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+
+    async def _run_process_task(self, doc, position):
+        completed = False
+
+        try:
+            document = doc['fullDocument']
+
+            # In claim mode the running state is checked atomically by claim_process
+            if not self.claim and self.name in document and document[self.name]['isRunning']:
+                self.logger.error('Process "{}" is already running'.format(self.name))
+            elif await self._execute_process(document) and doc.get('clusterTime') is not None:
+                self.metrics.observe('end_to_end_lag_seconds', self.metric_labels,
+                                     time.time() - doc['clusterTime'].time)
+
+            completed = True
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.logger.exception('An error occurred while trying to process data')
+            completed = True
+        finally:
+            self.semaphore.release()
+            if completed:
+                self.checkpointer.completed(position)
+
+    async def _execute_process(self, document):
+        metrics = self.metrics
+        labels = self.metric_labels
+        required = False
+
+        started = time.time()
+        try:
+            required = await _call(self.acknowledge_callback, document)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.logger.exception('An error occurred while trying to process data')
+        metrics.observe('acknowledge_seconds', labels, time.time() - started)
+
+        if not required:
+            metrics.increment('events_skipped_total', labels)
+            return False
+
+        metrics.increment('events_acknowledged_total', labels)
+
+        started = time.time()
+        if self.claim:
+            claimed = await self.mongo_repository.claim_process(document['_id'], self.name, self.owner,
+                                                                self.lease_time)
+            metrics.observe('start_write_seconds', labels, time.time() - started)
+            if not claimed:
+                self.logger.debug('Process "{}" has already been claimed for document {}'
+                                  .format(self.name, document['_id']))
+                metrics.increment('events_skipped_total', labels)
+                return False
+        else:
+            await self.mongo_repository.start_process(document['_id'], self.name)
+            metrics.observe('start_write_seconds', labels, time.time() - started)
+
+        doc_id = document['_id']
+        # Processes that are cancelled by stop are reset (see _reset_started)
+        self.started_ids[doc_id] = self.started_ids.get(doc_id, 0) + 1
+
+        success = False
+        results = {}
+
+        started = time.time()
+        try:
+            success, results = await _call(self.process_callback, document)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.logger.exception('An error occurred while trying to process data')
+        metrics.observe('process_seconds', labels, time.time() - started)
+        metrics.increment('events_succeeded_total' if success else 'events_failed_total', labels)
+
+        started = time.time()
+        if self.claim:
+            await self.mongo_repository.release_process(doc_id, self.name, self.owner, success, results)
+        else:
+            await self.mongo_repository.end_process(doc_id, self.name, success, results)
+        metrics.observe('end_write_seconds', labels, time.time() - started)
+
+        count = self.started_ids.pop(doc_id) - 1
+        if count > 0:
+            self.started_ids[doc_id] = count
+
+        return True
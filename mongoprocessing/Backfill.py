@@ -0,0 +1,188 @@
+import time
+from threading import Lock, Thread
+
+from pymongo import ASCENDING
+
+
+class Backfill(object):
+    def __init__(self, mongo_repository, query, workers, num_partitions=4, batch_size=1000, max_retries=5):
+        """
+        Scans the collection for documents that already meet the dependencies of a worker and feeds them into the
+        worker. The _id space is split into ranges that are scanned in parallel. Every scan remembers the last _id it
+        saw, so it can reopen its cursor at the same position after an error. Scans only read IDs, and every batch of
+        documents is read again right before it is handed to the worker, so documents processed by the change stream
+        in the meantime are skipped.
+        :param mongo_repository: The MongoRepository to scan
+        :param query: The query selecting all documents that should be processed (see MongoWatch._get_query)
+        :param workers: The RunningWorkers of the process (one per operation type). The documents are fed into the
+        first one, and none of them processes a document that the backfill has processed already.
+        :param num_partitions: Number of _id ranges scanned in parallel
+        :param batch_size: Cursor batch size
+        :param max_retries: Give up a scan after this many consecutive errors without progress
+        """
+        self.mongo_repository = mongo_repository
+        self.query = query
+        self.workers = workers
+        self.worker = workers[0]
+        self.num_partitions = num_partitions
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.projection = self.worker.get_document_projection()
+        self.recheck_size = min(batch_size, 100)
+
+        self.logger = mongo_repository.logger
+
+        self.abort = False
+        self.lock = Lock()
+        self.remaining = 0
+        self.scanned = 0
+        self.submitted = 0
+        self.tasks = []
+
+    def start(self):
+        """
+        Start scanning in the background.
+        """
+        self._set_backfill(True)
+
+        try:
+            ranges = self._get_ranges()
+        except:
+            self._set_backfill(False)
+            raise
+
+        self.logger.info('Starting backfill of worker "{}" with {} partition(s)'.format(self.worker.name, len(ranges)))
+
+        self.remaining = len(ranges)
+        if len(ranges) == 0:
+            self._set_backfill(False)
+
+        for lower, upper, last in ranges:
+            task = Thread(target=self._run_scan_thread, args=[lower, upper, last])
+            self.tasks.append(task)
+            task.start()
+
+    def stop(self):
+        """
+        Stop scanning and wait for all scans to finish.
+        """
+        self.abort = True
+        self.join()
+
+    def join(self):
+        """
+        Wait until all documents have been scanned and handed to the worker.
+        """
+        for task in self.tasks:
+            task.join()
+
+    def _set_backfill(self, running):
+        for worker in self.workers:
+            worker.set_backfill(self.query, running)
+
+    def _is_active(self, doc_id):
+        return any(worker.is_active(doc_id) for worker in self.workers)
+
+    def _get_ranges(self):
+        if self.num_partitions <= 1:
+            return [(None, None, True)]
+
+        buckets = list(self.mongo_repository.coll.aggregate([
+            {'$match': self.query},
+            {'$bucketAuto': {'groupBy': '$_id', 'buckets': self.num_partitions}}
+        ]))
+
+        if len(buckets) == 0:
+            return []
+
+        return [(bucket['_id']['min'], bucket['_id']['max'], index == len(buckets) - 1)
+                for index, bucket in enumerate(buckets)]
+
+    def _get_range_query(self, last_id, lower, upper, last):
+        id_condition = {}
+
+        if last_id is not None:
+            id_condition['$gt'] = last_id
+        elif lower is not None:
+            id_condition['$gte'] = lower
+
+        if upper is not None:
+            id_condition['$lte' if last else '$lt'] = upper
+
+        if len(id_condition) == 0:
+            return self.query
+
+        return {'$and': [self.query, {'_id': id_condition}]}
+
+    def _run_scan_thread(self, lower, upper, last):
+        try:
+            self._scan(lower, upper, last)
+        finally:
+            with self.lock:
+                self.remaining -= 1
+                finished = self.remaining == 0
+
+            if finished:
+                self._set_backfill(False)
+
+    def _scan(self, lower, upper, last):
+        last_id = None
+        finished = False
+        retries = 0
+
+        while not finished and not self.abort:
+            previous_id = last_id
+            doc_ids = []
+
+            try:
+                cursor = self.mongo_repository.coll.find(self._get_range_query(last_id, lower, upper, last),
+                                                         {'_id': True})
+                cursor = cursor.sort('_id', ASCENDING).batch_size(self.batch_size)
+
+                for document in cursor:
+                    if self.abort:
+                        return
+
+                    self.scanned += 1
+                    doc_ids.append(document['_id'])
+                    if len(doc_ids) >= self.recheck_size:
+                        self._submit(doc_ids)
+                        last_id = doc_ids[-1]
+                        doc_ids = []
+
+                if len(doc_ids) > 0:
+                    self._submit(doc_ids)
+                    last_id = doc_ids[-1]
+
+                finished = True
+            except:
+                retries = 0 if last_id != previous_id else retries + 1
+                if retries >= self.max_retries:
+                    self.logger.exception('Backfill scan of worker "{}" failed after _id {}, giving up'
+                                          .format(self.worker.name, last_id))
+                    return
+
+                self.logger.exception('Backfill scan of worker "{}" failed, resuming after _id {}'
+                                      .format(self.worker.name, last_id))
+                time.sleep(1)
+
+        self.logger.info('Backfill scan of worker "{}" finished'.format(self.worker.name))
+
+    def _submit(self, doc_ids):
+        doc_ids = [doc_id for doc_id in doc_ids if not self._is_active(doc_id)]
+        if len(doc_ids) == 0:
+            return
+
+        # Buffered writes of the change stream must be visible to the recheck
+        self.mongo_repository.flush()
+
+        # The cursor may have read a document before the change stream processed it, so the documents are read again
+        # and only those that still match the query (i.e. are neither processed nor running) are submitted
+        query = {'$and': [self.query, {'_id': {'$in': doc_ids}}]}
+        for document in self.mongo_repository.coll.find(query, self.projection):
+            if self._is_active(document['_id']):
+                continue
+
+            # The process only starts if the document still matches, even if the change stream processes it first
+            if self.worker.submit_document(document, 'backfill', start_query=self.query):
+                self.submitted += 1
@@ -0,0 +1,250 @@
+import time
+from threading import Condition, Thread
+
+from .RunningWorker import RunningWorker
+from .executors import call_batch_callback, encode_document
+
+
+class BatchedRunningWorker(RunningWorker):
+    def __init__(self, name, acknowledge_callback, process_batch_callback, mongo_repository, match, resume=True,
+                 num_threads=5, max_batch_size=100, max_wait_ms=1000, **kwargs):
+        """
+        A worker that collects events into micro-batches and processes each batch with a single callback call.
+        :param process_batch_callback: A function that takes a list of documents and returns a list with a
+        (success, results) tuple for every document
+        :param max_batch_size: Process a batch as soon as it contains this many documents
+        :param max_wait_ms: Process a batch at the latest max_wait_ms milliseconds after its first event arrived
+        """
+        RunningWorker.__init__(self, name, acknowledge_callback, None, mongo_repository, match, resume, num_threads,
+                               **kwargs)
+        if self.claim:
+            raise Exception('Batched workers do not support claim mode')
+        if self.fuse:
+            raise Exception('Batched workers do not support fusion')
+        if self.coalesce_window is not None:
+            raise Exception('Batched workers do not support coalescing')
+        if self.retry_policy is not None:
+            raise Exception('Batched workers do not support retries')
+        if self.concurrency_limiter is not None:
+            raise Exception('Batched workers do not support concurrency limiters')
+
+        self.process_batch_callback = process_batch_callback
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+
+        self.batch = []
+        self.batch_started = None
+        self.batch_condition = Condition()
+        self.batch_task = Thread(target=self._run_batch_timer_thread)
+        self.batch_task.daemon = True
+
+    def start(self):
+        self.batch_task.start()
+        RunningWorker.start(self)
+
+    def submit(self, doc, done_callback=None):
+        """
+        Add a change event to the current batch. Blocks while max_queue_size events are queued or in flight.
+        :param doc: The change event
+        :param done_callback: A function without parameters that is called once the event has been handled
+        :return: True if the event has been queued, False if the worker is not running
+        """
+        if not self._acquire_queue_slot(doc):
+            return False
+
+        with self.batch_condition:
+            if len(self.batch) == 0:
+                self.batch_started = time.time()
+                self.batch_condition.notify()
+
+            self.batch.append((doc, done_callback, time.time()))
+
+            if len(self.batch) >= self.max_batch_size:
+                self._flush_batch()
+
+        return True
+
+    def _on_abort(self):
+        with self.batch_condition:
+            if self.shared_stream:
+                # The events of the open batch are skipped by the thread pool (see RunningWorker._skip_events)
+                self._flush_batch()
+            self.batch_condition.notify()
+
+    def _flush_batch(self):
+        batch = self.batch
+        self.batch = []
+        self.batch_started = None
+
+        if len(batch) > 0:
+            self.running_tasks.apply_async(func=self._run_batch_task, args=[batch])
+
+    def _run_batch_timer_thread(self):
+        with self.batch_condition:
+            while not self.abort:
+                if self.batch_started is None:
+                    self.batch_condition.wait()
+                    continue
+
+                remaining = self.batch_started + self.max_wait - time.time()
+                if remaining <= 0:
+                    self._flush_batch()
+                else:
+                    self.batch_condition.wait(remaining)
+
+    def _run_batch_task(self, batch):
+        with self.queue_condition:
+            if self.abort:
+                # The worker is draining, the events are skipped
+                skipped = True
+            else:
+                skipped = False
+                self.in_flight += len(batch)
+                self.metrics.set_gauge('in_flight', self.metric_labels, self.in_flight)
+
+        if skipped:
+            self._skip_events([(doc, done_callback) for doc, done_callback, _ in batch])
+            return
+
+        started = time.time()
+        for _, _, queued in batch:
+            self.metrics.observe('queue_wait_seconds', self.metric_labels, started - queued)
+
+        failed = False
+        end_writes = {}
+        try:
+            # Events for the same document are processed once on the latest one, they all complete with its end write
+            latest = {}
+            for doc, _, _ in batch:
+                document = doc['fullDocument']
+                latest[document['_id']] = (document, self._get_start_query(doc))
+            documents = [latest.pop(doc['fullDocument']['_id']) for doc, _, _ in batch
+                         if doc['fullDocument']['_id'] in latest]
+            end_writes = self._execute_batch(documents)
+
+            for doc, _, _ in batch:
+                self._observe_end_to_end_lag(doc)
+        except:
+            self.logger.exception('An error occurred while trying to process data')
+            failed = True
+        finally:
+            with self.queue_condition:
+                self.in_flight -= len(batch)
+                self.metrics.set_gauge('in_flight', self.metric_labels, self.in_flight)
+                if self.abort:
+                    self.queue_condition.notify_all()
+            self._release_queue_slots([doc for doc, _, _ in batch])
+
+        for doc, done_callback, _ in batch:
+            end_write = end_writes.get(doc['fullDocument']['_id'])
+            if failed:
+                self._on_failed(doc, done_callback)
+            elif end_write is not None:
+                # The event is only completed once its buffered end write has succeeded
+                end_write.add_done_callback(lambda write, doc=doc, done_callback=done_callback:
+                                            self._on_end_write(write, doc, done_callback))
+            elif done_callback is not None:
+                done_callback()
+
+    def _execute_batch(self, documents):
+        """
+        Acknowledge and process a batch of documents.
+        :param documents: A list of (document, start_query) tuples with one tuple per document (see submit_document
+        for start_query)
+        :return: A dict with the PendingWrite of the end write of every processed document if the write buffer is
+        enabled, an empty dict otherwise
+        """
+        metrics = self.metrics
+        labels = self.metric_labels
+        acknowledged = []
+
+        started = time.time()
+        for document, start_query in documents:
+            if self._is_running(document):
+                self.logger.error('Process "{}" is already running'.format(self.name))
+                continue
+
+            try:
+                if self.acknowledge_callback(document):
+                    acknowledged.append((document, start_query))
+            except:
+                self.logger.exception('An error occurred while trying to process data')
+        metrics.observe('acknowledge_seconds', labels, time.time() - started)
+
+        metrics.increment('events_acknowledged_total', labels, len(acknowledged))
+        metrics.increment('events_skipped_total', labels, len(documents) - len(acknowledged))
+
+        if len(acknowledged) == 0:
+            return {}
+
+        started = time.time()
+        bulk_ids = [document['_id'] for document, start_query in acknowledged if start_query is None]
+        if len(bulk_ids) > 0:
+            self.mongo_repository.start_processes(bulk_ids, self.name)
+
+        required_documents = []
+        for document, start_query in acknowledged:
+            # Documents of a running backfill only start if they still match its query, one write each
+            if start_query is not None and \
+                    not self.mongo_repository.start_process_if(document['_id'], self.name, start_query):
+                self.logger.debug('Document {} does not need process "{}" anymore'.format(document['_id'], self.name))
+                metrics.increment('events_skipped_total', labels)
+                continue
+
+            required_documents.append(document)
+        metrics.observe('start_write_seconds', labels, time.time() - started)
+
+        if len(required_documents) == 0:
+            return {}
+
+        doc_ids = [document['_id'] for document in required_documents]
+        self._add_started(doc_ids)
+        try:
+            end_writes = self._process_batch(doc_ids, required_documents)
+        finally:
+            self._remove_started(doc_ids)
+
+        return dict(zip(doc_ids, end_writes)) if end_writes is not None else {}
+
+    def _process_batch(self, doc_ids, required_documents):
+        metrics = self.metrics
+        labels = self.metric_labels
+        outcomes = None
+
+        rate_limiter = self.rate_limiter
+        if rate_limiter is not None and self.scheduler is None:
+            metrics.observe('rate_limit_wait_seconds', labels, rate_limiter.acquire(len(required_documents)))
+        elif rate_limiter is not None:
+            # The task took one token before it was dispatched, the next task of the worker waits for the others
+            rate_limiter.take(len(required_documents) - 1)
+
+        started = time.time()
+        try:
+            outcomes = list(self._call_process_batch_callback(required_documents))
+            if len(outcomes) != len(required_documents):
+                raise Exception('Batch callback of process "{}" returned {} results for {} documents'
+                                .format(self.name, len(outcomes), len(required_documents)))
+        except:
+            self.logger.exception('An error occurred while trying to process data')
+            outcomes = [(False, {})] * len(required_documents)
+        metrics.observe('process_seconds', labels, time.time() - started)
+
+        succeeded = len([success for success, _ in outcomes if success])
+        metrics.increment('events_succeeded_total', labels, succeeded)
+        metrics.increment('events_failed_total', labels, len(outcomes) - succeeded)
+
+        started = time.time()
+        end_writes = self.mongo_repository.end_processes(self.name, [(doc_id, success, results)
+                                                                     for doc_id, (success, results)
+                                                                     in zip(doc_ids, outcomes)])
+        metrics.observe('end_write_seconds', labels, time.time() - started)
+
+        return end_writes
+
+    def _call_process_batch_callback(self, documents):
+        if self.executor is None:
+            return self.process_batch_callback(documents)
+
+        future = self.executor.submit(call_batch_callback, self.process_batch_callback,
+                                      [encode_document(document) for document in documents])
+        return future.result()
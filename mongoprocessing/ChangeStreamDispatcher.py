@@ -0,0 +1,255 @@
+from threading import Event, Lock, Thread
+
+from pymongo.errors import OperationFailure
+
+from .filters import compile_filter
+from .matching import matches
+
+
+class ChangeStreamDispatcher(object):
+    def __init__(self, mongo_repository, key='shared_stream', on_history_lost=None):
+        """
+        Shares a single change stream between all workers of a MongoRepository. The stream uses the union of all
+        worker filters and every event is routed to the matching workers on the client side, so oplog reads and
+        full document lookups happen once per event instead of once per worker.
+        :param mongo_repository: The MongoRepository to watch
+        :param key: The key of the resume token in the checkpoint store
+        :param on_history_lost: A function without parameters that is called if the stream cannot be resumed, e.g.
+        because the oplog has been truncated. It is called after the new stream has been opened, so it can recover
+        the lost events without missing further ones. If None, the stream starts from the current time.
+        """
+        self.mongo_repository = mongo_repository
+        self.logger = mongo_repository.logger
+        self.key = key
+        self.on_history_lost = on_history_lost
+
+        self.workers = []
+        self.lock = Lock()
+        # Events of stopped workers by worker key, the checkpoint does not get past them until they are delivered
+        self.parked = {}
+
+        self.checkpointer = None
+
+        self.stream = None
+        self.resume_token = None
+        self.restart = False
+
+        self.stop_event = None
+        self.task = None
+        self.stopped_task = None
+
+    def register(self, worker, resume=True):
+        """
+        Route all events matching the filter of a worker to this worker. The shared stream is started with the
+        first registered worker and restarted with the new union filter for every further worker.
+        :param worker: A RunningWorker
+        :param resume: Whether to resume the stream from where it stopped last time (only used when the stream starts)
+        """
+        while True:
+            with self.lock:
+                stopped_task = self.stopped_task
+                if self.task is not None or stopped_task is None or not stopped_task.is_alive():
+                    break
+
+            # The thread of a stream that has just been stopped must not share the state of the next one
+            stopped_task.join()
+
+        with self.lock:
+            self.workers.append(worker)
+
+            if self.task is None:
+                self.checkpointer = self.mongo_repository.create_checkpointer(self.key)
+                # The stream resumes from the saved checkpoint, which does not skip events that were not completed
+                self.resume_token = None
+                self.stopped_task = None
+                self.stop_event = Event()
+                self.task = Thread(target=self._run_dispatch_thread, args=[self.stop_event, resume])
+                self.task.start()
+            else:
+                self._restart_stream()
+
+            parked = self.parked.pop(worker.key, [])
+
+        if len(parked) > 0:
+            self.logger.info('Delivering {} parked event(s) to worker "{}"'.format(len(parked), worker.name))
+
+        for index, (doc, done_callback) in enumerate(parked):
+            if not worker.submit(doc, done_callback):
+                self.park(worker.key, parked[index:])
+                break
+
+    def unregister(self, worker):
+        """
+        Stop routing events to a worker. The shared stream is closed when the last worker is unregistered.
+        :param worker: A RunningWorker
+        """
+        with self.lock:
+            if worker in self.workers:
+                self.workers.remove(worker)
+
+            if len(self.workers) == 0 and self.task is not None:
+                self.stop_event.set()
+                self._close_stream()
+                # Joined by the next register, the thread may be waiting for a worker that is stopping
+                self.stopped_task = self.task
+                self.task = None
+                self.checkpointer.stop()
+                # The parked events are received again when the stream resumes from the checkpoint
+                self.parked = {}
+
+    def park(self, key, events):
+        """
+        Keep events that a stopping worker has not processed while the shared stream keeps running for other workers.
+        They are not completed, so the checkpoint does not get past them, and they are delivered to the next worker
+        that is registered with the same key.
+        :param key: The key of the worker
+        :param events: A list of tuples (doc, done_callback)
+        :return: True if the events have been parked, False if the shared stream has stopped (the events are received
+        again when it resumes)
+        """
+        with self.lock:
+            if self.task is None:
+                return False
+
+            self.parked.setdefault(key, []).extend(events)
+
+        return True
+
+    @property
+    def running(self):
+        """
+        :return: True while the shared stream runs for at least one worker
+        """
+        return self.task is not None
+
+    def save_checkpoint(self):
+        """
+        Save the resume token of the shared stream, e.g. after a stopped worker has finished its last events.
+        """
+        checkpointer = self.checkpointer
+        if checkpointer is not None:
+            checkpointer.save()
+
+    def _restart_stream(self):
+        # The flag is checked before and while the stream is consumed, so a worker registered while the stream is
+        # being opened is picked up as well. Closing only interrupts a stream that waits for events.
+        self.restart = True
+        self._close_stream()
+
+    def _close_stream(self):
+        stream = self.stream
+        if stream is not None:
+            try:
+                stream.close()
+            except:
+                self.logger.exception('Unable to close shared change stream')
+
+    def _get_filter(self):
+        matches_list = [worker.stream_match for worker in self.workers]
+        if len(matches_list) == 1:
+            return matches_list[0]
+
+        return compile_filter({'$or': matches_list})
+
+    def _get_projection(self):
+        projections = [worker.projection for worker in self.workers]
+        if any(projection is None for projection in projections):
+            return None
+
+        # Events are routed by evaluating the worker filters on the client, which needs the update description
+        paths = ['updateDescription'] + [path for projection in projections for path in projection]
+        return self.mongo_repository.create_projection(paths)
+
+    def _run_dispatch_thread(self, stop_event, resume):
+        self.checkpointer.start()
+        if resume and self.resume_token is None:
+            self.resume_token = self.checkpointer.load()
+
+        while not stop_event.is_set():
+            with self.lock:
+                self.restart = False
+                match = self._get_filter()
+                projection = self._get_projection()
+                raw = all(worker.raw for worker in self.workers)
+
+            try:
+                with self._watch(match, resume, projection, raw) as stream:
+                    self.stream = stream
+                    self.logger.info('Shared change stream started for {} worker(s)'.format(len(self.workers)))
+
+                    while stream.alive and not stop_event.is_set() and not self.restart:
+                        doc = stream.try_next()
+                        if doc is not None:
+                            self.resume_token = doc.get('_id')
+                            self._dispatch(doc)
+            except:
+                if not stop_event.is_set() and not self.restart:
+                    # The registered workers depend on this thread, so resume after a short pause
+                    self.logger.exception('Shared change stream failed, restarting')
+                    stop_event.wait(1)
+            finally:
+                self.stream = None
+
+        self.logger.info('Shared change stream stopped successfully')
+
+    def _watch(self, match, resume, projection, raw):
+        if self.on_history_lost is None:
+            return self.mongo_repository.watch(match, resume=resume, resume_token=self.resume_token,
+                                               projection=projection, raw=raw)
+
+        if self.resume_token is not None:
+            try:
+                return self.mongo_repository.watch(match, resume=False, resume_token=self.resume_token,
+                                                   projection=projection, raw=raw, fallback=False)
+            except OperationFailure:
+                self.logger.exception('Unable to resume change stream "{}", recovering lost events'.format(self.key))
+
+            stream = self.mongo_repository.watch(match, resume=False, projection=projection, raw=raw)
+            self.resume_token = None
+            try:
+                self.on_history_lost()
+            except:
+                stream.close()
+                raise
+            return stream
+
+        return self.mongo_repository.watch(match, resume=False, projection=projection, raw=raw)
+
+    def _dispatch(self, doc):
+        position = self.checkpointer.received(doc.get('_id'))
+
+        with self.lock:
+            workers = list(self.workers)
+
+        targets = []
+        for worker in workers:
+            try:
+                if matches(worker.match, doc):
+                    targets.append(worker)
+            except:
+                self.logger.exception('Unable to match event for worker "{}"'.format(worker.name))
+
+        completion = _EventCompletion(self.checkpointer, position, len(targets))
+        for worker in targets:
+            if not worker.submit(doc, completion.done):
+                # The worker is stopping
+                self.park(worker.key, [(doc, completion.done)])
+
+
+class _EventCompletion(object):
+    def __init__(self, checkpointer, position, remaining):
+        self.checkpointer = checkpointer
+        self.position = position
+        self.remaining = remaining
+        self.lock = Lock()
+
+        if remaining == 0:
+            checkpointer.completed(position)
+
+    def done(self):
+        with self.lock:
+            self.remaining -= 1
+            finished = self.remaining == 0
+
+        if finished:
+            self.checkpointer.completed(self.position)
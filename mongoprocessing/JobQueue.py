@@ -0,0 +1,278 @@
+import datetime
+import time
+
+from bson import ObjectId
+from pymongo import ASCENDING, DeleteOne, UpdateOne
+
+from .ChangeStreamDispatcher import ChangeStreamDispatcher
+from .WriteBuffer import WriteBuffer
+
+
+class JobQueue(object):
+    def __init__(self, mongo_repository, collection, lease_time=300, batch_size=100, poll_interval=0.5,
+                 produce=True):
+        """
+        Durable queue of pending processes, stored in a collection with one entry per document and process. A single
+        change stream turns matching change events into entries and any number of workers (in any number of
+        instances) lease batches of entries and process the documents. Unlike change events, the entries survive
+        outages of any length, and if the stream cannot resume because the oplog has been truncated, all matching
+        documents are enqueued again with their query.
+        :param mongo_repository: The MongoRepository whose documents are processed
+        :param collection: A pymongo collection for the entries, e.g. one in the same database as the processed
+        collection
+        :param lease_time: Number of seconds after which a leased entry may be leased again (e.g. because the instance
+        that leased it crashed)
+        :param batch_size: Maximum number of entries a worker has leased at the same time
+        :param poll_interval: Number of seconds a worker waits before polling an empty queue again
+        :param produce: If False, this instance only consumes entries and another instance runs the change stream
+        """
+        self.mongo_repository = mongo_repository
+        self.collection = collection
+        self.lease_time = lease_time
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.produce = produce
+
+        self.logger = mongo_repository.logger
+        self.metrics = mongo_repository.metrics
+
+        collection.create_index([('process', ASCENDING), ('documentId', ASCENDING)], unique=True)
+        collection.create_index([('process', ASCENDING), ('leaseExpiry', ASCENDING)])
+
+        self.write_buffer = None
+        self.dispatcher = ChangeStreamDispatcher(mongo_repository, 'job_queue', on_history_lost=self._recover)
+
+    def register(self, feeder, resume=True):
+        """
+        Enqueue all events matching the filter of a worker. Does nothing if produce is False.
+        :param feeder: A QueueFeeder
+        :param resume: Whether to resume the stream from where it stopped last time
+        """
+        if not self.produce:
+            return
+
+        if self.write_buffer is None:
+            self.write_buffer = WriteBuffer(self.collection, self.logger, flush_interval=0.1)
+
+        self.dispatcher.register(feeder, resume)
+
+    def unregister(self, feeder):
+        """
+        Stop enqueuing the events of a worker. Entries that are already enqueued are kept.
+        :param feeder: A QueueFeeder
+        """
+        if not self.produce:
+            return
+
+        self.dispatcher.unregister(feeder)
+        if len(self.dispatcher.workers) == 0 and self.write_buffer is not None:
+            self.write_buffer.flush()
+
+    def enqueue(self, process_name, doc_ids):
+        """
+        Enqueue documents for a process with a single write. Documents that are already enqueued are not added twice,
+        but run once more if their entry is currently leased.
+        :param process_name: The name of the process
+        :param doc_ids: The IDs of the documents
+        """
+        operations = [self._get_enqueue_operation(process_name, doc_id) for doc_id in doc_ids]
+        if len(operations) == 0:
+            return
+
+        started = time.time()
+        self.collection.bulk_write(operations, ordered=False)
+        self.mongo_repository._observe_write('enqueue', started)
+        self.metrics.increment('jobs_enqueued_total', {'process': process_name}, len(operations))
+
+    def enqueue_buffered(self, process_name, doc_id):
+        """
+        Enqueue a document through the write buffer of the queue.
+        :param process_name: The name of the process
+        :param doc_id: The ID of the document
+        :return: A PendingWrite that reports the outcome of the write
+        """
+        self.metrics.increment('jobs_enqueued_total', {'process': process_name})
+        return self.write_buffer.add((process_name, doc_id), self._get_enqueue_operation(process_name, doc_id))
+
+    def lease(self, process_name, owner, count):
+        """
+        Lease up to count available entries of a process, oldest first. Entries are leased with a single update, and
+        only entries whose lease has not been taken by another instance in the meantime are returned.
+        :param process_name: The name of the process
+        :param owner: An ID of the leasing instance
+        :param count: Maximum number of entries
+        :return: A list of entries, each with the fields documentId, version, attempts and leaseToken
+        """
+        now = datetime.datetime.utcnow()
+        query = {'process': process_name, 'leaseExpiry': {'$lte': now}}
+        candidates = self.collection.find(query, {'_id': True}).sort('leaseExpiry', ASCENDING).limit(count)
+        entry_ids = [candidate['_id'] for candidate in candidates]
+        if len(entry_ids) == 0:
+            return []
+
+        token = ObjectId()
+        query['_id'] = {'$in': entry_ids}
+        update_dict = {
+            '$set': {
+                'leaseToken': token,
+                'leaseOwner': owner,
+                'leaseExpiry': now + datetime.timedelta(seconds=self.lease_time)
+            },
+            '$inc': {'attempts': 1}
+        }
+
+        started = time.time()
+        self.collection.update_many(query, update_dict)
+        self.mongo_repository._observe_write('lease', started)
+
+        entries = list(self.collection.find({'_id': {'$in': entry_ids}, 'leaseToken': token},
+                                            {'documentId': True, 'version': True, 'attempts': True,
+                                             'leaseToken': True}))
+        self.metrics.increment('jobs_leased_total', {'process': process_name}, len(entries))
+        return entries
+
+    def complete(self, entries):
+        """
+        Delete leased entries after their documents have been processed. Entries that have been enqueued again while
+        they were leased are released instead, so the process runs once more.
+        :param entries: Entries returned by lease
+        """
+        if len(entries) == 0:
+            return
+
+        started = time.time()
+        # Entries whose lease expired and has been taken by another instance are left to that instance
+        self.collection.bulk_write([DeleteOne({'_id': entry['_id'], 'version': entry['version'],
+                                               'leaseToken': entry['leaseToken']})
+                                    for entry in entries], ordered=False)
+        self.mongo_repository._observe_write('complete', started)
+
+        self.release(entries)
+
+    def renew(self, entries):
+        """
+        Extend the leases of entries whose documents are still being processed, so no other instance leases them
+        again. Entries whose lease has been taken by another instance in the meantime are not changed.
+        :param entries: Entries returned by lease
+        """
+        if len(entries) == 0:
+            return
+
+        query = {
+            '_id': {'$in': [entry['_id'] for entry in entries]},
+            'leaseToken': {'$in': list(set(entry['leaseToken'] for entry in entries))}
+        }
+        update_dict = {
+            '$set': {'leaseExpiry': datetime.datetime.utcnow() + datetime.timedelta(seconds=self.lease_time)}
+        }
+
+        started = time.time()
+        self.collection.update_many(query, update_dict)
+        self.mongo_repository._observe_write('renew', started)
+
+    def release(self, entries):
+        """
+        Make leased entries available again without processing them, e.g. because the worker is stopped.
+        :param entries: Entries returned by lease
+        """
+        if len(entries) == 0:
+            return
+
+        query = {
+            '_id': {'$in': [entry['_id'] for entry in entries]},
+            'leaseToken': {'$in': list(set(entry['leaseToken'] for entry in entries))}
+        }
+        update_dict = {
+            '$set': {'leaseExpiry': datetime.datetime.utcnow()},
+            '$unset': {'leaseToken': '', 'leaseOwner': ''}
+        }
+
+        started = time.time()
+        self.collection.update_many(query, update_dict)
+        self.mongo_repository._observe_write('release', started)
+
+    def count(self, process_name):
+        """
+        :param process_name: The name of the process
+        :return: The number of enqueued entries of a process, including leased ones
+        """
+        return self.collection.count_documents({'process': process_name})
+
+    def stop(self):
+        """
+        Stop enqueuing and flush all buffered entries.
+        """
+        for feeder in list(self.dispatcher.workers):
+            self.dispatcher.unregister(feeder)
+
+        if self.write_buffer is not None:
+            self.write_buffer.stop()
+            self.write_buffer = None
+
+    def _get_enqueue_operation(self, process_name, doc_id):
+        now = datetime.datetime.utcnow()
+        return UpdateOne({'process': process_name, 'documentId': doc_id},
+                         {'$setOnInsert': {'enqueuedAt': now, 'leaseExpiry': now, 'attempts': 0},
+                          '$inc': {'version': 1}},
+                         upsert=True)
+
+    def _recover(self):
+        # The events since the last checkpoint are lost, so every document that may need a process is enqueued
+        for feeder in list(self.dispatcher.workers):
+            if feeder.query is None:
+                self.logger.error('Events of process "{}" have been lost'.format(feeder.name))
+                continue
+
+            self.logger.warning('Enqueuing all documents matching the query of process "{}"'.format(feeder.name))
+            doc_ids = []
+
+            for document in self.mongo_repository.coll.find(feeder.query, {'_id': True}):
+                doc_ids.append(document['_id'])
+                if len(doc_ids) >= 1000:
+                    self.enqueue(feeder.name, doc_ids)
+                    doc_ids = []
+
+            self.enqueue(feeder.name, doc_ids)
+
+
+class QueueFeeder(object):
+    def __init__(self, worker, query):
+        """
+        Enqueues the change events of a worker. Registered with the dispatcher of a JobQueue in place of the worker.
+        :param worker: A QueueRunningWorker
+        :param query: Query of all documents the process may need to run on, enqueued if change events have been lost
+        """
+        self.worker = worker
+        self.job_queue = worker.job_queue
+        self.name = worker.name
+        self.key = worker.key
+        self.query = query
+        self.logger = worker.logger
+
+        self.match = worker.match
+        self.stream_match = worker.stream_match
+        self.projection = worker.projection
+        self.raw = True
+
+    def submit(self, doc, done_callback=None):
+        """
+        Enqueue the document of a change event.
+        :param doc: The change event
+        :param done_callback: A function without parameters that is called once the entry has been written
+        :return: True
+        """
+        pending_write = self.job_queue.enqueue_buffered(self.name, doc['documentKey']['_id'])
+        pending_write.add_done_callback(lambda write: self._on_enqueued(write, done_callback))
+        return True
+
+    def _on_enqueued(self, pending_write, done_callback):
+        error = pending_write.error
+        # A concurrent upsert of another instance inserted the same entry
+        if error is not None and getattr(error, 'code', None) != 11000:
+            # The event is not completed, so it is received again when the stream resumes
+            self.logger.error('Unable to enqueue document {} for process "{}": {}'
+                              .format(pending_write.doc_id[1], self.name, error))
+            return
+
+        if done_callback is not None:
+            done_callback()
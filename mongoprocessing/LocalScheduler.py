@@ -0,0 +1,99 @@
+import copy
+import datetime
+from threading import Lock
+
+from .executors import decode_document
+from .matching import matches
+
+
+class LocalScheduler(object):
+    def __init__(self):
+        """
+        Runs chained processes of one MongoRepository inline. When a worker finishes a document, every worker of the
+        same process that was started with fuse=True and whose filter matches the resulting change is run directly
+        on the updated document, and so on down the chain. The bookkeeping of all these steps is written with a
+        single update, so each hop saves the end_process write, the change event, the updateLookup and the
+        start_process write. Workers in other processes still receive the merged change event.
+        """
+        self.workers = []
+        self.lock = Lock()
+
+    def register(self, worker):
+        with self.lock:
+            self.workers = self.workers + [worker]
+
+    def unregister(self, worker):
+        with self.lock:
+            self.workers = [registered for registered in self.workers if registered is not worker]
+
+    def run_followers(self, worker, document, success, results):
+        """
+        Run all local workers that directly or indirectly follow a finished process.
+        :param worker: The worker that finished the process
+        :param document: The document as it was passed to the process
+        :param success: Whether the process executed successfully
+        :param results: The results of the process
+        :return: A list of (process_name, success, results) tuples of all processes that ran inline
+        """
+        if len(self.workers) == 0:
+            return []
+
+        document = decode_document(document)
+        now = datetime.datetime.utcnow()
+
+        updated_fields = {}
+        visited = set([worker.name])
+        followers = []
+        finished = [(worker.name, success, results, False)]
+
+        while len(finished) > 0:
+            name, success, results, started = finished.pop(0)
+            self._apply_end(document, updated_fields, name, success, results, started, now)
+
+            event = {
+                'operationType': 'update',
+                'documentKey': {'_id': document['_id']},
+                'fullDocument': document,
+                'updateDescription': {'updatedFields': updated_fields, 'removedFields': []}
+            }
+
+            for follower in self.workers:
+                if follower.name in visited or follower.abort or not self._can_fuse(worker, follower):
+                    continue
+                if not matches(follower.match, event):
+                    continue
+
+                visited.add(follower.name)
+                outcome = follower._run_fused(copy.deepcopy(document))
+                if outcome is not None:
+                    followers.append((follower.name, outcome[0], outcome[1]))
+                    finished.append((follower.name, outcome[0], outcome[1], True))
+
+        return followers
+
+    def _can_fuse(self, worker, follower):
+        # With a projection the document only contains the fields that the first worker needs
+        if worker.projection is None:
+            return True
+        if follower.projection is None:
+            return False
+
+        for path in follower.projection:
+            parts = path.split('.')
+            if not any('.'.join(parts[:index]) in worker.projection for index in range(1, len(parts) + 1)):
+                return False
+
+        return True
+
+    def _apply_end(self, document, updated_fields, name, success, results, started, now):
+        fields = {'success': success, 'isRunning': False, 'endTime': now}
+        if started:
+            fields['startTime'] = now
+        fields.update(results)
+
+        if not isinstance(document.get(name), dict):
+            document[name] = {}
+
+        for key, value in fields.items():
+            document[name][key] = value
+            updated_fields['{}.{}'.format(name, key)] = value
@@ -0,0 +1,23 @@
+from .MongoRepository import MongoRepository
+from .checkpoints import MemoryCheckpointStore
+from .memory import MemoryCollection
+
+
+class MemoryMongoRepository(MongoRepository):
+    def __init__(self, collection=None, logger_name=None, *time_fields):
+        """
+        A MongoRepository backed by an in-memory collection with change streams instead of a replica set, e.g. for
+        tests, benchmarks and load tests. Resume tokens are kept in memory as well.
+        :param collection: A MemoryCollection (a new, empty one if None)
+        :param logger_name: See MongoRepository.__init__
+        :param time_fields: See MongoRepository.__init__
+        """
+        if collection is None:
+            collection = MemoryCollection()
+
+        self._init_collection(collection, None, logger_name, *time_fields)
+        self.checkpoint_store = MemoryCheckpointStore()
+
+    def _load_resume_token(self):
+        # There is no resume token file
+        return None
@@ -1,10 +1,24 @@
-import cPickle as pickle
+import datetime
 import logging
 import os
 import time
 from threading import Lock, Thread
 
-from pymongo import MongoClient
+from bson.raw_bson import RawBSONDocument
+from pymongo import ASCENDING, MongoClient, UpdateOne
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from .ChangeStreamDispatcher import ChangeStreamDispatcher
+from .JobQueue import JobQueue
+from .LocalScheduler import LocalScheduler
+from .ReadCache import ReadCache
+from .WriteBuffer import WriteBuffer
+from .checkpoints import Checkpointer, FileCheckpointStore
+from .metrics import NullMetrics
 
 
 class MongoRepository(object):
@@ -20,13 +34,149 @@ class MongoRepository(object):
         """
         client = MongoClient(connection_string, document_class=dict)
         db = client[database]
-        self.coll = db[collection]
+        self._init_collection(db[collection], resume_token_path, logger_name, *time_fields)
+
+    @classmethod
+    def from_collection(cls, coll, resume_token_path='resume_token.bin', logger_name=None, *time_fields):
+        """
+        Create a repository for an existing collection object instead of connecting to a MongoDB server.
+        :param coll: A pymongo collection or an object with the same interface
+        :param resume_token_path: See __init__
+        :param logger_name: See __init__
+        :param time_fields: See __init__
+        :return: The repository
+        """
+        repository = cls.__new__(cls)
+        repository._init_collection(coll, resume_token_path, logger_name, *time_fields)
+        return repository
+
+    def _init_collection(self, coll, resume_token_path, logger_name, *time_fields):
+        self.coll = coll
         self.time_fields = list(time_fields)
         self.save_lock = Lock()
         self.last_save = time.time()
         self.save_interval = 5
+        self.max_await_time_ms = 1000
         self.logger = logging.getLogger(logger_name)
         self.resume_token_path = resume_token_path
+        self.checkpoint_store = FileCheckpointStore(resume_token_path)
+        self.dispatcher = ChangeStreamDispatcher(self)
+        self.local_scheduler = LocalScheduler()
+        self.write_buffer = None
+        self.read_cache = None
+        self.dead_letters = None
+        self.job_queue = None
+        self.metrics = NullMetrics()
+
+    def set_metrics(self, metrics):
+        """
+        Record timings and counters of this repository and of all workers that are started afterwards.
+        :param metrics: A Metrics instance (see metrics.Metrics)
+        """
+        self.metrics = metrics
+
+    def set_checkpoint_store(self, checkpoint_store, save_interval=None):
+        """
+        Set where workers save the resume tokens of their streams.
+        :param checkpoint_store: A checkpoint store like FileCheckpointStore or CollectionCheckpointStore
+        :param save_interval: Save resume tokens every save_interval seconds (None keeps the current interval)
+        """
+        self.checkpoint_store = checkpoint_store
+        if save_interval is not None:
+            self.save_interval = save_interval
+
+    def create_checkpointer(self, key):
+        """
+        Create a Checkpointer that saves the resume token of a single stream in the checkpoint store.
+        :param key: The key of the stream
+        :return: A Checkpointer
+        """
+        return Checkpointer(self.checkpoint_store, key, self.logger, self.save_interval)
+
+    def set_dead_letter_collection(self, collection):
+        """
+        Set where workers with a retry policy record documents on which a process failed on every attempt.
+        :param collection: A pymongo collection, e.g. one in the same database as the processed collection
+        """
+        collection.create_index([('process', ASCENDING), ('documentId', ASCENDING)], unique=True)
+        self.dead_letters = collection
+
+    def enable_write_buffer(self, batch_size=500, flush_interval=0.5):
+        """
+        Buffer all updates (including the start and end of processes) and send them as unordered bulk writes.
+        While the buffer is enabled, update methods return a PendingWrite that reports the outcome of the write.
+        :param batch_size: Flush as soon as this many writes are pending
+        :param flush_interval: Flush pending writes at least every flush_interval seconds
+        """
+        if self.write_buffer is None:
+            self.write_buffer = WriteBuffer(self.coll, self.logger, batch_size, flush_interval)
+
+    def disable_write_buffer(self):
+        """
+        Flush all pending writes and send all further updates directly to the database.
+        """
+        write_buffer = self.write_buffer
+        if write_buffer is not None:
+            self.write_buffer = None
+            write_buffer.stop()
+
+    def enable_read_cache(self, max_entries=10000, max_bytes=64 * 1024 * 1024, ttl=None, refresh=False):
+        """
+        Cache the documents read by get_by_id and get_multiple_by_ids. The cache is kept coherent with a change stream
+        of the collection (see ReadCache), and writes through this repository drop the written documents right away.
+        :param max_entries: Maximum number of cached documents
+        :param max_bytes: Maximum total BSON size of the cached documents (None for no limit)
+        :param ttl: Number of seconds after which a cached document is read again (None for no limit)
+        :param refresh: If True, changed documents are refreshed from the change stream instead of being dropped
+        :return: The ReadCache, e.g. to read its statistics with get_stats
+        """
+        if self.read_cache is None:
+            self.read_cache = ReadCache(self, max_entries, max_bytes, ttl, refresh)
+            self.read_cache.start()
+
+        return self.read_cache
+
+    def disable_read_cache(self):
+        """
+        Stop caching reads and drop all cached documents.
+        """
+        read_cache = self.read_cache
+        if read_cache is not None:
+            self.read_cache = None
+            read_cache.stop()
+
+    def enable_job_queue(self, collection, lease_time=300, batch_size=100, poll_interval=0.5, produce=True):
+        """
+        Keep pending processes in a queue collection, so workers started with queue=True lease them from there instead
+        of consuming their own change streams (see JobQueue). Enable it before starting these workers.
+        :param collection: A pymongo collection for the queue entries
+        :param lease_time: Number of seconds after which entries leased by a crashed instance are leased again
+        :param batch_size: Maximum number of entries a worker has leased at the same time
+        :param poll_interval: Number of seconds a worker waits before polling an empty queue again
+        :param produce: If False, this instance only consumes entries and another instance enqueues them
+        :return: The JobQueue, e.g. to count the pending entries of a process
+        """
+        if self.job_queue is None:
+            self.job_queue = JobQueue(self, collection, lease_time, batch_size, poll_interval, produce)
+
+        return self.job_queue
+
+    def disable_job_queue(self):
+        """
+        Stop enqueuing change events and flush the entries that have not been written yet. Stop the queue workers
+        first.
+        """
+        job_queue = self.job_queue
+        if job_queue is not None:
+            self.job_queue = None
+            job_queue.stop()
+
+    def flush(self):
+        """
+        Send all buffered writes to the database and wait until they have been acknowledged.
+        """
+        if self.write_buffer is not None:
+            self.write_buffer.flush()
 
     def get(self, key, value):
         """
@@ -41,17 +191,29 @@ class MongoRepository(object):
         """
         Gets a document from the collection by ID.
         :param doc_id: The document ID
-        :return: The document (if it exists)
+        :return: The document or None if it does not exist
         """
-        return self.get('_id', doc_id)[0]
+        read_cache = self.read_cache
+        if read_cache is not None:
+            return read_cache.get(doc_id)
+
+        return self.coll.find_one({'_id': doc_id})
 
-    def get_multiple_by_ids(self, ids):
+    def get_multiple_by_ids(self, ids, projection=None):
         """
-        Get multiple documents by their IDs.
+        Get multiple documents by their IDs. With the read cache enabled, only the IDs that are not cached are read
+        from the collection.
         :param ids: All IDs that should be found
-        :return: Instance of cursor corresponding to the query
+        :param projection: If given, only read these fields from the collection (bypasses the read cache)
+        :return: A list of the documents that exist, in the order of ids
         """
-        return self.coll.find({'_id': {'$in': ids}})
+        read_cache = self.read_cache
+        if read_cache is not None and projection is None:
+            documents = read_cache.get_multiple(ids)
+        else:
+            documents = self.coll.find({'_id': {'$in': ids}}, projection)
+
+        return self._order_by_ids(documents, ids)
 
     def insert(self, doc_id, doc):
         """
@@ -70,11 +232,12 @@ class MongoRepository(object):
         :param doc_id: The ID of the document to update
         :param data: A dictionary with all updates to make
         :param time_fields: All properties that should have their value set to the current time
+        :return: A PendingWrite if the write buffer is enabled, None otherwise
         """
         update_dict = self._get_base_update_dict(*time_fields)
         update_dict['$set'] = data
 
-        self.coll.update_one({'_id': doc_id}, update_dict, upsert=True)
+        return self._update_one(doc_id, update_dict, upsert=True)
 
     def update_key_value(self, doc_id, key, value, *time_fields):
         """
@@ -83,12 +246,13 @@ class MongoRepository(object):
         :param key: The key of the property to update
         :param value: The new value of the given property
         :param time_fields: All properties that should have their value set to the current time
+        :return: A PendingWrite if the write buffer is enabled, None otherwise
         """
 
         update_dict = self._get_base_update_dict(*time_fields)
         update_dict['$set'] = {key: value}
 
-        self.coll.update_one({'_id': doc_id}, update_dict, upsert=True)
+        return self._update_one(doc_id, update_dict, upsert=True)
 
     def increment(self, doc_id, key, value, *time_fields):
         """
@@ -97,11 +261,12 @@ class MongoRepository(object):
         :param key: The key of the property to increment
         :param value: The increment value
         :param time_fields: All properties that should have their value set to the current time
+        :return: A PendingWrite if the write buffer is enabled, None otherwise
         """
         update_dict = self._get_base_update_dict(*time_fields)
         update_dict['$inc'] = {key: value}
 
-        self.coll.update_one({'_id': doc_id}, update_dict, upsert=True)
+        return self._update_one(doc_id, update_dict, upsert=True)
 
     def add_to_set(self, doc_id, key, value, *time_fields):
         """
@@ -110,26 +275,44 @@ class MongoRepository(object):
         :param key: The key of the set
         :param value: The value to add to the set
         :param time_fields: All properties that should have their value set to the current time
+        :return: A PendingWrite if the write buffer is enabled, None otherwise
         """
         update_dict = self._get_base_update_dict(*time_fields)
         update_dict['$addToSet'] = {key: value}
-        self.coll.update_one({'_id': doc_id}, update_dict)
+        return self._update_one(doc_id, update_dict)
 
-    def watch(self, match, resume=True):
+    def watch(self, match, resume=True, resume_token=None, projection=None, raw=False, fallback=True):
         """
         Watch the collection using a filter.
         :param match: BSON document specifying the filter criteria
         :param resume: Whether to resume the stream from where it stopped last time
-        :return: A stream of documents as they get inserted/replaced/updated
+        :param resume_token: Resume after this token instead of the one saved in the resume token file
+        :param projection: Only return these fields of the change events (see create_projection)
+        :param raw: If True, change events are returned as RawBSONDocument, which only decodes the fields that are
+        accessed
+        :param fallback: If False, an error is raised instead of starting a new stream when the stream cannot be
+        resumed after resume_token
+        :return: A stream of documents as they get inserted/replaced/updated. try_next waits at most
+        max_await_time_ms milliseconds for the next event.
         """
+        coll, pipeline = self._get_watch_pipeline(match, projection, raw)
+
+        if resume_token is not None:
+            try:
+                return coll.watch(pipeline, full_document='updateLookup', resume_after=resume_token,
+                                  max_await_time_ms=self.max_await_time_ms)
+            except:
+                if not fallback:
+                    raise
+                self.logger.warning('Unable to resume after the given token. Trying the resume token file...')
 
         if resume:
             resume_token = self._load_resume_token()
             if resume_token is not None:
                 try:
                     self.logger.info('Successfully loaded resume token')
-                    watch = self.coll.watch([{'$match': match}], full_document='updateLookup',
-                                            resume_after=resume_token)
+                    watch = coll.watch(pipeline, full_document='updateLookup', resume_after=resume_token,
+                                       max_await_time_ms=self.max_await_time_ms)
                     self.logger.info('Successfully resumed watch')
                     return watch
 
@@ -137,24 +320,41 @@ class MongoRepository(object):
                     self.logger.warning('Unable to resume, probably because the oplog is too small. Trying again '
                                            'without resuming...')
 
-                    return self.watch(match, resume=False)
+                    return self.watch(match, resume=False, projection=projection, raw=raw)
 
-        watch = self.coll.watch([{'$match': match}], full_document='updateLookup')
+        watch = coll.watch(pipeline, full_document='updateLookup', max_await_time_ms=self.max_await_time_ms)
         self.logger.info('Successfully started watch')
         return watch
 
+    def create_projection(self, paths):
+        """
+        Create a $project specification that includes the given fields. Fields inside other included fields are
+        dropped, since MongoDB rejects overlapping paths.
+        :param paths: Dotted paths of all fields to include
+        :return: The projection
+        """
+        projection = {}
+
+        for path in sorted(set(paths)):
+            parts = path.split('.')
+            if not any('.'.join(parts[:index]) in projection for index in range(1, len(parts))):
+                projection[path] = 1
+
+        return projection
+
     def start_process(self, doc_id, process_name, *time_fields):
         """
         Manually start a process
         :param doc_id: The ID of the affected document
         :param process_name: The name of the process to be started
         :param time_fields: All properties that should have their value set to the current time
+        :return: A PendingWrite if the write buffer is enabled, None otherwise
         """
         updates = {'{}.success'.format(process_name): False, '{}.isRunning'.format(process_name): True}
         all_time_fields = list(time_fields)
         all_time_fields.append('{}.startTime'.format(process_name))
 
-        self.update(doc_id, updates, *all_time_fields)
+        return self.update(doc_id, updates, *all_time_fields)
 
     def end_process(self, doc_id, process_name, success, results, *time_fields):
         """
@@ -164,20 +364,330 @@ class MongoRepository(object):
         :param success: Whether the process executed successfully
         :param results: Any results to save with the process
         :param time_fields: All properties that should have their value set to the current time
+        :return: A PendingWrite if the write buffer is enabled, None otherwise
         """
-        updates = {'{}.success'.format(process_name): success, '{}.isRunning'.format(process_name): False}
+        updates = self._get_end_updates(process_name, success, results)
 
-        for key in results:
-            updates['{}.{}'.format(process_name, key)] = results[key]
+        all_time_fields = list(time_fields)
+        all_time_fields.append('{}.endTime'.format(process_name))
+
+        return self.update(doc_id, updates, *all_time_fields)
+
+    def end_process_with_followers(self, doc_id, process_name, success, results, followers, *time_fields):
+        """
+        End a process together with processes that ran inline after it (see LocalScheduler) in a single write.
+        :param doc_id: The ID of the affected document
+        :param process_name: The name of the process to be ended
+        :param success: Whether the process executed successfully
+        :param results: Any results to save with the process
+        :param followers: A list of (process_name, success, results) tuples of processes that have been started and
+        ended after this process
+        :param time_fields: All properties that should have their value set to the current time
+        :return: A PendingWrite if the write buffer is enabled, None otherwise
+        """
+        updates = self._get_end_updates(process_name, success, results)
+
+        all_time_fields = list(time_fields)
+        all_time_fields.append('{}.endTime'.format(process_name))
+
+        for follower_name, follower_success, follower_results in followers:
+            updates.update(self._get_end_updates(follower_name, follower_success, follower_results))
+            all_time_fields.append('{}.startTime'.format(follower_name))
+            all_time_fields.append('{}.endTime'.format(follower_name))
+
+        return self.update(doc_id, updates, *all_time_fields)
+
+    def start_processes(self, doc_ids, process_name, *time_fields):
+        """
+        Start a process for multiple documents with a single write.
+        :param doc_ids: The IDs of the affected documents
+        :param process_name: The name of the process to be started
+        :param time_fields: All properties that should have their value set to the current time
+        """
+        updates = {'{}.success'.format(process_name): False, '{}.isRunning'.format(process_name): True}
+        all_time_fields = list(time_fields)
+        all_time_fields.append('{}.startTime'.format(process_name))
+
+        update_dict = self._get_base_update_dict(*all_time_fields)
+        update_dict['$set'] = updates
 
+        return self._update_many(doc_ids, update_dict)
+
+    def end_processes(self, process_name, outcomes, *time_fields):
+        """
+        End a process for multiple documents with a single bulk write.
+        :param process_name: The name of the process to be ended
+        :param outcomes: A list of (doc_id, success, results) tuples
+        :param time_fields: All properties that should have their value set to the current time
+        :return: A list with a PendingWrite per document if the write buffer is enabled, None otherwise
+        """
         all_time_fields = list(time_fields)
         all_time_fields.append('{}.endTime'.format(process_name))
 
-        self.update(doc_id, updates, *all_time_fields)
+        operations = []
+        for doc_id, success, results in outcomes:
+            updates = self._get_end_updates(process_name, success, results)
+
+            update_dict = self._get_base_update_dict(*all_time_fields)
+            update_dict['$set'] = updates
+            operations.append((doc_id, UpdateOne({'_id': doc_id}, update_dict, upsert=True)))
+
+        return self._bulk_write(operations)
+
+    def claim_process(self, doc_id, process_name, owner, lease_time=300, *time_fields):
+        """
+        Atomically start a process, but only if it is not running yet or the lease of the running process has
+        expired (e.g. because the owning instance crashed).
+        :param doc_id: The ID of the affected document
+        :param process_name: The name of the process to be started
+        :param owner: An ID of the claiming instance
+        :param lease_time: Number of seconds after which the claim may be taken over by another instance
+        :param time_fields: All properties that should have their value set to the current time
+        :return: True if the process has been claimed, False if it is already running
+        """
+        query, update_dict = self._get_claim_update(doc_id, process_name, owner, lease_time, *time_fields)
+
+        self._invalidate_cache([doc_id])
+        started = time.time()
+        claimed = self.coll.find_one_and_update(query, update_dict, projection={'_id': True})
+        self._observe_write('find_one_and_update', started)
+
+        return claimed is not None
+
+    def start_process_if(self, doc_id, process_name, query, owner=None, lease_time=300):
+        """
+        Atomically start a process, but only if the document still matches a query, e.g. because it may have been
+        processed since it was read.
+        :param doc_id: The ID of the affected document
+        :param process_name: The name of the process to be started
+        :param query: The query the document must match
+        :param owner: If given, the process is claimed by this instance (see claim_process)
+        :param lease_time: See claim_process
+        :return: True if the process has been started, False if the document does not match anymore
+        """
+        start_query, update_dict = self._get_start_if_update(doc_id, process_name, query, owner, lease_time)
+
+        self._invalidate_cache([doc_id])
+        started = time.time()
+        document = self.coll.find_one_and_update(start_query, update_dict, projection={'_id': True})
+        self._observe_write('find_one_and_update', started)
+
+        return document is not None
+
+    def release_process(self, doc_id, process_name, owner, success, results, *time_fields):
+        """
+        End a process that has been started with claim_process. Nothing is written if another instance has taken
+        over the claim in the meantime.
+        :param doc_id: The ID of the affected document
+        :param process_name: The name of the process to be ended
+        :param owner: The ID of the instance that claimed the process
+        :param success: Whether the process executed successfully
+        :param results: Any results to save with the process
+        :param time_fields: All properties that should have their value set to the current time
+        :return: A PendingWrite if the write buffer is enabled, None otherwise
+        """
+        updates = self._get_end_updates(process_name, success, results)
+
+        all_time_fields = list(time_fields)
+        all_time_fields.append('{}.endTime'.format(process_name))
+
+        update_dict = self._get_base_update_dict(*all_time_fields)
+        update_dict['$set'] = updates
+        update_dict['$unset'] = {'{}.owner'.format(process_name): '', '{}.leaseExpiry'.format(process_name): ''}
+
+        query = {'_id': doc_id, '{}.owner'.format(process_name): owner}
+        return self._update_one(doc_id, update_dict, query=query)
+
+    def reset_processes(self, doc_ids, process_name, owner=None):
+        """
+        Mark a process as not running on multiple documents with a single write, e.g. because the worker has been
+        stopped before the process ended. The process then runs again when the documents are received again.
+        :param doc_ids: The IDs of the affected documents
+        :param process_name: The name of the process
+        :param owner: If given, only reset documents claimed by this instance (see claim_process)
+        """
+        query, update_dict = self._get_reset_update(doc_ids, process_name, owner)
+
+        self._invalidate_cache(doc_ids)
+        started = time.time()
+        self.coll.update_many(query, update_dict)
+        self._observe_write('update_many', started)
+
+    def dead_letter(self, doc_id, process_name, attempts, error=None, results=None):
+        """
+        Record that a process failed on a document on every attempt. There is at most one dead letter per document
+        and process, a newer one replaces the previous one.
+        :param doc_id: The ID of the affected document
+        :param process_name: The name of the failed process
+        :param attempts: Number of attempts
+        :param error: The error of the last attempt if the process raised an exception
+        :param results: The results of the last attempt
+        :return: True if the dead letter has been recorded, False if no dead letter collection is set
+        """
+        if self.dead_letters is None:
+            self.logger.error('Process "{}" failed {} time(s) on document {}, but there is no dead letter collection'
+                              .format(process_name, attempts, doc_id))
+            return False
+
+        record = self._get_dead_letter(doc_id, process_name, attempts, error, results)
+
+        started = time.time()
+        self.dead_letters.replace_one({'process': process_name, 'documentId': doc_id}, record, upsert=True)
+        self._observe_write('dead_letter', started)
+
+        return True
+
+    def get_dead_letters(self, process_name, doc_ids=None, limit=0):
+        """
+        Get the dead letters of a process, oldest first.
+        :param process_name: The name of the process
+        :param doc_ids: Only get the dead letters of these documents (None gets all)
+        :param limit: Maximum number of dead letters (0 means no limit)
+        :return: Instance of cursor corresponding to the query
+        """
+        if self.dead_letters is None:
+            raise Exception('No dead letter collection has been set')
+
+        query = {'process': process_name}
+        if doc_ids is not None:
+            query['documentId'] = {'$in': list(doc_ids)}
+
+        return self.dead_letters.find(query).sort('failedAt', ASCENDING).limit(limit)
+
+    def delete_dead_letters(self, process_name, doc_ids):
+        """
+        Delete the dead letters of a process for multiple documents with a single write.
+        :param process_name: The name of the process
+        :param doc_ids: The IDs of the affected documents
+        """
+        started = time.time()
+        self.dead_letters.delete_many({'process': process_name, 'documentId': {'$in': list(doc_ids)}})
+        self._observe_write('delete_many', started)
 
     def register_time_field(self, *time_fields):
         self.time_fields.extend(time_fields)
 
+    def _update_one(self, doc_id, update_dict, upsert=False, query=None):
+        if query is None:
+            query = {'_id': doc_id}
+
+        self._invalidate_cache([doc_id])
+        if self.write_buffer is not None:
+            return self.write_buffer.add(doc_id, UpdateOne(query, update_dict, upsert=upsert))
+
+        started = time.time()
+        self.coll.update_one(query, update_dict, upsert=upsert)
+        self._observe_write('update_one', started)
+
+    def _update_many(self, doc_ids, update_dict):
+        self._invalidate_cache(doc_ids)
+        if self.write_buffer is not None:
+            for doc_id in doc_ids:
+                self.write_buffer.add(doc_id, UpdateOne({'_id': doc_id}, update_dict))
+            return
+
+        started = time.time()
+        self.coll.update_many({'_id': {'$in': list(doc_ids)}}, update_dict)
+        self._observe_write('update_many', started)
+
+    def _bulk_write(self, operations):
+        self._invalidate_cache([doc_id for doc_id, _ in operations])
+        if self.write_buffer is not None:
+            return [self.write_buffer.add(doc_id, operation) for doc_id, operation in operations]
+
+        if len(operations) > 0:
+            started = time.time()
+            self.coll.bulk_write([operation for _, operation in operations], ordered=False)
+            self._observe_write('bulk_write', started)
+
+    def _order_by_ids(self, documents, ids):
+        documents = dict((document['_id'], document) for document in documents)
+        # Every document is returned once, even if its ID is requested more than once
+        return [documents.pop(doc_id) for doc_id in ids if doc_id in documents]
+
+    def _invalidate_cache(self, doc_ids):
+        read_cache = self.read_cache
+        if read_cache is not None:
+            read_cache.invalidate(doc_ids)
+
+    def _observe_write(self, operation, started):
+        labels = {'operation': operation}
+        self.metrics.observe('write_seconds', labels, time.time() - started)
+        self.metrics.increment('writes_total', labels)
+
+    def _get_watch_pipeline(self, match, projection, raw):
+        pipeline = [{'$match': match}]
+        if projection is not None:
+            pipeline.append({'$project': projection})
+
+        coll = self.coll
+        if raw:
+            coll = coll.with_options(codec_options=coll.codec_options.with_options(document_class=RawBSONDocument))
+
+        return coll, pipeline
+
+    def _get_claim_update(self, doc_id, process_name, owner, lease_time, *time_fields):
+        now = datetime.datetime.utcnow()
+        query = {
+            '_id': doc_id,
+            '$or': [
+                {'{}.isRunning'.format(process_name): {'$ne': True}},
+                {'{}.leaseExpiry'.format(process_name): {'$lt': now}}
+            ]
+        }
+
+        all_time_fields = list(time_fields)
+        all_time_fields.append('{}.startTime'.format(process_name))
+
+        update_dict = self._get_base_update_dict(*all_time_fields)
+        update_dict['$set'] = {
+            '{}.success'.format(process_name): False,
+            '{}.isRunning'.format(process_name): True,
+            '{}.owner'.format(process_name): owner,
+            '{}.leaseExpiry'.format(process_name): now + datetime.timedelta(seconds=lease_time)
+        }
+
+        return query, update_dict
+
+    def _get_start_if_update(self, doc_id, process_name, query, owner, lease_time):
+        if owner is not None:
+            start_query, update_dict = self._get_claim_update(doc_id, process_name, owner, lease_time)
+        else:
+            start_query = {'_id': doc_id}
+            update_dict = self._get_base_update_dict('{}.startTime'.format(process_name))
+            update_dict['$set'] = {'{}.success'.format(process_name): False,
+                                   '{}.isRunning'.format(process_name): True}
+
+        return {'$and': [start_query, query]}, update_dict
+
+    def _get_reset_update(self, doc_ids, process_name, owner):
+        query = {'_id': {'$in': list(doc_ids)}, '{}.isRunning'.format(process_name): True}
+        update_dict = {'$set': {'{}.isRunning'.format(process_name): False}}
+
+        if owner is not None:
+            query['{}.owner'.format(process_name)] = owner
+            update_dict['$unset'] = {'{}.owner'.format(process_name): '', '{}.leaseExpiry'.format(process_name): ''}
+
+        return query, update_dict
+
+    def _get_dead_letter(self, doc_id, process_name, attempts, error, results):
+        return {
+            'process': process_name,
+            'documentId': doc_id,
+            'attempts': attempts,
+            'error': error,
+            'results': results,
+            'failedAt': datetime.datetime.utcnow()
+        }
+
+    def _get_end_updates(self, process_name, success, results):
+        updates = {'{}.success'.format(process_name): success, '{}.isRunning'.format(process_name): False}
+
+        for key in results:
+            updates['{}.{}'.format(process_name, key)] = results[key]
+
+        return updates
+
     def _get_base_update_dict(self, *time_fields):
         update_dict = dict()
 
@@ -198,6 +708,11 @@ class MongoRepository(object):
         return update_dict
 
     def save_resume_token(self, doc):
+        """
+        Save the resume token of an event to the resume token file that is shared by all streams of this repository.
+        Workers use a Checkpointer per stream instead (see create_checkpointer).
+        :param doc: The change event
+        """
         if self.save_lock.acquire():
             Thread(target=self._save_resume_token, args=[doc]).start()
             self.save_lock.release()
@@ -1,7 +1,12 @@
+import datetime
 from threading import Thread
 
-from RunningWorker import RunningWorker
-from dependencies import MultipleDependency
+from .Backfill import Backfill
+from .BatchedRunningWorker import BatchedRunningWorker
+from .QueueRunningWorker import QueueRunningWorker
+from .RunningWorker import RunningWorker
+from .dependencies import MultipleDependency, PartitionCondition
+from .filters import compile_filter, split_filter
 
 class MongoWatch(object):
     def __init__(self, mongo_repository):
@@ -13,13 +18,19 @@ class MongoWatch(object):
 
         self.dependency = MultipleDependency([])
         self.running_workers = {}
+        self.backfills = {}
+        self.partitions = {}
 
         self.logger = mongo_repository.logger
 
     def add_dependency(self, dependency):
         self.dependency.add_dependency(dependency)
 
-    def start_worker(self, name, acknowledge_callback, process_callback, resume=True):
+    def start_worker(self, name, acknowledge_callback, process_callback, resume=True, shared_stream=False,
+                     max_queue_size=None, claim=False, lease_time=300, executor='thread', num_threads=5,
+                     backfill=False, partition=None, fuse=False, fields=None, coalesce_ms=None, client_filter=False,
+                     retry_policy=None, concurrency_limiter=None, rate_limit=None, raw=False, queue=False,
+                     scheduler=None, weight=1, priority=0):
         """
         Start a new worker.
         :param name: Name of the worker
@@ -28,27 +39,277 @@ class MongoWatch(object):
         :param process_callback: A function that takes a document as a parameter and returns two values: A boolean
         indicating whether the process executed successfully and a dictionary containing all results
         :param resume: Whether to resume the stream from where it stopped last time
+        :param shared_stream: If True, the worker does not open its own change stream but receives its events from the
+        change stream that is shared by all workers of the MongoRepository
+        :param max_queue_size: Maximum number of events that may be queued or in flight per worker. The change stream
+        is not consumed any further while the queue is full. None means unlimited.
+        :param claim: If True, the worker atomically claims each document before processing it, so duplicate events
+        and other instances of the same worker do not run the process twice
+        :param lease_time: Number of seconds after which a claim of a crashed instance may be taken over
+        :param executor: Where process callbacks run: "thread" runs them in the worker's thread pool, "process" in a
+        pool of num_threads worker processes (the callback must be picklable, e.g. a module level function). Any object
+        with a concurrent.futures-like submit method can be passed as well. Documents are sent to the executor as raw
+        BSON, while all MongoDB I/O stays in the current process.
+        :param num_threads: Number of threads (and processes in "process" mode) per worker
+        :param backfill: If True, also process all documents that already meet the dependencies (see backfill)
+        :param partition: A tuple (index, count) to process only one of count partitions of the documents, split by
+        their _id. Start one instance per partition (e.g. on different hosts) to scale out a worker. Every partition
+        keeps its own resume token. On MongoDB 7.0 and newer, pass (index, count, True) to also split IDs other than
+        ObjectIds and numbers by their hash (see PartitionCondition).
+        :param fuse: If True, workers in this process whose results satisfy the dependencies of this worker run its
+        process inline right after their own, and all bookkeeping is merged into a single write (see LocalScheduler).
+        The process then runs in the thread of the upstream worker. Workers in other processes are unaffected. Cannot
+        be combined with claim.
+        :param fields: The fields of the document that the callbacks read. If given, the worker only receives these
+        fields, the fields referenced by the dependencies and its own process field instead of the whole document
+        (and the update description, if it is needed by client_filter or coalesce_ms).
+        :param coalesce_ms: If given, events for the same document that arrive within coalesce_ms milliseconds are
+        collapsed into a single execution on the latest event. Events for a document that is being processed are held
+        back until the process has ended and then run on the reloaded document, if it still matches the filter.
+        :param client_filter: If True, the $expr conditions of the filter (e.g. of ProcessDependency) are evaluated in
+        this process instead of on the server. This takes load off the server at the cost of receiving more events.
+        :param retry_policy: A RetryPolicy. If given, documents on which the process failed are retried after a delay
+        and recorded in the dead letter collection of the MongoRepository after the last attempt (see
+        requeue_dead_letters). Retries are scheduled in memory, so pending retries are lost when the worker stops.
+        :param concurrency_limiter: An AIMDLimiter that adapts the number of threads to the latency and error rate of
+        the process callback. Every operation type and partition adapts its own copy of the limiter. num_threads is
+        ignored in favour of the initial limit of the limiter.
+        :param rate_limit: Maximum number of process callback calls per second and worker (see TokenBucket). With a
+        scheduler, events wait in the queue of the worker until the rate allows them to run, so they do not hold
+        threads of the scheduler, and events the acknowledge callback skips count towards the rate as well.
+        :param raw: If True, events are received as RawBSONDocument and the callbacks get read-only documents that
+        only decode the fields they access. Saves CPU time when most events are skipped or only a few fields are
+        read. Process executors receive the raw bytes without encoding them again.
+        :param queue: If True, the worker processes the job queue of the MongoRepository instead of consuming its own
+        change stream (see MongoRepository.enable_job_queue). Pending documents survive outages of any length and the
+        worker is scaled out by starting it in more instances, so partitions are not supported.
+        :param scheduler: A SharedScheduler. If given, the worker runs its process callbacks in the threads of the
+        scheduler, which are shared with the other workers of this process, instead of its own num_threads threads. The
+        worker may use all threads of the scheduler unless a concurrency limiter or set_num_threads limits it.
+        :param weight: Share of the threads of the scheduler relative to the other workers with the same priority
+        :param priority: Workers with a higher priority get the threads of the scheduler first, e.g. latency-critical
+        steps. Workers with a lower priority only run while no worker with a higher priority has a backlog.
         """
+        if queue:
+            if shared_stream or partition is not None:
+                raise Exception('Queue workers do not support shared streams and partitions')
+
+            query = self._get_query(name)
+
+            def create_worker(key, match, projection, stream_match):
+                return QueueRunningWorker(name, acknowledge_callback, process_callback, self.mongo_repository, match,
+                                          resume, num_threads, query, max_queue_size=max_queue_size, key=key,
+                                          claim=claim, lease_time=lease_time, executor=executor, fuse=fuse,
+                                          projection=projection, coalesce_ms=coalesce_ms, stream_match=stream_match,
+                                          retry_policy=retry_policy,
+                                          concurrency_limiter=self._copy_limiter(concurrency_limiter),
+                                          rate_limit=rate_limit, raw=raw, scheduler=scheduler, weight=weight,
+                                          priority=priority)
+
+            self._start_workers(name, create_worker, partition, fields, client_filter, coalesce_ms is not None)
+
+            if backfill:
+                self.backfill(name)
+            return
+
+        def create_worker(key, match, projection, stream_match):
+            return RunningWorker(name, acknowledge_callback, process_callback, self.mongo_repository, match, resume,
+                                 num_threads, shared_stream=shared_stream, max_queue_size=max_queue_size, key=key,
+                                 claim=claim, lease_time=lease_time, executor=executor, fuse=fuse,
+                                 projection=projection, coalesce_ms=coalesce_ms, stream_match=stream_match,
+                                 retry_policy=retry_policy,
+                                 concurrency_limiter=self._copy_limiter(concurrency_limiter), rate_limit=rate_limit,
+                                 raw=raw, scheduler=scheduler, weight=weight, priority=priority)
+
+        self._start_workers(name, create_worker, partition, fields, client_filter, coalesce_ms is not None)
+
+        if backfill:
+            self.backfill(name)
+
+    def start_worker_batched(self, name, acknowledge_callback, process_batch_callback, max_batch_size=100,
+                             max_wait_ms=1000, resume=True, shared_stream=False, max_queue_size=None,
+                             executor='thread', num_threads=5, partition=None, fields=None, client_filter=False,
+                             rate_limit=None, raw=False, scheduler=None, weight=1, priority=0):
+        """
+        Start a new worker that processes documents in micro-batches. The start and end of the process are written
+        for the whole batch at once.
+        :param name: Name of the worker
+        :param acknowledge_callback: A function that takes a document as a parameter and returns True if the process
+        should run on the document, False otherwise
+        :param process_batch_callback: A function that takes a list of documents as a parameter and returns a list
+        with a tuple (success, results) for every document, in the same order
+        :param max_batch_size: Maximum number of documents per batch
+        :param max_wait_ms: Maximum number of milliseconds to wait for a batch to fill up
+        :param resume: Whether to resume the stream from where it stopped last time
+        :param shared_stream: See start_worker
+        :param max_queue_size: See start_worker
+        :param executor: See start_worker
+        :param num_threads: See start_worker
+        :param partition: See start_worker
+        :param fields: See start_worker
+        :param client_filter: See start_worker
+        :param rate_limit: Maximum number of documents per second and worker
+        :param raw: See start_worker
+        :param scheduler: See start_worker
+        :param weight: See start_worker
+        :param priority: See start_worker
+        """
+
+        def create_worker(key, match, projection, stream_match):
+            return BatchedRunningWorker(name, acknowledge_callback, process_batch_callback, self.mongo_repository,
+                                        match, resume, num_threads, max_batch_size, max_wait_ms,
+                                        shared_stream=shared_stream, max_queue_size=max_queue_size, key=key,
+                                        executor=executor, projection=projection, stream_match=stream_match,
+                                        rate_limit=rate_limit, raw=raw, scheduler=scheduler, weight=weight,
+                                        priority=priority)
+
+        self._start_workers(name, create_worker, partition, fields, client_filter)
+
+    def _start_workers(self, name, create_worker, partition=None, fields=None, client_filter=False, coalesce=False):
+        if partition is not None:
+            partition = PartitionCondition(*partition)
+
+        # Filters evaluated in this process (client_filter, and coalesced events that are reloaded) need the update
+        # description of the events
+        projection = self._get_projection(name, fields, client_filter or coalesce)
 
         for op_type in set(self.dependency.operation_types):
             key = name + '_' + op_type
+            if partition is not None:
+                key += '_' + partition.key
             if key in self.running_workers:
                 raise Exception('Worker {} is already running!'.format(key))
 
-            match = self._get_filter(name, op_type)
-            running_worker = RunningWorker(name, acknowledge_callback, process_callback, self.mongo_repository, match,
-                                           resume)
+            match = self._get_filter(name, op_type, partition)
+            stream_match = split_filter(match)[0] if client_filter else match
+            running_worker = create_worker(key, match, projection, stream_match)
             self.running_workers[key] = running_worker
 
             running_worker.start()
 
-    def stop_all(self):
+        self.partitions[name] = partition
+
+    def backfill(self, name, num_partitions=4, batch_size=1000):
+        """
+        Process all documents that already meet the dependencies of a running worker, e.g. after deploying a new
+        process or losing the resume token. The collection is scanned in parallel and every matching document is fed
+        into the worker. Start the backfill after the worker, so documents that change during the scan are picked up
+        by the change stream. Documents are read again right before they are fed into the worker and skipped if they
+        no longer match (e.g. because the change stream has processed them in the meantime) or are queued or in
+        flight in the worker.
+        :param name: Name of a running worker
+        :param num_partitions: Number of _id ranges scanned in parallel
+        :param batch_size: Cursor batch size
+        :return: The running Backfill
+        """
+        workers = self._get_workers(name)
+
+        if name in self.backfills:
+            self.backfills[name].stop()
+
+        query = self._get_query(name, self.partitions.get(name))
+        backfill = Backfill(self.mongo_repository, query, workers, num_partitions, batch_size)
+        self.backfills[name] = backfill
+        backfill.start()
+
+        return backfill
+
+    def set_num_threads(self, name, num_threads):
+        """
+        Resize the thread pools of a running worker without restarting it.
+        :param name: Name of a running worker
+        :param num_threads: The new number of threads per operation type and partition
+        """
+        for worker in self._get_workers(name):
+            worker.set_num_threads(num_threads)
+
+    def set_rate_limit(self, name, rate_limit, burst=None):
+        """
+        Change the maximum rate of a running worker without restarting it.
+        :param name: Name of a running worker
+        :param rate_limit: Number of calls per second per operation type and partition (None removes the limit)
+        :param burst: See TokenBucket
+        """
+        for worker in self._get_workers(name):
+            worker.set_rate_limit(rate_limit, burst)
+
+    def set_weight(self, name, weight, priority=None):
+        """
+        Change the share of the shared scheduler of a running worker without restarting it.
+        :param name: Name of a running worker that uses a SharedScheduler
+        :param weight: See start_worker
+        :param priority: See start_worker (None keeps the current priority)
+        """
+        for worker in self._get_workers(name):
+            worker.set_weight(weight, priority)
+
+    def _get_workers(self, name):
+        workers = [worker for worker in self.running_workers.values() if worker.name == name]
+        if len(workers) == 0:
+            raise Exception('Worker {} is not running!'.format(name))
+
+        return workers
+
+    def requeue_dead_letters(self, name, doc_ids=None, batch_size=1000):
+        """
+        Feed documents on which a process has failed on every attempt back into its running worker, e.g. after the
+        cause of the failures has been fixed. Dead letters are read and their documents loaded in batches with one
+        query each, and the dead letters are deleted once the documents have been queued. The retry policy starts
+        over for every requeued document.
+        :param name: Name of a running worker
+        :param doc_ids: Only requeue these documents (None requeues all dead letters of the process)
+        :param batch_size: Number of dead letters per batch
+        :return: Number of requeued documents
+        """
+        worker = self._get_workers(name)[0]
+        projection = worker.get_document_projection()
+        requeued = 0
+
+        while True:
+            dead_letters = list(self.mongo_repository.get_dead_letters(name, doc_ids, batch_size))
+            if len(dead_letters) == 0:
+                break
+
+            ids = [dead_letter['documentId'] for dead_letter in dead_letters]
+            queued = []
+            stopped = False
+
+            for document in self.mongo_repository.coll.find({'_id': {'$in': ids}}, projection):
+                if not worker.submit_document(document, 'requeue'):
+                    stopped = True
+                    break
+                queued.append(document['_id'])
+
+            # Dead letters of deleted documents are dropped as well, unless the worker has stopped
+            self.mongo_repository.delete_dead_letters(name, queued if stopped else ids)
+            requeued += len(queued)
+
+            if stopped:
+                break
+
+        self.logger.info('Requeued {} dead letter(s) of worker "{}"'.format(requeued, name))
+        return requeued
+
+    def stop_all(self, drain_timeout=30):
+        """
+        Stop all workers in parallel, flush pending writes and save the resume tokens.
+        :param drain_timeout: See RunningWorker.stop
+        """
         self.logger.info('Stopping all workers')
 
+        for backfill in self.backfills.values():
+            backfill.stop()
+        self.backfills = {}
+
+        # Close the shared stream first, so no worker parks the events it skips (see RunningWorker.stop)
+        for worker in self.running_workers.values():
+            if worker.shared_stream:
+                self.mongo_repository.dispatcher.unregister(worker)
+
         stop_tasks = []
 
-        for worker in self.running_workers:
-            task = Thread(target=self._stop_task, args=[worker])
+        for worker in list(self.running_workers):
+            task = Thread(target=self._stop_task, args=[worker, drain_timeout])
             stop_tasks.append(task)
             task.start()
 
@@ -56,14 +317,31 @@ class MongoWatch(object):
             task.join()
 
         self.running_workers = {}
+        self.partitions = {}
+
+        self.mongo_repository.flush()
 
         self.logger.info('Successfully stopped all workers')
 
-    def _stop_task(self, worker):
-        self.running_workers[worker].stop()
+    def get_queue_depths(self):
+        """
+        Get the number of events that are currently queued or in flight for each running worker.
+        :return: A dictionary mapping worker keys to queue depths
+        """
+        return dict((key, worker.queue_depth) for key, worker in self.running_workers.items())
+
+    def _copy_limiter(self, concurrency_limiter):
+        # Workers share the parameters but adapt their thread pools independently
+        return concurrency_limiter.copy() if concurrency_limiter is not None else None
+
+    def _stop_task(self, worker, drain_timeout):
+        self.running_workers[worker].stop(drain_timeout)
         del self.running_workers[worker]
 
-    def _get_filter(self, name, op_type):
+    def _get_filter(self, name, op_type, partition=None):
+        return compile_filter(self._build_filter(name, op_type, partition))
+
+    def _build_filter(self, name, op_type, partition=None):
         if len(self.dependency) == 0:
             raise Exception('Since v. 0.5.0 you have to add at least one dependency to mongowatch. Consider using OperationTypeDependency')
 
@@ -74,6 +352,8 @@ class MongoWatch(object):
         outer_and_list = []
 
         self.dependency._add_match_condition(name, match, outer_and_list, or_filters, op_type)
+        if partition is not None:
+            partition._add_match_condition(name, match, outer_and_list, or_filters, op_type)
 
         or_dict = {'$or': or_filters}
         outer_and_list.append(or_dict)
@@ -82,3 +362,36 @@ class MongoWatch(object):
 
         return match
 
+    def _get_projection(self, name, fields, update_description=False):
+        if fields is None:
+            return None
+
+        document_fields = ['_id', name] + list(fields) + self.dependency._get_fields(name)
+        paths = ['operationType', 'clusterTime', 'documentKey'] + ['fullDocument.' + field for field in document_fields]
+        if update_description:
+            paths.append('updateDescription')
+
+        return self.mongo_repository.create_projection(paths)
+
+    def _get_query(self, name, partition=None):
+        queries = []
+
+        for op_type in set(self.dependency.operation_types):
+            query = {}
+            or_filters = [{name: {'$exists': False}}]
+            and_list = []
+
+            self.dependency._add_query_condition(name, query, and_list, or_filters, op_type)
+            if partition is not None:
+                partition._add_query_condition(name, query, and_list, or_filters, op_type)
+
+            and_list.append({'$or': or_filters})
+            query['$and'] = and_list
+            queries.append(query)
+
+        not_running = {'$or': [
+            {'{}.isRunning'.format(name): {'$ne': True}},
+            {'{}.leaseExpiry'.format(name): {'$lt': datetime.datetime.utcnow()}}
+        ]}
+
+        return {'$and': [queries[0] if len(queries) == 1 else {'$or': queries}, not_running]}
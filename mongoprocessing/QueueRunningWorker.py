@@ -0,0 +1,173 @@
+from threading import Event, Lock, Thread
+
+from .JobQueue import QueueFeeder
+from .RunningWorker import RunningWorker
+
+
+class QueueRunningWorker(RunningWorker):
+    def __init__(self, name, acknowledge_callback, process_callback, mongo_repository, match, resume=True,
+                 num_threads=5, query=None, **kwargs):
+        """
+        A worker that processes the entries of the job queue of a MongoRepository (see enable_job_queue) instead of
+        the events of its own change stream. Its events are turned into queue entries by the change stream of the job
+        queue, and the worker leases entries in batches, loads their documents with a single query and deletes the
+        entries once the documents have been processed. Any number of instances can consume the same queue.
+        :param query: Query of all documents the process may need to run on. If given, these documents are enqueued
+        again when the change stream of the job queue cannot resume.
+        """
+        RunningWorker.__init__(self, name, acknowledge_callback, process_callback, mongo_repository, match, resume,
+                               num_threads, **kwargs)
+        if self.shared_stream:
+            raise Exception('Queue workers do not support shared streams')
+        if mongo_repository.job_queue is None:
+            raise Exception('No job queue has been enabled')
+
+        self.job_queue = mongo_repository.job_queue
+        # Progress is kept in the queue instead of a resume token
+        self.checkpointer = None
+        self.feeder = QueueFeeder(self, query)
+
+        self.lease_lock = Lock()
+        self.lease_event = Event()
+        self.leases = {}
+        self.completed = []
+
+        self.renew_event = Event()
+        self.renew_task = Thread(target=self._run_renew_thread)
+        self.renew_task.daemon = True
+
+    def start(self):
+        RunningWorker.start(self)
+        self.renew_task.start()
+        self.job_queue.register(self.feeder, self.resume)
+
+    def stop(self, drain_timeout=30):
+        """
+        Stop the worker. Entries that have not been processed are released, so other instances can lease them right
+        away. See RunningWorker.stop.
+        """
+        self.job_queue.unregister(self.feeder)
+        RunningWorker.stop(self, drain_timeout)
+        # Leases are renewed while the worker drains and released below
+        self.renew_event.set()
+
+        self._complete_entries()
+
+        with self.lease_lock:
+            entries = list(self.leases.values())
+            self.leases = {}
+
+        try:
+            self.job_queue.release(entries)
+        except:
+            self.logger.exception('Unable to release the entries of worker "{}"'.format(self.name))
+
+    def _on_abort(self):
+        RunningWorker._on_abort(self)
+        self.lease_event.set()
+
+    def _run_renew_thread(self):
+        # Leases of documents that take longer than the lease time would otherwise expire and be leased again
+        interval = self.job_queue.lease_time / 3.0
+
+        while not self.renew_event.wait(interval):
+            with self.lease_lock:
+                entries = list(self.leases.values())
+
+            try:
+                self.job_queue.renew(entries)
+            except:
+                self.logger.exception('Unable to renew the leases of worker "{}"'.format(self.name))
+
+    def _run_watch_thread(self, match, resume):
+        self.logger.info('Worker thread "{}" started consuming the job queue'.format(self.name))
+        batch_size = self.job_queue.batch_size
+
+        while not self.abort:
+            self.lease_event.clear()
+
+            try:
+                self._complete_entries()
+
+                with self.lease_lock:
+                    count = batch_size - len(self.leases)
+
+                # Wait until at least half a batch has been processed instead of leasing single entries
+                if count < max(1, batch_size // 2):
+                    self.lease_event.wait(self.job_queue.poll_interval)
+                elif self._lease_entries(count) < count:
+                    self.lease_event.wait(self.job_queue.poll_interval)
+            except:
+                self.logger.exception('Unable to lease entries for worker "{}"'.format(self.name))
+                self.lease_event.wait(self.job_queue.poll_interval)
+
+        self.logger.info('Worker thread "{}" stopped successfully'.format(self.name))
+
+    def _lease_entries(self, count):
+        entries = self.job_queue.lease(self.name, self.owner, count)
+        if len(entries) == 0:
+            return 0
+
+        with self.lease_lock:
+            for entry in entries:
+                self.leases[entry['documentId']] = entry
+
+        # The entries have been leased before without being completed, e.g. by an instance that crashed while the
+        # process was running. Claims expire by themselves, but a process marked as running would never run again.
+        stale_ids = [entry['documentId'] for entry in entries if entry['attempts'] > 1]
+        if len(stale_ids) > 0 and not self.claim:
+            self.mongo_repository.reset_processes(stale_ids, self.name)
+
+        documents = self.mongo_repository.get_multiple_by_ids([entry['documentId'] for entry in entries],
+                                                              self.get_document_projection())
+        documents = dict((document['_id'], document) for document in documents)
+
+        for entry in entries:
+            done_callback = lambda entry=entry: self._complete(entry)
+            document = documents.get(entry['documentId'])
+
+            if document is None:
+                # The document has been deleted
+                done_callback()
+            elif not self.submit_document(document, 'queue', done_callback):
+                # The worker is stopping, the remaining entries are released
+                break
+
+        return len(entries)
+
+    def _on_already_running(self, document):
+        # The process has not run, so the entry is kept until its lease expires and then leased again
+        self._defer(document['_id'])
+
+    def _on_failed(self, doc, done_callback):
+        # The writes of the process failed, e.g. during a failover. Instead of delivering the event again in this
+        # instance, the entry is kept until its lease expires and then leased again by any instance.
+        self.logger.warning('Process "{}" failed to run on document {}, it is leased again after {} second(s)'
+                            .format(self.name, doc['documentKey']['_id'], self.job_queue.lease_time))
+        self._defer(doc['documentKey']['_id'])
+        if done_callback is not None:
+            done_callback()
+
+    def _defer(self, doc_id):
+        with self.lease_lock:
+            entry = self.leases.get(doc_id)
+            if entry is not None:
+                entry['deferred'] = True
+
+    def _complete(self, entry):
+        with self.lease_lock:
+            self.leases.pop(entry['documentId'], None)
+            if not entry.get('deferred', False):
+                self.completed.append(entry)
+
+        self.lease_event.set()
+
+    def _complete_entries(self):
+        with self.lease_lock:
+            completed = self.completed
+            self.completed = []
+
+        if len(completed) > 0:
+            # Entries that fail to be deleted are leased again after their lease expired
+            self.job_queue.complete(completed)
+            self.metrics.increment('jobs_completed_total', {'process': self.name}, len(completed))
@@ -0,0 +1,240 @@
+import time
+from collections import OrderedDict
+from threading import Lock, Thread
+
+from bson import BSON
+
+
+class ReadCache(object):
+    def __init__(self, mongo_repository, max_entries=10000, max_bytes=64 * 1024 * 1024, ttl=None, refresh=False):
+        """
+        LRU cache for documents read by ID. The cache watches the collection and drops every document that is
+        updated, replaced or deleted, so it never returns a document that changed before the change event has been
+        received. Documents are stored as BSON, which bounds the memory usage exactly and hands every caller its own
+        copy. Nothing is cached while the change stream is not running.
+        :param mongo_repository: The MongoRepository whose reads are cached
+        :param max_entries: Maximum number of cached documents
+        :param max_bytes: Maximum total BSON size of the cached documents (None for no limit)
+        :param ttl: Number of seconds after which a document is read again even if it did not change (None for no
+        limit)
+        :param refresh: If True, cached documents are replaced by the new version from the change stream instead of
+        being dropped. This needs a full document lookup for every update of the collection.
+        """
+        self.mongo_repository = mongo_repository
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.refresh = refresh
+
+        self.logger = mongo_repository.logger
+        self.metrics = mongo_repository.metrics
+
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+
+        # IDs changed while a read was in flight must not be cached with the result of that read
+        self.pending_reads = 0
+        self.changed_ids = set()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        # Incremented whenever the change stream stops, reads started before must not be cached
+        self.epoch = 0
+        self.coherent = False
+        self.abort = False
+        self.task = Thread(target=self._run_watch_thread)
+        self.task.daemon = True
+
+    def start(self):
+        self.task.start()
+
+    def stop(self):
+        self.abort = True
+        if self.task.ident is not None:
+            self.task.join()
+        self.clear()
+
+    def get(self, doc_id):
+        """
+        Get a document by ID, reading it from the collection on a miss.
+        :param doc_id: The document ID
+        :return: The document or None if it does not exist
+        """
+        documents = self.get_multiple([doc_id])
+        return documents[0] if len(documents) > 0 else None
+
+    def get_multiple(self, ids):
+        """
+        Get multiple documents by ID. All misses are read from the collection with a single query.
+        :param ids: The document IDs
+        :return: A list of all documents that exist, hits first
+        """
+        hits = []
+        missing = []
+        now = time.time()
+
+        with self.lock:
+            for doc_id in ids:
+                entry = self._get_entry(doc_id, now)
+                if entry is not None:
+                    hits.append(entry[0])
+                else:
+                    missing.append(doc_id)
+
+            self.hits += len(hits)
+            self.misses += len(missing)
+            self.pending_reads += 1
+            epoch = self.epoch
+
+        self.metrics.increment('cache_hits_total', None, len(hits))
+        self.metrics.increment('cache_misses_total', None, len(missing))
+
+        documents = [BSON(data).decode() for data in hits]
+
+        try:
+            if len(missing) > 0:
+                fetched = list(self.mongo_repository.coll.find({'_id': {'$in': missing}}))
+                for document in fetched:
+                    self._put(document, epoch)
+                documents.extend(fetched)
+        finally:
+            with self.lock:
+                self.pending_reads -= 1
+                if self.pending_reads == 0:
+                    self.changed_ids.clear()
+
+        return documents
+
+    def invalidate(self, doc_ids):
+        """
+        Drop documents from the cache, e.g. because they have been written by this process.
+        :param doc_ids: The document IDs
+        """
+        with self.lock:
+            for doc_id in doc_ids:
+                self._remove(doc_id)
+                if self.pending_reads > 0:
+                    self.changed_ids.add(doc_id)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def get_stats(self):
+        """
+        :return: A dictionary with the number of hits, misses, evictions, invalidations, entries and bytes
+        """
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'entries': len(self.entries),
+                'bytes': self.size
+            }
+
+    def _get_entry(self, doc_id, now):
+        if not self.coherent:
+            return None
+
+        entry = self.entries.pop(doc_id, None)
+        if entry is None:
+            return None
+
+        if entry[1] is not None and entry[1] <= now:
+            self.size -= len(entry[0])
+            return None
+
+        # Move the entry to the end of the LRU order
+        self.entries[doc_id] = entry
+        return entry
+
+    def _put(self, document, epoch=None):
+        # epoch is the epoch at the start of a read, None for documents from the change stream
+        data = BSON.encode(document)
+        if self.max_bytes is not None and len(data) > self.max_bytes:
+            return
+
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        evicted = 0
+
+        with self.lock:
+            doc_id = document['_id']
+            if not self.coherent:
+                return
+            if epoch is not None and (epoch != self.epoch or doc_id in self.changed_ids):
+                return
+
+            self._remove(doc_id)
+            self.entries[doc_id] = (data, expires)
+            self.size += len(data)
+
+            while len(self.entries) > self.max_entries or \
+                    (self.max_bytes is not None and self.size > self.max_bytes):
+                _, entry = self.entries.popitem(last=False)
+                self.size -= len(entry[0])
+                evicted += 1
+
+            self.evictions += evicted
+
+        if evicted > 0:
+            self.metrics.increment('cache_evictions_total', None, evicted)
+
+    def _remove(self, doc_id):
+        entry = self.entries.pop(doc_id, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+
+    def _run_watch_thread(self):
+        pipeline = [
+            {'$match': {'operationType': {'$in': ['update', 'replace', 'delete']}}},
+            {'$project': {'operationType': 1, 'documentKey': 1, 'fullDocument': 1}}
+        ]
+        full_document = 'updateLookup' if self.refresh else None
+
+        while not self.abort:
+            try:
+                stream = self.mongo_repository.coll.watch(pipeline, full_document=full_document,
+                                                          max_await_time_ms=self.mongo_repository.max_await_time_ms)
+                with stream:
+                    with self.lock:
+                        self.coherent = True
+                        # Reads that started before the stream was opened may have missed changes
+                        self.epoch += 1
+                    self.logger.info('Read cache started watching for changes')
+
+                    while stream.alive and not self.abort:
+                        event = stream.try_next()
+                        if event is not None:
+                            self._handle_event(event)
+            except:
+                if not self.abort:
+                    self.logger.exception('Change stream of the read cache failed, restarting')
+            finally:
+                with self.lock:
+                    self.coherent = False
+                    self.epoch += 1
+                self.clear()
+
+            if not self.abort:
+                time.sleep(1)
+
+    def _handle_event(self, event):
+        doc_id = event['documentKey']['_id']
+        document = event.get('fullDocument')
+
+        with self.lock:
+            cached = doc_id in self.entries
+            self.invalidations += 1
+
+        self.invalidate([doc_id])
+        if self.refresh and cached and document is not None:
+            self._put(document)
+
+        self.metrics.increment('cache_invalidations_total')
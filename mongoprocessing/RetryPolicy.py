@@ -0,0 +1,42 @@
+import random
+
+
+class RetryPolicy(object):
+    def __init__(self, max_attempts=3, initial_delay=1.0, max_delay=300.0, multiplier=2.0, jitter=0.5):
+        """
+        Describes how often and when a worker retries a process that failed on a document. The delay grows
+        exponentially with every attempt and is randomly shortened by up to jitter of its length, so documents that
+        failed together (e.g. during an outage of a downstream service) are not retried all at once.
+        :param max_attempts: Number of attempts including the first one. After the last failed attempt the document
+        is written to the dead letter collection (see MongoRepository.set_dead_letter_collection).
+        :param initial_delay: Seconds to wait before the first retry
+        :param max_delay: Upper bound of the delay in seconds
+        :param multiplier: Factor by which the delay grows with every attempt
+        :param jitter: Fraction of the delay (between 0 and 1) that is randomly subtracted
+        """
+        if max_attempts < 1:
+            raise Exception('A retry policy needs at least one attempt')
+        if jitter < 0 or jitter > 1:
+            raise Exception('The jitter must be between 0 and 1')
+
+        self.max_attempts = max_attempts
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+
+    def should_retry(self, attempts):
+        """
+        :param attempts: Number of failed attempts so far
+        :return: True if the process should be attempted again
+        """
+        return attempts < self.max_attempts
+
+    def get_delay(self, attempts):
+        """
+        Get the delay before the next attempt.
+        :param attempts: Number of failed attempts so far
+        :return: The delay in seconds
+        """
+        delay = min(self.max_delay, self.initial_delay * self.multiplier ** (attempts - 1))
+        return delay * (1 - self.jitter * random.random())
@@ -1,81 +1,918 @@
+import heapq
+import itertools
+import os
+import socket
 import time
-from threading import Thread
-from multiprocessing.pool import ThreadPool
+import traceback
+import uuid
+from threading import Condition, Thread
+
+from .concurrency import TokenBucket, WorkerPool
+from .executors import ProcessExecutor, call_process_callback, encode_document
+from .matching import matches
+
+# Delay before an event whose writes failed is delivered again, doubled up to the maximum for every further failure
+_REDELIVERY_DELAY = 1
+_MAX_REDELIVERY_DELAY = 60
+
+
+def _get_document_id(doc):
+    document_key = doc.get('documentKey')
+    if document_key is not None:
+        return document_key.get('_id')
+
+    return doc.get('fullDocument', {}).get('_id')
+
+
+def _get_event_age(doc):
+    cluster_time = doc.get('clusterTime')
+    if cluster_time is None:
+        return None
+
+    return time.time() - cluster_time.time
+
+
+class _CoalescedEvent(object):
+    def __init__(self, doc, done_callback, deadline):
+        self.doc = doc
+        self.done_callbacks = [done_callback]
+        self.queued = time.time()
+        self.deadline = deadline
+        self.deferred = False
+
+    def add(self, doc, done_callback):
+        self.doc = doc
+        self.done_callbacks.append(done_callback)
+
+    def done(self):
+        for done_callback in self.done_callbacks:
+            if done_callback is not None:
+                done_callback()
+
 
 class RunningWorker(object):
-    def __init__(self, name, acknowledge_callback, process_callback, mongo_repository, match, resume=True, num_threads=5):
+    def __init__(self, name, acknowledge_callback, process_callback, mongo_repository, match, resume=True, num_threads=5,
+                 shared_stream=False, max_queue_size=None, key=None, claim=False, lease_time=300, executor='thread',
+                 fuse=False, projection=None, coalesce_ms=None, stream_match=None, retry_policy=None,
+                 concurrency_limiter=None, rate_limit=None, raw=False, scheduler=None, weight=1, priority=0):
         self.name = name
+        self.key = key if key is not None else name
         self.acknowledge_callback = acknowledge_callback
         self.process_callback = process_callback
         self.mongo_repository = mongo_repository
+        self.match = match
+        # A less selective filter for the change stream, events are checked against match on the client
+        self.stream_match = stream_match if stream_match is not None else match
+        self.resume = resume
+        self.shared_stream = shared_stream
+        self.claim = claim
+        self.lease_time = lease_time
+        self.fuse = fuse
+        self.projection = projection
+        self.raw = raw
+        self.owner = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+        if fuse and claim:
+            # A fused process is started by the write of the upstream worker, which cannot claim it
+            raise Exception('Fused workers do not support claim mode')
 
         self.logger = mongo_repository.logger
+        self.metrics = mongo_repository.metrics
+        self.metric_labels = {'worker': self.key}
 
         self.abort = False
         self.running = False
 
-        self.running_tasks = ThreadPool(num_threads)
+        self.concurrency_limiter = concurrency_limiter
+        if concurrency_limiter is not None:
+            num_threads = concurrency_limiter.limit
+
+        self.scheduler = scheduler
+        if scheduler is not None:
+            # Without a concurrency limiter, the worker may use all threads of the scheduler
+            max_concurrency = num_threads if concurrency_limiter is not None else None
+            self.running_tasks = scheduler.create_queue(weight, priority, max_concurrency)
+        else:
+            self.running_tasks = WorkerPool(num_threads)
+        self.metrics.set_gauge('concurrency_limit', self.metric_labels, self.running_tasks.size)
+
+        self.rate_limiter = None
+        self.set_rate_limit(rate_limit)
+
+        self.owns_executor = False
+        if executor == 'thread' or executor is None:
+            self.executor = None
+        elif executor == 'process':
+            self.executor = ProcessExecutor(num_threads)
+            self.owns_executor = True
+        elif hasattr(executor, 'submit'):
+            self.executor = executor
+        else:
+            raise Exception('Unknown executor {}'.format(executor))
+
+        self.max_queue_size = max_queue_size
+        self.queue_condition = Condition()
+        self.queue_depth = 0
+        self.in_flight = 0
+        self.active_ids = {}
+        self.started_ids = {}
+
+        self.checkpointer = None if shared_stream else mongo_repository.create_checkpointer(self.key)
+
+        self.task = Thread(target=self._run_watch_thread, args=[self.stream_match, resume])
 
-        self.task = Thread(target=self._run_watch_thread, args=[match, resume])
+        self.coalesce_window = coalesce_ms / 1000.0 if coalesce_ms is not None else None
+        self.coalesce_condition = Condition()
+        self.coalesced_events = {}
+        self.running_ids = set()
+        self.coalesce_task = Thread(target=self._run_coalesce_thread)
+        self.coalesce_task.daemon = True
+
+        # While a backfill runs (and for events from before it ended), processes only start on documents that still
+        # match its query, so the backfill and the change stream do not both process a document
+        self.backfill_query = None
+        self.backfill_end = None
+
+        self.retry_policy = retry_policy
+        self.retry_condition = Condition()
+        self.retry_attempts = {}
+        self.retry_schedule = []
+        self.retry_scheduled = set()
+        self.retry_sequence = itertools.count()
+        self.redeliveries = []
+        self.retry_task = Thread(target=self._run_retry_thread)
+        self.retry_task.daemon = True
 
     def start(self):
         self.logger.info('Starting thread for worker "{}"'.format(self.name))
         self.running = True
-        self.task.start()
 
-    def stop(self):
+        if self.fuse:
+            self.mongo_repository.local_scheduler.register(self)
+
+        if self.coalesce_window is not None:
+            self.coalesce_task.start()
+
+        # Also delivers events again whose writes failed
+        self.retry_task.start()
+
+        if self.shared_stream:
+            self.mongo_repository.dispatcher.register(self, self.resume)
+        else:
+            if self.checkpointer is not None:
+                self.checkpointer.start()
+            self.task.start()
+
+    def stop(self, drain_timeout=30):
+        """
+        Stop the worker. Its change stream is closed within max_await_time_ms of the MongoRepository, pending writes
+        are flushed and the resume token is saved.
+        :param drain_timeout: Wait at most drain_timeout seconds for the documents that are being processed. Queued
+        documents are not processed anymore and are received again after a restart. If the shared stream keeps running
+        for other workers, they are parked instead and delivered when the worker is started again. Documents whose
+        process is still running after the timeout are logged and marked as not running, so they are processed again
+        after a restart as well. If None, wait for all documents that are being processed without a timeout.
+        """
         self.logger.info('Stopping worker "{}"'.format(self.name))
+
+        if self.shared_stream:
+            self.mongo_repository.dispatcher.unregister(self)
+
         self.abort = True
+        self._on_abort()
+
+        if self.fuse:
+            self.mongo_repository.local_scheduler.unregister(self)
+
+        with self.queue_condition:
+            self.queue_condition.notify_all()
+
+        if self.task.ident is not None:
+            self.task.join()
+
+        drained = drain_timeout is None or self._drain(time.time() + drain_timeout)
+
+        if self.shared_stream:
+            # Queued events are skipped one by one, so the shared checkpoint does not wait for them
+            self.running_tasks.close()
+            self._skip_coalesced_events()
+        else:
+            self.running_tasks.terminate()
+        if drained:
+            self.running_tasks.join()
+
+        if self.owns_executor:
+            self.executor.shutdown(wait=False)
+
+        self.mongo_repository.flush()
+        if not drained:
+            self._reset_started()
+
+        if self.checkpointer is not None:
+            self.checkpointer.stop()
+        elif self.shared_stream:
+            self.mongo_repository.dispatcher.save_checkpoint()
 
-        self.running_tasks.terminate()
-        self.running_tasks.join()
         self.logger.info('Successfully stopped worker "{}"'.format(self.name))
 
+    def set_num_threads(self, num_threads):
+        """
+        Resize the thread pool while the worker is running. With a concurrency limiter, the limiter continues to adapt
+        from the new size. With a shared scheduler, this limits the number of its threads the worker uses.
+        :param num_threads: The new number of threads
+        """
+        if self.concurrency_limiter is not None:
+            num_threads = self.concurrency_limiter.set_limit(num_threads)
+
+        self._resize(num_threads)
+
+    def set_rate_limit(self, rate_limit, burst=None):
+        """
+        Change the maximum rate of process callbacks while the worker is running. With a shared scheduler, the rate
+        limits the tasks of the worker instead, which wait in its queue (see ScheduledQueue.set_rate_limiter).
+        :param rate_limit: Number of calls per second (None removes the limit)
+        :param burst: See TokenBucket
+        """
+        if rate_limit is None:
+            self.rate_limiter = None
+        elif self.rate_limiter is None:
+            self.rate_limiter = TokenBucket(rate_limit, burst)
+        else:
+            self.rate_limiter.set_rate(rate_limit, burst)
+
+        if self.scheduler is not None:
+            # Tasks wait for their token in the queue of the worker, so they do not block threads of other workers
+            self.running_tasks.set_rate_limiter(self.rate_limiter)
+
+    def set_weight(self, weight, priority=None):
+        """
+        Change the share of the threads of the shared scheduler while the worker is running.
+        :param weight: See SharedScheduler.create_queue
+        :param priority: See SharedScheduler.create_queue (None keeps the current priority)
+        """
+        if self.scheduler is None:
+            raise Exception('Worker "{}" does not use a shared scheduler'.format(self.key))
+
+        self.running_tasks.set_weight(weight, priority)
+
+    def _resize(self, num_threads):
+        self.running_tasks.resize(num_threads)
+        self.metrics.set_gauge('concurrency_limit', self.metric_labels, self.running_tasks.size)
+        self.logger.debug('Worker "{}" now runs {} thread(s)'.format(self.key, self.running_tasks.size))
+
+    def _drain(self, deadline):
+        """
+        Wait until no document is being processed anymore.
+        :param deadline: Give up at this time
+        :return: True if all documents have been processed, False if the deadline has passed
+        """
+        with self.queue_condition:
+            while self.in_flight > 0:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.logger.warning('{} document(s) of worker "{}" are still being processed after the drain '
+                                        'timeout, abandoning documents {}'
+                                        .format(self.in_flight, self.name, sorted(self.started_ids, key=repr)))
+                    return False
+
+                self.queue_condition.wait(remaining)
+
+        return True
+
+    def _reset_started(self):
+        with self.queue_condition:
+            doc_ids = list(self.started_ids.keys())
+
+        if len(doc_ids) > 0:
+            try:
+                self.mongo_repository.reset_processes(doc_ids, self.name, self.owner if self.claim else None)
+            except:
+                self.logger.exception('Unable to reset the running processes of worker "{}"'.format(self.name))
+
+    def _add_started(self, doc_ids):
+        with self.queue_condition:
+            for doc_id in doc_ids:
+                self.started_ids[doc_id] = self.started_ids.get(doc_id, 0) + 1
+
+    def _remove_started(self, doc_ids):
+        with self.queue_condition:
+            for doc_id in doc_ids:
+                count = self.started_ids.get(doc_id, 0) - 1
+                if count > 0:
+                    self.started_ids[doc_id] = count
+                else:
+                    self.started_ids.pop(doc_id, None)
+
+    def _on_abort(self):
+        with self.coalesce_condition:
+            self.coalesce_condition.notify()
+
+        with self.retry_condition:
+            self.retry_condition.notify()
+
     def _run_watch_thread(self, match, resume):
-        with self.mongo_repository.watch(match, resume=resume) as stream:
+        resume_token = self.checkpointer.load() if resume else None
+
+        with self.mongo_repository.watch(match, resume=resume, resume_token=resume_token,
+                                         projection=self.projection, raw=self.raw) as stream:
             self.logger.info('Worker thread "{}" started successfully\n'.format(self.name))
-            for doc in stream:
+            # try_next returns after max_await_time_ms without an event, so a stopped worker notices it promptly
+            while stream.alive and not self.abort:
+                doc = stream.try_next()
                 if self.abort:
                     return
                 if not self.running:
                     continue
 
                 if doc is not None:
-                    self.running_tasks.apply_async(func=self._run_process_thread, args=[doc])
+                    position = self.checkpointer.received(doc.get('_id'))
+                    if self.stream_match is not self.match and not matches(self.match, doc):
+                        self.checkpointer.completed(position)
+                        continue
+
+                    self.submit(doc, lambda position=position: self.checkpointer.completed(position))
 
         self.logger.info('Worker thread "{}" stopped successfully'.format(self.name))
 
+    def submit(self, doc, done_callback=None):
+        """
+        Queue a change event for processing. Blocks while max_queue_size events are queued or in flight, which slows
+        down the consumption of the change stream.
+        :param doc: The change event
+        :param done_callback: A function without parameters that is called once the event has been handled
+        :return: True if the event has been queued, False if the worker is not running
+        """
+        if self.coalesce_window is not None:
+            return self._submit_coalesced(doc, done_callback)
+
+        if not self._acquire_queue_slot(doc):
+            return False
+
+        self.running_tasks.apply_async(func=self._run_queued_task, args=[doc, done_callback, time.time()])
+        return True
+
+    def submit_document(self, document, operation_type, done_callback=None, start_query=None):
+        """
+        Queue a document that has not been received from the change stream, e.g. by a backfill or a retry.
+        :param document: The document
+        :param operation_type: The operationType of the change event that is created for the document
+        :param done_callback: A function without parameters that is called once the document has been handled
+        :param start_query: If given, the process only starts if the document still matches this query when it is
+        started (see MongoRepository.start_process_if)
+        :return: True if the document has been queued, False if the worker is not running
+        """
+        doc = {
+            '_id': None,
+            'operationType': operation_type,
+            'documentKey': {'_id': document['_id']},
+            'fullDocument': document
+        }
+        if start_query is not None:
+            doc['startQuery'] = start_query
+
+        return self.submit(doc, done_callback)
+
+    def _submit_coalesced(self, doc, done_callback):
+        doc_id = _get_document_id(doc)
+
+        if self._merge_coalesced_event(doc_id, doc, done_callback):
+            return True
+
+        if not self._acquire_queue_slot(doc):
+            return False
+
+        with self.coalesce_condition:
+            # Another event for the same document may have arrived in the meantime
+            if self._merge_coalesced_event(doc_id, doc, done_callback):
+                self._release_queue_slots([doc])
+                return True
+
+            self.coalesced_events[doc_id] = _CoalescedEvent(doc, done_callback, time.time() + self.coalesce_window)
+            self.coalesce_condition.notify()
+
+        return True
+
+    def _merge_coalesced_event(self, doc_id, doc, done_callback):
+        with self.coalesce_condition:
+            coalesced_event = self.coalesced_events.get(doc_id)
+            if coalesced_event is None:
+                return False
+
+            coalesced_event.add(doc, done_callback)
+
+        self.metrics.increment('events_coalesced_total', self.metric_labels)
+        return True
+
+    def _run_coalesce_thread(self):
+        with self.coalesce_condition:
+            while not self.abort:
+                now = time.time()
+                next_deadline = None
+
+                for doc_id, coalesced_event in list(self.coalesced_events.items()):
+                    if doc_id in self.running_ids:
+                        # Wait until the document is no longer in flight
+                        if not coalesced_event.deferred:
+                            coalesced_event.deferred = True
+                            self.metrics.increment('events_deferred_total', self.metric_labels)
+                    elif coalesced_event.deadline <= now:
+                        del self.coalesced_events[doc_id]
+                        self.running_ids.add(doc_id)
+                        self.running_tasks.apply_async(func=self._run_coalesced_task, args=[doc_id, coalesced_event])
+                    elif next_deadline is None or coalesced_event.deadline < next_deadline:
+                        next_deadline = coalesced_event.deadline
+
+                self.coalesce_condition.wait(next_deadline - now if next_deadline is not None else None)
+
+    def _run_coalesced_task(self, doc_id, coalesced_event):
+        queued = False
+
+        try:
+            doc = coalesced_event.doc
+            if coalesced_event.deferred:
+                doc = self._refresh_event(doc)
+
+            if doc is not None:
+                queued = True
+                self._run_queued_task(doc, coalesced_event.done, coalesced_event.queued)
+            else:
+                self._release_queue_slots([coalesced_event.doc])
+        except:
+            self.logger.exception('An error occurred while trying to process data')
+            self._release_queue_slots([coalesced_event.doc])
+        finally:
+            with self.coalesce_condition:
+                self.running_ids.discard(doc_id)
+                self.coalesce_condition.notify()
+
+            if not queued:
+                coalesced_event.done()
+
+    def _refresh_event(self, doc):
+        """
+        Reload the document of an event that has been deferred while the document was in flight, since the process
+        has changed the document in the meantime.
+        :param doc: The change event
+        :return: The change event with the current document or None if the event no longer matches the filter
+        """
+        document = self.mongo_repository.coll.find_one({'_id': _get_document_id(doc)}, self.get_document_projection())
+        if document is None:
+            return None
+
+        doc = dict(doc)
+        doc['fullDocument'] = document
+        if not matches(self.match, doc):
+            return None
+
+        return doc
+
+    def get_document_projection(self):
+        """
+        Get the projection for reading the fields of documents that the worker receives from its change stream.
+        :return: The projection or None if the worker receives the whole documents
+        """
+        if self.projection is None:
+            return None
+
+        prefix = 'fullDocument.'
+        return dict((path[len(prefix):], 1) for path in self.projection if path.startswith(prefix))
+
+    def is_active(self, doc_id):
+        """
+        Check whether an event for a document is currently queued or in flight.
+        :param doc_id: The ID of the document
+        :return: True if the document is queued or being processed
+        """
+        return doc_id in self.active_ids
+
+    def _acquire_queue_slot(self, doc):
+        with self.queue_condition:
+            while self.max_queue_size is not None and self.queue_depth >= self.max_queue_size and not self.abort:
+                self.queue_condition.wait()
+
+            if self.abort or not self.running:
+                return False
+
+            self.queue_depth += 1
+            self.metrics.set_gauge('queue_depth', self.metric_labels, self.queue_depth)
+
+            doc_id = _get_document_id(doc)
+            self.active_ids[doc_id] = self.active_ids.get(doc_id, 0) + 1
+
+        self.metrics.increment('events_received_total', self.metric_labels)
+        age = _get_event_age(doc)
+        if age is not None:
+            self.metrics.observe('stream_lag_seconds', self.metric_labels, age)
+
+        return True
+
+    def _release_queue_slots(self, docs):
+        with self.queue_condition:
+            self.queue_depth -= len(docs)
+            self.queue_condition.notify(len(docs))
+            self.metrics.set_gauge('queue_depth', self.metric_labels, self.queue_depth)
+
+            for doc in docs:
+                doc_id = _get_document_id(doc)
+                count = self.active_ids.get(doc_id, 0) - 1
+                if count > 0:
+                    self.active_ids[doc_id] = count
+                else:
+                    self.active_ids.pop(doc_id, None)
+
+    def _skip_events(self, events):
+        """
+        Drop queued events while the worker is draining.
+        :param events: A list of tuples (doc, done_callback)
+        """
+        self._release_queue_slots([doc for doc, _ in events])
+        self._abandon_events(events)
+
+    def _abandon_events(self, events):
+        """
+        Give up events that have not been processed because the worker is stopping.
+        :param events: A list of tuples (doc, done_callback)
+        """
+        if not self.shared_stream or len(events) == 0:
+            # The events are received again after a restart
+            return
+
+        # The shared stream may keep running for other workers, it delivers the events once the worker is started again
+        if self.mongo_repository.dispatcher.park(self.key, events):
+            self.logger.warning('Worker "{}" parked {} unprocessed event(s) while stopping, the shared checkpoint waits '
+                                'for them until the worker is started again'.format(self.name, len(events)))
+
+    def _skip_coalesced_events(self):
+        with self.coalesce_condition:
+            coalesced_events = list(self.coalesced_events.values())
+            self.coalesced_events = {}
+
+        self._skip_events([(coalesced_event.doc, coalesced_event.done) for coalesced_event in coalesced_events])
+
+    def _run_queued_task(self, doc, done_callback, queued=None):
+        with self.queue_condition:
+            if self.abort:
+                # The worker is draining, the event is skipped
+                skipped = True
+            else:
+                skipped = False
+                self.in_flight += 1
+                self.metrics.set_gauge('in_flight', self.metric_labels, self.in_flight)
+
+        if skipped:
+            self._skip_events([(doc, done_callback)])
+            return
+
+        if queued is not None:
+            self.metrics.observe('queue_wait_seconds', self.metric_labels, time.time() - queued)
+
+        failed = False
+        end_write = None
+        try:
+            end_write = self._run_process_thread(doc)
+        except:
+            self.logger.exception('An error occurred while trying to process data')
+            failed = True
+        finally:
+            with self.queue_condition:
+                self.in_flight -= 1
+                self.metrics.set_gauge('in_flight', self.metric_labels, self.in_flight)
+                if self.abort:
+                    self.queue_condition.notify_all()
+            self._release_queue_slots([doc])
+
+        if failed:
+            self._on_failed(doc, done_callback)
+        elif end_write is not None:
+            # The event is only completed once its buffered end write has succeeded
+            end_write.add_done_callback(lambda write: self._on_end_write(write, doc, done_callback))
+        elif done_callback is not None:
+            done_callback()
+
+    def _on_end_write(self, end_write, doc, done_callback):
+        if end_write.error is not None:
+            self._on_failed(doc, done_callback)
+        elif done_callback is not None:
+            done_callback()
+
+    def _on_failed(self, doc, done_callback):
+        """
+        Called when the process could not be started or ended on a document, e.g. because of a failover. The event is
+        not completed but delivered again after a delay, so the resume token never gets past it.
+        :param doc: The change event
+        :param done_callback: The done_callback of the event
+        """
+        redeliveries = doc.get('redeliveries', 0)
+        delay = min(_MAX_REDELIVERY_DELAY, _REDELIVERY_DELAY * 2 ** redeliveries)
+
+        doc = dict(doc)
+        doc['redeliveries'] = redeliveries + 1
+
+        with self.retry_condition:
+            # Checked with the condition held, so the retry thread gives up every event scheduled before it exits
+            stopping = self.abort
+            if not stopping:
+                heapq.heappush(self.redeliveries, (time.time() + delay, next(self.retry_sequence), doc, done_callback))
+                self.retry_condition.notify()
+
+        if stopping:
+            self._abandon_events([(doc, done_callback)])
+        else:
+            self.logger.warning('Delivering document {} to worker "{}" again in {} second(s)'
+                                .format(_get_document_id(doc), self.name, delay))
+
+    def set_backfill(self, query, running):
+        """
+        Called by a Backfill when it starts and ends.
+        :param query: The query of the backfill
+        :param running: True when the backfill starts, False when it has ended
+        """
+        self.backfill_end = None if running else time.time()
+        self.backfill_query = query
+
+    def _get_start_query(self, doc):
+        start_query = doc.get('startQuery')
+        if start_query is not None or self.backfill_query is None:
+            return start_query
+
+        # Events from before the backfill ended may be about documents the backfill has processed already
+        backfill_end = self.backfill_end
+        cluster_time = doc.get('clusterTime')
+        if backfill_end is None or (cluster_time is not None and cluster_time.time <= backfill_end):
+            return self.backfill_query
+
+        return None
+
     def _run_process_thread(self, doc):
+        """
+        Process the document of a change event.
+        :param doc: The change event
+        :return: The PendingWrite of the end_process write if the process ran with the write buffer enabled, None
+        otherwise
+        """
         document = doc['fullDocument']
-        is_running = False
-
-        if self.name in document:
-            is_running = document[self.name]['isRunning']
 
-        if not is_running:
-            self._execute_process(document)
+        if not self._is_running(document):
+            end_write = self._execute_process(document, self._get_start_query(doc))
+            if end_write is not False:
+                self._observe_end_to_end_lag(doc, end_write)
+                return end_write
         else:
             self.logger.error('Process "{}" is already running'.format(self.name))
+            self._on_already_running(document)
+
+        return None
+
+    def _on_already_running(self, document):
+        """
+        Called when the process does not run on a document because it is already running or claimed elsewhere.
+        :param document: The document
+        """
+        pass
+
+    def _is_running(self, document):
+        # In claim mode the running state is checked atomically by claim_process
+        if not self.claim and self.name in document:
+            return document[self.name]['isRunning']
 
-        self.mongo_repository.save_resume_token(doc)
+        return False
+
+    def _execute_process(self, document, start_query=None):
+        """
+        Acknowledge and process a document.
+        :param document: The document
+        :param start_query: See submit_document
+        :return: False if the process did not run, otherwise the result of the end_process write
+        """
+        metrics = self.metrics
+        labels = self.metric_labels
+
+        if not self._acknowledge(document):
+            return False
+
+        started = time.time()
+        if start_query is not None:
+            owner = self.owner if self.claim else None
+            matched = self.mongo_repository.start_process_if(document['_id'], self.name, start_query, owner,
+                                                             self.lease_time)
+            metrics.observe('start_write_seconds', labels, time.time() - started)
+            if not matched:
+                self.logger.debug('Document {} does not need process "{}" anymore'.format(document['_id'], self.name))
+                metrics.increment('events_skipped_total', labels)
+                return False
+        elif self.claim:
+            claimed = self.mongo_repository.claim_process(document['_id'], self.name, self.owner, self.lease_time)
+            metrics.observe('start_write_seconds', labels, time.time() - started)
+            if not claimed:
+                self.logger.debug('Process "{}" has already been claimed for document {}'
+                                  .format(self.name, document['_id']))
+                metrics.increment('events_skipped_total', labels)
+                self._on_already_running(document)
+                return False
+        else:
+            self.mongo_repository.start_process(document["_id"], self.name)
+            metrics.observe('start_write_seconds', labels, time.time() - started)
 
-    def _execute_process(self, document):
+        self._add_started([document['_id']])
+        try:
+            success, results, error = self._process(document)
+
+            followers = []
+            if not self.claim:
+                # A claim only covers this process, so claimed documents are not fused
+                followers = self.mongo_repository.local_scheduler.run_followers(self, document, success, results)
+
+            started = time.time()
+            if self.claim:
+                end_write = self.mongo_repository.release_process(document['_id'], self.name, self.owner, success,
+                                                                  results)
+            elif len(followers) > 0:
+                end_write = self.mongo_repository.end_process_with_followers(document['_id'], self.name, success,
+                                                                             results, followers)
+            else:
+                end_write = self.mongo_repository.end_process(document['_id'], self.name, success, results)
+            metrics.observe('end_write_seconds', labels, time.time() - started)
+        finally:
+            self._remove_started([document['_id']])
+
+        self._handle_outcome(document['_id'], success, results, error)
+        return end_write
+
+    def _run_fused(self, document):
+        """
+        Run the process inline on a document that an upstream worker of this process has just finished
+        (see LocalScheduler). Nothing is written, the caller merges the outcome into its own end_process write.
+        :param document: The document including the results of the upstream worker
+        :return: A tuple (success, results) or None if the process did not run
+        """
+        if self.abort or self._is_running(document) or not self._acknowledge(document):
+            return None
+
+        self.metrics.increment('events_fused_total', self.metric_labels)
+        success, results, error = self._process(document)
+        self._handle_outcome(document['_id'], success, results, error)
+
+        return success, results
+
+    def _acknowledge(self, document):
         required = False
 
+        started = time.time()
         try:
             required = self.acknowledge_callback(document)
         except:
             self.logger.exception('An error occurred while trying to process data')
+        self.metrics.observe('acknowledge_seconds', self.metric_labels, time.time() - started)
 
-        if required:
-            self.mongo_repository.start_process(document["_id"], self.name)
+        self.metrics.increment('events_acknowledged_total' if required else 'events_skipped_total', self.metric_labels)
+        return required
 
-            success = False
-            results = {}
+    def _process(self, document):
+        success = False
+        results = {}
+        error = None
 
-            try:
-                success, results = self.process_callback(document)
-            except:
-                self.logger.exception('An error occurred while trying to process data')
+        rate_limiter = self.rate_limiter
+        if rate_limiter is not None and self.scheduler is None:
+            self.metrics.observe('rate_limit_wait_seconds', self.metric_labels, rate_limiter.acquire())
+
+        started = time.time()
+        try:
+            success, results = self._call_process_callback(document)
+        except:
+            self.logger.exception('An error occurred while trying to process data')
+            error = traceback.format_exc()
+        duration = time.time() - started
+        self.metrics.observe('process_seconds', self.metric_labels, duration)
+
+        if self.concurrency_limiter is not None:
+            limit = self.concurrency_limiter.record(duration, success, self.in_flight)
+            if limit is not None:
+                self._resize(limit)
+
+        self.metrics.increment('events_succeeded_total' if success else 'events_failed_total', self.metric_labels)
+        return success, results, error
+
+    def _handle_outcome(self, doc_id, success, results, error):
+        """
+        Schedule a retry of a failed process or record a dead letter once the retry policy is exhausted.
+        """
+        if self.retry_policy is None:
+            return
+
+        with self.retry_condition:
+            if success:
+                self.retry_attempts.pop(doc_id, None)
+                return
+            if doc_id in self.retry_scheduled:
+                # The document failed again before its scheduled retry
+                return
+
+            attempts = self.retry_attempts.get(doc_id, 0) + 1
+            if self.retry_policy.should_retry(attempts):
+                self.retry_attempts[doc_id] = attempts
+                self.retry_scheduled.add(doc_id)
+                due = time.time() + self.retry_policy.get_delay(attempts)
+                heapq.heappush(self.retry_schedule, (due, next(self.retry_sequence), doc_id))
+                self.metrics.set_gauge('retries_scheduled', self.metric_labels, len(self.retry_scheduled))
+                self.retry_condition.notify()
+                return
+
+            self.retry_attempts.pop(doc_id, None)
+
+        self.logger.warning('Process "{}" failed {} time(s) on document {}, giving up'
+                            .format(self.name, attempts, doc_id))
+        self.metrics.increment('events_dead_lettered_total', self.metric_labels)
+        try:
+            self.mongo_repository.dead_letter(doc_id, self.name, attempts, error, results)
+        except:
+            self.logger.exception('Unable to record dead letter of document {}'.format(doc_id))
+
+    def _run_retry_thread(self):
+        while not self.abort:
+            with self.retry_condition:
+                doc_ids, redeliveries = self._wait_for_retries()
+
+            for _, _, doc, done_callback in redeliveries:
+                if not self.submit(doc, done_callback):
+                    self._abandon_events([(doc, done_callback)])
+
+            if len(doc_ids) > 0:
+                try:
+                    self._retry(doc_ids)
+                except:
+                    self.logger.exception('An error occurred while trying to retry data')
+
+        with self.retry_condition:
+            redeliveries = self.redeliveries
+            self.redeliveries = []
+        self._abandon_events([(doc, done_callback) for _, _, doc, done_callback in redeliveries])
+
+    def _wait_for_retries(self):
+        # Returns the IDs of all documents whose retry is due and all due redeliveries, must be called with the retry
+        # condition held
+        while not self.abort:
+            now = time.time()
+
+            redeliveries = []
+            while len(self.redeliveries) > 0 and self.redeliveries[0][0] <= now:
+                redeliveries.append(heapq.heappop(self.redeliveries))
+
+            doc_ids = []
+            while len(self.retry_schedule) > 0 and self.retry_schedule[0][0] <= now:
+                doc_id = heapq.heappop(self.retry_schedule)[2]
+                self.retry_scheduled.discard(doc_id)
+                doc_ids.append(doc_id)
+
+            if len(doc_ids) > 0:
+                self.metrics.set_gauge('retries_scheduled', self.metric_labels, len(self.retry_scheduled))
+            if len(doc_ids) > 0 or len(redeliveries) > 0:
+                return doc_ids, redeliveries
+
+            due = [schedule[0][0] for schedule in (self.retry_schedule, self.redeliveries) if len(schedule) > 0]
+            self.retry_condition.wait(min(due) - now if len(due) > 0 else None)
+
+        return [], []
+
+    def _retry(self, doc_ids):
+        """
+        Reload the documents of due retries with a single query and queue them again.
+        """
+        documents = self.mongo_repository.coll.find({'_id': {'$in': doc_ids}}, self.get_document_projection())
+        found = set()
+
+        for document in documents:
+            found.add(document['_id'])
+
+            state = document.get(self.name)
+            if isinstance(state, dict) and state.get('success'):
+                # Another event has processed the document successfully in the meantime
+                self._handle_outcome(document['_id'], True, None, None)
+                continue
+
+            self.metrics.increment('events_retried_total', self.metric_labels)
+            if not self.submit_document(document, 'retry'):
+                return
+
+        with self.retry_condition:
+            for doc_id in doc_ids:
+                if doc_id not in found:
+                    self.retry_attempts.pop(doc_id, None)
+
+    def _observe_end_to_end_lag(self, doc, end_write=None):
+        if not self.metrics.enabled or doc.get('clusterTime') is None:
+            return
+
+        if end_write is None:
+            self.metrics.observe('end_to_end_lag_seconds', self.metric_labels, _get_event_age(doc))
+        else:
+            # Buffered writes reach the database later
+            end_write.add_done_callback(lambda _: self.metrics.observe('end_to_end_lag_seconds', self.metric_labels,
+                                                                       _get_event_age(doc)))
+
+    def _call_process_callback(self, document):
+        if self.executor is None:
+            return self.process_callback(document)
 
-            self.mongo_repository.end_process(document['_id'], self.name, success, results)
+        future = self.executor.submit(call_process_callback, self.process_callback, encode_document(document))
+        return future.result()
@@ -0,0 +1,178 @@
+import logging
+from threading import Event, Lock, Thread
+
+from pymongo.errors import BulkWriteError, WriteError
+
+
+class PendingWrite(object):
+    def __init__(self, doc_id, operation):
+        """
+        Result of a write that has been queued in a WriteBuffer.
+        :param doc_id: The ID of the document affected by the write
+        :param operation: The queued pymongo write operation
+        """
+        self.doc_id = doc_id
+        self.operation = operation
+        self.error = None
+        self._done = Event()
+        self._callbacks = []
+        self._lock = Lock()
+
+    def done(self):
+        """
+        :return: True if the write has been sent to the database
+        """
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Wait for the write to be sent to the database.
+        :param timeout: Maximum time to wait in seconds (None to wait forever)
+        :return: True if the write succeeded, False if the timeout expired
+        :raise: The error that occurred while writing (WriteError for errors of this particular operation)
+        """
+        if not self._done.wait(timeout):
+            return False
+
+        if self.error is not None:
+            raise self.error
+
+        return True
+
+    def add_done_callback(self, callback):
+        """
+        Register a function that is called with this PendingWrite once the write has been sent to the database.
+        :param callback: A function taking the PendingWrite as its only parameter
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+
+        callback(self)
+
+    def _set_done(self, error=None):
+        with self._lock:
+            self.error = error
+            self._done.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+
+        for callback in callbacks:
+            try:
+                callback(self)
+            except:
+                logging.exception('Error in callback of pending write')
+
+
+class WriteBuffer(object):
+    def __init__(self, coll, logger, batch_size=500, flush_interval=0.5):
+        """
+        Write-behind buffer that collects single document writes and sends them as unordered bulk writes.
+        Writes to the same document are never part of the same bulk write, so they are applied in the order in which
+        they were added.
+        :param coll: The pymongo collection to write to
+        :param logger: Logger used to report failed writes
+        :param batch_size: Flush as soon as this many writes are pending
+        :param flush_interval: Flush pending writes at least every flush_interval seconds
+        """
+        self.coll = coll
+        self.logger = logger
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.pending = []
+        self.lock = Lock()
+        self.flush_lock = Lock()
+
+        self.abort = False
+        self.flush_event = Event()
+        self.task = Thread(target=self._run_flush_thread)
+        self.task.daemon = True
+        self.task.start()
+
+    def add(self, doc_id, operation):
+        """
+        Queue a write operation.
+        :param doc_id: The ID of the document affected by the write
+        :param operation: A pymongo write operation (e.g. UpdateOne)
+        :return: A PendingWrite that reports the outcome of the operation
+        """
+        pending_write = PendingWrite(doc_id, operation)
+
+        with self.lock:
+            self.pending.append(pending_write)
+            full = len(self.pending) >= self.batch_size
+
+        if full:
+            self.flush_event.set()
+
+        return pending_write
+
+    def __len__(self):
+        return len(self.pending)
+
+    def flush(self):
+        """
+        Send all pending writes to the database and wait until they have been acknowledged.
+        """
+        with self.flush_lock:
+            with self.lock:
+                pending = self.pending
+                self.pending = []
+
+            for batch in self._split_batches(pending):
+                self._write_batch(batch)
+
+    def stop(self):
+        """
+        Stop the background flushing and flush all pending writes.
+        """
+        self.abort = True
+        self.flush_event.set()
+        self.task.join()
+        self.flush()
+
+    def _run_flush_thread(self):
+        while not self.abort:
+            self.flush_event.wait(self.flush_interval)
+            self.flush_event.clear()
+
+            try:
+                self.flush()
+            except:
+                self.logger.exception('Unable to flush write buffer')
+
+    def _split_batches(self, pending):
+        batches = []
+        write_counts = {}
+
+        for pending_write in pending:
+            index = write_counts.get(pending_write.doc_id, 0)
+            write_counts[pending_write.doc_id] = index + 1
+
+            if index == len(batches):
+                batches.append([])
+            batches[index].append(pending_write)
+
+        return batches
+
+    def _write_batch(self, batch):
+        errors = {}
+
+        try:
+            self.coll.bulk_write([pending_write.operation for pending_write in batch], ordered=False)
+        except BulkWriteError as e:
+            for write_error in e.details.get('writeErrors', []):
+                errors[write_error['index']] = WriteError(write_error.get('errmsg'), write_error.get('code'),
+                                                          write_error)
+        except Exception as e:
+            self.logger.exception('Bulk write of {} operations failed'.format(len(batch)))
+            for index in range(len(batch)):
+                errors[index] = e
+
+        for index, pending_write in enumerate(batch):
+            error = errors.get(index)
+            if error is not None:
+                self.logger.error('Buffered write {} failed: {}'.format(pending_write.operation, error))
+            pending_write._set_done(error)
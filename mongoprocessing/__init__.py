@@ -1,3 +1,15 @@
-from MongoRepository import MongoRepository
-from MongoWatch import MongoWatch
-from dependencies import *
+from .MemoryMongoRepository import MemoryMongoRepository
+from .MongoRepository import MongoRepository
+from .MongoWatch import MongoWatch
+from .RetryPolicy import RetryPolicy
+from .checkpoints import CollectionCheckpointStore, FileCheckpointStore, MemoryCheckpointStore
+from .concurrency import AIMDLimiter, SharedScheduler, TokenBucket
+from .dependencies import *
+from .metrics import Metrics
+
+try:
+    from .AsyncMongoRepository import AsyncMongoRepository
+    from .AsyncMongoWatch import AsyncMongoWatch
+except SyntaxError:
+    # The asyncio flavour requires Python 3.5+
+    pass
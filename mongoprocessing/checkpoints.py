@@ -0,0 +1,220 @@
+import datetime
+import os
+import tempfile
+from threading import Event, Lock, Thread
+
+from bson import BSON
+from bson.raw_bson import RawBSONDocument
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+class FileCheckpointStore(object):
+    def __init__(self, path):
+        """
+        Stores resume tokens in files. Every stream gets its own file next to the given path, e.g. "resume_token.bin"
+        becomes "resume_token.one_insert.bin" for the stream "one_insert".
+        :param path: Base file path of the resume token files
+        """
+        self.path = path
+
+    def get_path(self, key):
+        root, ext = os.path.splitext(self.path)
+        return '{}.{}{}'.format(root, key, ext)
+
+    def load(self, key):
+        """
+        Load the resume token of a stream.
+        :param key: The key of the stream
+        :return: The resume token or None if no token has been saved
+        """
+        path = self.get_path(key)
+        if not os.path.exists(path):
+            return None
+
+        with open(path, 'rb') as token_file:
+            return pickle.load(token_file)
+
+    def save(self, key, resume_token):
+        """
+        Atomically replace the resume token of a stream.
+        :param key: The key of the stream
+        :param resume_token: The resume token
+        """
+        path = self.get_path(key)
+        directory = os.path.dirname(os.path.abspath(path))
+
+        handle, temp_path = tempfile.mkstemp(dir=directory, prefix='.resume_token')
+        try:
+            with os.fdopen(handle, 'wb') as token_file:
+                pickle.dump(resume_token, token_file)
+                token_file.flush()
+                os.fsync(token_file.fileno())
+            os.rename(temp_path, path)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+class CollectionCheckpointStore(object):
+    def __init__(self, collection):
+        """
+        Stores resume tokens in a MongoDB collection, one document per stream.
+        :param collection: A pymongo collection
+        """
+        self.collection = collection
+
+    def load(self, key):
+        """
+        Load the resume token of a stream.
+        :param key: The key of the stream
+        :return: The resume token or None if no token has been saved
+        """
+        doc = self.collection.find_one({'_id': key})
+        if doc is None:
+            return None
+
+        return doc.get('resumeToken')
+
+    def save(self, key, resume_token):
+        """
+        Replace the resume token of a stream.
+        :param key: The key of the stream
+        :param resume_token: The resume token
+        """
+        self.collection.update_one({'_id': key},
+                                   {'$set': {'resumeToken': resume_token, 'updatedAt': datetime.datetime.utcnow()}},
+                                   upsert=True)
+
+
+class MemoryCheckpointStore(object):
+    def __init__(self):
+        """
+        Keeps resume tokens in memory, e.g. for tests and benchmarks. Tokens are lost when the process exits.
+        """
+        self.tokens = {}
+
+    def load(self, key):
+        return self.tokens.get(key)
+
+    def save(self, key, resume_token):
+        self.tokens[key] = resume_token
+
+
+class Checkpointer(object):
+    def __init__(self, store, key, logger, interval=5):
+        """
+        Tracks the events of one change stream and periodically persists the resume token of the newest event for
+        which all previous events have been completed (the low-water mark). Events may complete in any order.
+        :param store: A checkpoint store like FileCheckpointStore or CollectionCheckpointStore
+        :param key: The key of the stream
+        :param logger: Logger used to report errors
+        :param interval: Save the low-water mark every interval seconds (if it changed)
+        """
+        self.store = store
+        self.key = key
+        self.logger = logger
+        self.interval = interval
+
+        self.lock = Lock()
+        self.tokens = {}
+        self.completed_positions = set()
+        self.next_position = 0
+        self.low_water_mark = -1
+
+        self.resume_token = None
+        self.saved_token = None
+
+        self.stop_event = Event()
+        self.task = None
+
+    def load(self):
+        """
+        Load the saved resume token of the stream.
+        :return: The resume token or None if no token has been saved or it could not be loaded
+        """
+        try:
+            return self.store.load(self.key)
+        except:
+            self.logger.exception('Unable to load resume token for stream "{}"'.format(self.key))
+            return None
+
+    def received(self, resume_token):
+        """
+        Register a new event of the stream. Must be called in stream order.
+        :param resume_token: The resume token of the event (its "_id")
+        :return: The position of the event that has to be passed to completed()
+        """
+        with self.lock:
+            position = self.next_position
+            self.next_position += 1
+            self.tokens[position] = resume_token
+
+        return position
+
+    def completed(self, position):
+        """
+        Mark an event as completed.
+        :param position: The position returned by received()
+        """
+        with self.lock:
+            self.completed_positions.add(position)
+
+            while self.low_water_mark + 1 in self.completed_positions:
+                self.low_water_mark += 1
+                self.completed_positions.remove(self.low_water_mark)
+                self.resume_token = self.tokens.pop(self.low_water_mark)
+
+    @property
+    def pending(self):
+        """
+        :return: The number of received events that are not covered by the low-water mark yet
+        """
+        return self.next_position - self.low_water_mark - 1
+
+    def start(self):
+        """
+        Start saving the low-water mark in the background.
+        """
+        if self.task is None:
+            self.stop_event = Event()
+            self.task = Thread(target=self._run_save_thread)
+            self.task.daemon = True
+            self.task.start()
+
+    def stop(self):
+        """
+        Stop the background saving and save the current low-water mark.
+        """
+        self.stop_event.set()
+        if self.task is not None:
+            self.task.join()
+            self.task = None
+
+        self.save()
+
+    def save(self):
+        """
+        Save the current low-water mark if it changed since the last save.
+        """
+        resume_token = self.resume_token
+        if resume_token is None or resume_token == self.saved_token:
+            return
+
+        try:
+            if isinstance(resume_token, RawBSONDocument):
+                # Tokens of raw streams are stored like all others
+                self.store.save(self.key, BSON(resume_token.raw).decode())
+            else:
+                self.store.save(self.key, resume_token)
+            self.saved_token = resume_token
+        except:
+            self.logger.exception('Unable to save resume token for stream "{}"'.format(self.key))
+
+    def _run_save_thread(self):
+        while not self.stop_event.wait(self.interval):
+            self.save()
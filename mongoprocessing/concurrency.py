@@ -0,0 +1,543 @@
+import logging
+import time
+from collections import deque
+from threading import Condition, Lock, Thread
+
+
+class WorkerPool(object):
+    def __init__(self, num_threads):
+        """
+        A thread pool that can be resized while it is running. Unlike multiprocessing's ThreadPool, threads are only
+        started when they are needed and surplus threads exit after their current task when the pool shrinks.
+        :param num_threads: Number of threads
+        """
+        self.condition = Condition()
+        self.tasks = deque()
+        self.size = 0
+        self.num_workers = 0
+        self.idle_workers = 0
+        self.closed = False
+        self.threads = []
+
+        self.resize(num_threads)
+
+    def apply_async(self, func, args=()):
+        """
+        Run a function in one of the threads.
+        :param func: The function
+        :param args: The positional arguments of the function
+        """
+        with self.condition:
+            if self.closed:
+                raise Exception('The pool has been closed')
+
+            self.tasks.append((func, args))
+            if self.idle_workers > 0:
+                self.condition.notify()
+            if len(self.tasks) > self.idle_workers and self.num_workers < self.size:
+                self._start_worker()
+
+    def resize(self, num_threads):
+        """
+        Change the number of threads. Additional threads are started as soon as there are tasks for them.
+        :param num_threads: The new number of threads (at least 1)
+        """
+        with self.condition:
+            self.size = max(1, int(num_threads))
+
+            while self.num_workers < self.size and len(self.tasks) > self.idle_workers:
+                self._start_worker()
+
+            # Surplus idle threads exit when they wake up
+            self.condition.notify_all()
+
+    def close(self):
+        """
+        Do not accept new tasks. Queued tasks are still run.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def terminate(self):
+        """
+        Do not accept new tasks and discard all queued tasks. Running tasks are not interrupted.
+        """
+        with self.condition:
+            self.closed = True
+            self.tasks.clear()
+            self.condition.notify_all()
+
+    def join(self):
+        """
+        Wait until all threads have exited. Call close or terminate first.
+        """
+        for thread in list(self.threads):
+            thread.join()
+
+    def _start_worker(self):
+        self.num_workers += 1
+        thread = Thread(target=self._run_worker_thread)
+        thread.daemon = True
+        self.threads = [existing for existing in self.threads if existing.is_alive()] + [thread]
+        thread.start()
+
+    def _run_worker_thread(self):
+        while True:
+            with self.condition:
+                while len(self.tasks) == 0 and not self.closed and self.num_workers <= self.size:
+                    self.idle_workers += 1
+                    self.condition.wait()
+                    self.idle_workers -= 1
+
+                if len(self.tasks) == 0 or self.num_workers > self.size:
+                    self.num_workers -= 1
+                    return
+
+                func, args = self.tasks.popleft()
+
+            try:
+                func(*args)
+            except:
+                logging.exception('Error in task of worker pool')
+
+
+class AIMDLimiter(object):
+    def __init__(self, initial_limit=5, min_limit=1, max_limit=50, latency_target=None, max_error_rate=0.1,
+                 backoff_ratio=0.9, window=20):
+        """
+        Adapts the number of concurrent process callbacks of a worker with additive increase, multiplicative decrease
+        (AIMD). After every window of calls the limit is multiplied by backoff_ratio if too many calls failed or their
+        mean latency exceeded the target, and raised by one if all threads were busy.
+        :param initial_limit: Concurrency at start
+        :param min_limit: Lower bound of the concurrency
+        :param max_limit: Upper bound of the concurrency
+        :param latency_target: Back off if the mean latency of a window exceeds this many seconds (None to only react
+        to errors)
+        :param max_error_rate: Back off if more than this fraction of the calls in a window failed
+        :param backoff_ratio: Factor by which the limit is reduced
+        :param window: Number of calls after which the limit is adjusted
+        """
+        self.initial_limit = initial_limit
+        self.limit = max(min_limit, min(max_limit, initial_limit))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.max_error_rate = max_error_rate
+        self.backoff_ratio = backoff_ratio
+        self.window = window
+
+        self.lock = Lock()
+        self.samples = 0
+        self.errors = 0
+        self.total_latency = 0
+        self.saturated = False
+
+    def copy(self):
+        """
+        Create a limiter with the same parameters that starts again from the initial limit, e.g. for another worker.
+        :return: A new AIMDLimiter
+        """
+        return AIMDLimiter(self.initial_limit, self.min_limit, self.max_limit, self.latency_target,
+                           self.max_error_rate, self.backoff_ratio, self.window)
+
+    def set_limit(self, limit):
+        """
+        Override the current limit, e.g. when resizing a worker manually.
+        :param limit: The new limit, bounded by min_limit and max_limit
+        :return: The applied limit
+        """
+        with self.lock:
+            self.limit = max(self.min_limit, min(self.max_limit, limit))
+            return self.limit
+
+    def record(self, latency, success, in_flight):
+        """
+        Record a finished call.
+        :param latency: Duration of the call in seconds
+        :param success: Whether the call succeeded
+        :param in_flight: Number of calls that were running, including this one
+        :return: The new limit if it changed, None otherwise
+        """
+        with self.lock:
+            self.samples += 1
+            self.total_latency += latency
+            if not success:
+                self.errors += 1
+            if in_flight >= self.limit:
+                self.saturated = True
+
+            if self.samples < self.window:
+                return None
+
+            error_rate = float(self.errors) / self.samples
+            mean_latency = self.total_latency / self.samples
+            saturated = self.saturated
+
+            self.samples = 0
+            self.errors = 0
+            self.total_latency = 0
+            self.saturated = False
+
+            if error_rate > self.max_error_rate or \
+                    (self.latency_target is not None and mean_latency > self.latency_target):
+                limit = max(self.min_limit, int(self.limit * self.backoff_ratio))
+            elif saturated:
+                limit = min(self.max_limit, self.limit + 1)
+            else:
+                return None
+
+            if limit == self.limit:
+                return None
+
+            self.limit = limit
+            return limit
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=None):
+        """
+        Limits the rate of process callbacks of a worker. Tokens are refilled continuously at the given rate and every
+        call takes one token, waiting if none is left.
+        :param rate: Number of calls per second
+        :param burst: Maximum number of tokens that can accumulate while the worker is idle (defaults to rate, at
+        least 1)
+        """
+        if rate <= 0:
+            raise Exception('The rate must be positive')
+
+        self.lock = Lock()
+        self.rate = float(rate)
+        self.burst = float(burst) if burst is not None else max(1.0, self.rate)
+        self.tokens = self.burst
+        self.updated = time.time()
+
+    def set_rate(self, rate, burst=None):
+        """
+        Change the rate while the worker is running.
+        :param rate: Number of calls per second
+        :param burst: See __init__
+        """
+        if rate <= 0:
+            raise Exception('The rate must be positive')
+
+        with self.lock:
+            self._refill()
+            self.rate = float(rate)
+            self.burst = float(burst) if burst is not None else max(1.0, self.rate)
+            self.tokens = min(self.tokens, self.burst)
+
+    def acquire(self, count=1):
+        """
+        Take tokens, waiting until enough tokens are available. Tokens are reserved immediately, so concurrent callers
+        are served in order.
+        :param count: Number of tokens
+        :return: Number of seconds waited
+        """
+        with self.lock:
+            self._refill()
+            self.tokens -= count
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if delay > 0:
+            time.sleep(delay)
+
+        return delay
+
+    def try_acquire(self, count=1):
+        """
+        Take tokens without waiting, e.g. before dispatching a task.
+        :param count: Number of tokens
+        :return: 0 if the tokens have been taken, otherwise the number of seconds until enough tokens are available
+        """
+        with self.lock:
+            self._refill()
+            # A burst below count would never be reached, the bucket goes into debt instead
+            needed = min(count, self.burst)
+            if self.tokens >= needed:
+                self.tokens -= count
+                return 0
+
+            return (needed - self.tokens) / self.rate
+
+    def take(self, count):
+        """
+        Take tokens without waiting. The bucket may go into debt, which delays the next acquire.
+        :param count: Number of tokens (a negative count returns tokens)
+        """
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.burst, self.tokens - count)
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class SharedScheduler(object):
+    def __init__(self, num_threads):
+        """
+        A thread pool shared by the workers of a process (see the scheduler parameter of MongoWatch.start_worker).
+        Every worker submits its tasks into its own queue. A free thread takes the next task from the queue with the
+        highest priority that has tasks, and queues with the same priority share the threads in proportion to their
+        weights (stride scheduling). Idle threads are therefore used by whichever worker has a backlog. Running tasks
+        are never interrupted, a task of a higher priority runs as soon as a thread becomes free.
+        :param num_threads: Number of threads
+        """
+        self.condition = Condition()
+        self.queues = []
+        self.pending = 0
+        self.size = 0
+        self.num_workers = 0
+        self.idle_workers = 0
+        self.closed = False
+        self.threads = []
+        # Stride scheduling: every queue advances its pass by 1 / weight per task and the lowest pass runs next
+        self.virtual_time = 0.0
+
+        self.resize(num_threads)
+
+    def create_queue(self, weight=1, priority=0, max_concurrency=None):
+        """
+        Create the queue of a worker. It has the same interface as WorkerPool.
+        :param weight: Share of the threads relative to the other queues with the same priority
+        :param priority: Queues with a higher priority are served first
+        :param max_concurrency: Maximum number of tasks of this queue that run at the same time (None for no limit)
+        :return: The queue
+        """
+        if weight <= 0:
+            raise Exception('The weight of a queue must be positive')
+
+        queue = ScheduledQueue(self, weight, priority, max_concurrency)
+        with self.condition:
+            queue.pass_value = self.virtual_time
+            self.queues.append(queue)
+
+        return queue
+
+    def resize(self, num_threads):
+        """
+        Change the number of threads. Additional threads are started as soon as there are tasks for them.
+        :param num_threads: The new number of threads (at least 1)
+        """
+        with self.condition:
+            self.size = max(1, int(num_threads))
+            self._start_workers()
+            self.condition.notify_all()
+
+    def close(self):
+        """
+        Stop all threads once every queue is empty.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def join(self):
+        """
+        Wait until all threads have exited. Call close first.
+        """
+        for thread in list(self.threads):
+            thread.join()
+
+    def get_queue_depths(self):
+        """
+        :return: A list with a (weight, priority, queued, running) tuple for every queue
+        """
+        with self.condition:
+            return [(queue.weight, queue.priority, len(queue.tasks), queue.running) for queue in self.queues]
+
+    def _submit(self, queue, func, args):
+        with self.condition:
+            if queue.closed:
+                raise Exception('The queue has been closed')
+
+            if len(queue.tasks) == 0 and queue.running == 0:
+                # A queue that has been idle does not get credit for the time it did not use
+                queue.pass_value = max(queue.pass_value, self.virtual_time)
+
+            queue.tasks.append((func, args))
+            self.pending += 1
+
+            if self.idle_workers > 0:
+                self.condition.notify()
+            self._start_workers()
+
+    def _start_workers(self):
+        while self.num_workers < self.size and self.pending > self.idle_workers:
+            self.num_workers += 1
+            thread = Thread(target=self._run_worker_thread)
+            thread.daemon = True
+            self.threads = [existing for existing in self.threads if existing.is_alive()] + [thread]
+            thread.start()
+
+    def _select_queue(self):
+        """
+        Select the queue whose next task runs now. Queues whose rate limit has no token left are passed over, so their
+        tasks wait in the queue instead of blocking a thread.
+        :return: A tuple (queue, delay) with the queue (None if no task can run now) and the number of seconds until
+        a task that is held back by a rate limit can run (None if no task is held back)
+        """
+        candidates = []
+
+        for queue in self.queues:
+            if len(queue.tasks) == 0:
+                continue
+            if queue.max_concurrency is not None and queue.running >= queue.max_concurrency:
+                continue
+
+            candidates.append(queue)
+
+        # Highest priority first, then the lowest pass (the sort is stable, so ties keep their order)
+        candidates.sort(key=lambda queue: (-queue.priority, queue.pass_value))
+
+        delay = None
+        for queue in candidates:
+            rate_limiter = queue.rate_limiter
+            if rate_limiter is not None:
+                wait = rate_limiter.try_acquire()
+                if wait > 0:
+                    delay = wait if delay is None else min(delay, wait)
+                    continue
+
+            return queue, delay
+
+        return None, delay
+
+    def _remove_queue(self, queue):
+        self.pending -= len(queue.tasks)
+        queue.tasks.clear()
+        if queue in self.queues:
+            self.queues.remove(queue)
+        self.condition.notify_all()
+
+    def _run_worker_thread(self):
+        while True:
+            with self.condition:
+                queue, delay = self._select_queue()
+                while queue is None and self.num_workers <= self.size and not (self.closed and self.pending == 0):
+                    self.idle_workers += 1
+                    self.condition.wait(delay)
+                    self.idle_workers -= 1
+                    queue, delay = self._select_queue()
+
+                if queue is None or self.num_workers > self.size:
+                    self.num_workers -= 1
+                    if self.pending > 0:
+                        self.condition.notify()
+                    return
+
+                func, args = queue.tasks.popleft()
+                self.pending -= 1
+                queue.running += 1
+                self.virtual_time = queue.pass_value
+                queue.pass_value += 1.0 / queue.weight
+
+            try:
+                func(*args)
+            except:
+                logging.exception('Error in task of shared scheduler')
+            finally:
+                with self.condition:
+                    queue.running -= 1
+                    if queue.closed and queue.running == 0 and len(queue.tasks) == 0:
+                        self._remove_queue(queue)
+                    elif queue.max_concurrency is not None or queue.closed:
+                        # A task of this queue may have been waiting for a free slot, or a join for the last task
+                        self.condition.notify_all()
+
+
+class ScheduledQueue(object):
+    def __init__(self, scheduler, weight, priority, max_concurrency):
+        """
+        The queue of a worker in a SharedScheduler. Create it with SharedScheduler.create_queue.
+        """
+        self.scheduler = scheduler
+        self.weight = weight
+        self.priority = priority
+        self.max_concurrency = max_concurrency
+        self.tasks = deque()
+        self.running = 0
+        self.closed = False
+        self.pass_value = 0.0
+        self.rate_limiter = None
+
+    @property
+    def size(self):
+        """
+        :return: The number of threads this queue may use at the same time
+        """
+        if self.max_concurrency is None:
+            return self.scheduler.size
+
+        return min(self.max_concurrency, self.scheduler.size)
+
+    def apply_async(self, func, args=()):
+        """
+        Run a function in one of the threads of the scheduler.
+        :param func: The function
+        :param args: The positional arguments of the function
+        """
+        self.scheduler._submit(self, func, args)
+
+    def resize(self, num_threads):
+        """
+        Change the maximum number of tasks of this queue that run at the same time.
+        :param num_threads: The new limit (at least 1)
+        """
+        with self.scheduler.condition:
+            self.max_concurrency = max(1, int(num_threads))
+            self.scheduler.condition.notify_all()
+
+    def set_weight(self, weight, priority=None):
+        """
+        Change the share of the threads while the worker is running.
+        :param weight: See SharedScheduler.create_queue
+        :param priority: See SharedScheduler.create_queue (None keeps the current priority)
+        """
+        if weight <= 0:
+            raise Exception('The weight of a queue must be positive')
+
+        with self.scheduler.condition:
+            self.weight = weight
+            if priority is not None:
+                self.priority = priority
+
+    def set_rate_limiter(self, rate_limiter):
+        """
+        Limit the rate at which the tasks of this queue start. Every task takes a token of the limiter before it is
+        dispatched and waits in the queue until one is available, so no thread of the scheduler waits for it.
+        :param rate_limiter: A TokenBucket (None removes the limit)
+        """
+        with self.scheduler.condition:
+            self.rate_limiter = rate_limiter
+            self.scheduler.condition.notify_all()
+
+    def close(self):
+        """
+        Do not accept new tasks. Queued tasks are still run.
+        """
+        with self.scheduler.condition:
+            self.closed = True
+            if self.running == 0 and len(self.tasks) == 0:
+                self.scheduler._remove_queue(self)
+
+    def terminate(self):
+        """
+        Do not accept new tasks and discard all queued tasks. Running tasks are not interrupted.
+        """
+        with self.scheduler.condition:
+            self.closed = True
+            self.scheduler.pending -= len(self.tasks)
+            self.tasks.clear()
+            if self.running == 0:
+                self.scheduler._remove_queue(self)
+
+    def join(self):
+        """
+        Wait until all tasks of this queue have finished. Call close or terminate first.
+        """
+        with self.scheduler.condition:
+            while self.running > 0 or len(self.tasks) > 0:
+                self.scheduler.condition.wait()
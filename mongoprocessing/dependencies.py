@@ -8,6 +8,12 @@ class OperationTypeDependency(object):
     def _add_match_condition(self, name, match, outer_and_list, or_filters, op_type):
         pass
 
+    def _add_query_condition(self, name, query, and_list, or_filters, op_type):
+        pass
+
+    def _get_fields(self, name):
+        return []
+
 class RequiredKeyDependency(object):
     def __init__(self, key, operation_types):
         self.key = key
@@ -16,6 +22,12 @@ class RequiredKeyDependency(object):
     def _add_match_condition(self, name, match, outer_and_list, or_filters, op_type):
         match['fullDocument.{}'.format(self.key)] = {'$exists': True}
 
+    def _add_query_condition(self, name, query, and_list, or_filters, op_type):
+        query[self.key] = {'$exists': True}
+
+    def _get_fields(self, name):
+        return [self.key]
+
 
 class KeyValueDependency(object):
     def __init__(self, key, value, operation_types):
@@ -26,6 +38,12 @@ class KeyValueDependency(object):
     def _add_match_condition(self, name, match, outer_and_list, or_filters, op_type):
         match['fullDocument.{}'.format(self.key)] = self.value
 
+    def _add_query_condition(self, name, query, and_list, or_filters, op_type):
+        query[self.key] = self.value
+
+    def _get_fields(self, name):
+        return [self.key]
+
 class ProcessDependency(object):
     def __init__(self, process_name, operation_types = ['update'], trigger_if_rerun=True, *required_results):
         """
@@ -86,19 +104,93 @@ class ProcessDependency(object):
             match['fullDocument.{}.{}'.format(self.process_name, result)] = {'$exists': True}
 
         if self.trigger_if_rerun:
-            or_filters.append({
-                '$expr': {
-                    '$and': [{
-                        '$gt': [
-                            '$fullDocument.{}.endTime'.format(self.process_name),
-                            '$fullDocument.{}.endTime'.format(name)
-                        ]}, {
-                        '$gt': [
-                            '$fullDocument.{}.startTime'.format(self.process_name),
-                            '$fullDocument.{}.startTime'.format(name)
-                        ]},
-                    ]}
-            })
+            or_filters.append(self._get_rerun_condition(name, '$fullDocument.'))
+
+    def _add_query_condition(self, name, query, and_list, or_filters, op_type):
+        query['{}.success'.format(self.process_name)] = True
+
+        for result in self.required_results:
+            query['{}.{}'.format(self.process_name, result)] = {'$exists': True}
+
+        if self.trigger_if_rerun:
+            or_filters.append(self._get_rerun_condition(name, '$'))
+
+    def _get_fields(self, name):
+        return [self.process_name]
+
+    def _get_rerun_condition(self, name, prefix):
+        return {
+            '$expr': {
+                '$and': [{
+                    '$gt': [
+                        '{}{}.endTime'.format(prefix, self.process_name),
+                        '{}{}.endTime'.format(prefix, name)
+                    ]}, {
+                    '$gt': [
+                        '{}{}.startTime'.format(prefix, self.process_name),
+                        '{}{}.startTime'.format(prefix, name)
+                    ]},
+                ]}
+        }
+
+
+class PartitionCondition(object):
+    def __init__(self, index, count, hashed=False):
+        """
+        Restricts a worker to one of count partitions of the documents, so count instances of the same worker can share
+        the load without coordination. ObjectIds are partitioned by their last byte (the low byte of their counter) and
+        numeric IDs by their value modulo count. Other IDs (e.g. strings) all belong to partition 0 unless hashed is
+        True.
+        :param index: The partition of this worker (0 <= index < count)
+        :param count: The total number of partitions
+        :param hashed: If True, other IDs are partitioned by their hash ($toHashedIndexKey). Requires MongoDB 7.0, older
+        servers reject the filter even if all IDs are ObjectIds or numbers.
+        """
+        if count < 1 or count > 256 or not 0 <= index < count:
+            raise Exception('Invalid partition {} of {}'.format(index, count))
+
+        self.index = index
+        self.count = count
+        self.hashed = hashed
+
+    @property
+    def key(self):
+        return 'p{}of{}'.format(self.index, self.count)
+
+    def _add_match_condition(self, name, match, outer_and_list, or_filters, op_type):
+        outer_and_list.append(self._get_condition('$documentKey._id'))
+
+    def _add_query_condition(self, name, query, and_list, or_filters, op_type):
+        and_list.append(self._get_condition('$_id'))
+
+    def _get_condition(self, field):
+        suffixes = ['{:02x}'.format(value) for value in range(256) if value % self.count == self.index]
+        # $mod keeps the sign of negative IDs and hashes, so their remainders are index - count
+        remainders = [self.index, self.index - self.count]
+        numeric = {'$in': [{'$type': field}, ['int', 'long', 'double', 'decimal']]}
+
+        if self.hashed:
+            other = {'$in': [
+                {'$mod': [{'$cond': [numeric, {'$toLong': field}, {'$toHashedIndexKey': field}]}, self.count]},
+                remainders
+            ]}
+        else:
+            # The server parses all branches of $cond, so $toHashedIndexKey must not appear at all
+            other = {'$cond': [
+                numeric,
+                {'$in': [{'$mod': [{'$toLong': field}, self.count]}, remainders]},
+                self.index == 0
+            ]}
+
+        return {
+            '$expr': {
+                '$cond': [
+                    {'$eq': [{'$type': field}, 'objectId']},
+                    {'$in': [{'$substrBytes': [{'$toString': field}, 22, 2]}, suffixes]},
+                    other
+                ]
+            }
+        }
 
 
 class MultipleDependency(object):
@@ -119,5 +211,13 @@ class MultipleDependency(object):
             if op_type in dependency.operation_types:
                 dependency._add_match_condition(name, match, outer_and_list, or_filters, op_type)
 
+    def _add_query_condition(self, name, query, and_list, or_filters, op_type):
+        for dependency in self._children:
+            if op_type in dependency.operation_types:
+                dependency._add_query_condition(name, query, and_list, or_filters, op_type)
+
+    def _get_fields(self, name):
+        return [field for dependency in self._children for field in dependency._get_fields(name)]
+
     def __len__(self):
         return len(self._children)
\ No newline at end of file
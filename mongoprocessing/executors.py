@@ -0,0 +1,88 @@
+import copy
+from multiprocessing import Pool
+
+from bson import BSON
+
+
+def encode_document(document):
+    """
+    Encode a document as raw BSON so it can be shipped to another process without pickling a dict.
+    :param document: The document (a dict or a RawBSONDocument)
+    :return: The BSON bytes of the document
+    """
+    raw = getattr(document, 'raw', None)
+    if raw is not None:
+        return raw
+
+    return BSON.encode(document)
+
+
+def decode_document(document):
+    """
+    Get a mutable copy of a document, decoding it completely if it is a RawBSONDocument.
+    :param document: The document (a dict or a RawBSONDocument)
+    :return: The copy as a dict
+    """
+    raw = getattr(document, 'raw', None)
+    if raw is not None:
+        return BSON(raw).decode()
+
+    return copy.deepcopy(document)
+
+
+def call_process_callback(process_callback, data):
+    """
+    Decode a raw BSON document and pass it to a process callback. Runs in the executor.
+    :param process_callback: The process callback (must be picklable for process executors)
+    :param data: The BSON bytes of the document
+    :return: The return value of the process callback
+    """
+    return process_callback(BSON(data).decode())
+
+
+def call_batch_callback(process_batch_callback, data):
+    """
+    Decode a list of raw BSON documents and pass them to a batch callback. Runs in the executor.
+    :param process_batch_callback: The batch callback (must be picklable for process executors)
+    :param data: A list with the BSON bytes of every document
+    :return: The return value of the batch callback
+    """
+    return process_batch_callback([BSON(document).decode() for document in data])
+
+
+class _AsyncResultFuture(object):
+    def __init__(self, async_result):
+        self.async_result = async_result
+
+    def result(self, timeout=None):
+        return self.async_result.get(timeout)
+
+
+class ProcessExecutor(object):
+    def __init__(self, processes=None):
+        """
+        Runs process callbacks in a pool of worker processes so CPU-bound callbacks are not serialized by the GIL.
+        Any object with the same submit(fn, *args) method (e.g. a concurrent.futures executor) can be used instead.
+        :param processes: Number of worker processes (defaults to the number of CPUs)
+        """
+        self.pool = Pool(processes)
+
+    def submit(self, fn, *args):
+        """
+        Schedule a function call in a worker process.
+        :param fn: A picklable function
+        :param args: Picklable arguments
+        :return: A future-like object whose result() method waits for the return value
+        """
+        return _AsyncResultFuture(self.pool.apply_async(fn, args))
+
+    def shutdown(self, wait=True):
+        """
+        Stop all worker processes.
+        :param wait: Whether to wait for running calls to complete
+        """
+        if wait:
+            self.pool.close()
+        else:
+            self.pool.terminate()
+        self.pool.join()
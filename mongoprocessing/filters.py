@@ -0,0 +1,140 @@
+"""
+Compiles the change stream filters built by MongoWatch into an equivalent, cheaper form: nested $and conditions are
+flattened, duplicates are removed and cheap equality predicates are evaluated before $expr conditions. Conditions
+with $expr can optionally be split off and evaluated on the client with the matching module.
+"""
+
+_COST_EQUALITY = 0
+_COST_FIELD = 1
+_COST_LOGICAL = 2
+_COST_EXPRESSION = 3
+
+
+def compile_filter(query):
+    """
+    Compile a query into an equivalent one that the server can evaluate faster.
+    :param query: A query document
+    :return: A query that matches exactly the same documents
+    """
+    conditions = _compile_conditions(query)
+    if conditions is None:
+        return {}
+
+    return _combine(conditions)
+
+
+def split_filter(query):
+    """
+    Split a query into a part without $expr conditions for the server and the $expr conditions for the client.
+    Events matching both parts are exactly the events matching the query.
+    :param query: A query document
+    :return: A tuple (server_query, client_query), client_query is None if there are no $expr conditions
+    """
+    conditions = _compile_conditions(query)
+    if conditions is None:
+        return {}, None
+
+    server_conditions = [condition for condition in conditions if not contains_expression(condition)]
+    client_conditions = [condition for condition in conditions if contains_expression(condition)]
+
+    client_query = _combine(client_conditions) if len(client_conditions) > 0 else None
+    return _combine(server_conditions), client_query
+
+
+def contains_expression(query):
+    """
+    :return: True if the query contains an $expr condition at any level
+    """
+    if isinstance(query, dict):
+        return any(key == '$expr' or contains_expression(value) for key, value in query.items())
+    if isinstance(query, list):
+        return any(contains_expression(value) for value in query)
+
+    return False
+
+
+def _combine(conditions):
+    if len(conditions) == 0:
+        return {}
+    if len(conditions) == 1:
+        return conditions[0]
+
+    return {'$and': conditions}
+
+
+def _compile_conditions(query):
+    # Returns a sorted list of conditions that must all be met, or None if the query matches everything
+    conditions = []
+    seen = set()
+
+    for condition in _flatten(query):
+        key = _get_canonical_key(condition)
+        if key not in seen:
+            seen.add(key)
+            conditions.append(condition)
+
+    conditions.sort(key=_get_cost)
+    return conditions if len(conditions) > 0 else None
+
+
+def _flatten(query):
+    conditions = []
+
+    for key, value in query.items():
+        if key == '$and':
+            for sub_query in value:
+                conditions.extend(_flatten(sub_query))
+        elif key == '$or':
+            alternatives = []
+            seen = set()
+
+            for sub_query in value:
+                alternative = _compile_conditions(sub_query)
+                if alternative is None:
+                    # An empty alternative matches everything, so the whole $or does
+                    alternatives = None
+                    break
+
+                alternative = _combine(alternative)
+                alternative_key = _get_canonical_key(alternative)
+                if alternative_key not in seen:
+                    seen.add(alternative_key)
+                    alternatives.append(alternative)
+
+            if alternatives is None:
+                continue
+            if len(alternatives) == 1:
+                conditions.extend(_flatten(alternatives[0]))
+            else:
+                # The server stops at the first matching alternative
+                alternatives.sort(key=_get_cost)
+                conditions.append({'$or': alternatives})
+        else:
+            conditions.append({key: value})
+
+    return conditions
+
+
+def _get_cost(condition):
+    if contains_expression(condition):
+        return _COST_EXPRESSION
+
+    key, value = list(condition.items())[0]
+    if key.startswith('$'):
+        return _COST_LOGICAL
+
+    if isinstance(value, dict) and any(operator.startswith('$') for operator in value):
+        if set(value.keys()) <= set(['$eq', '$exists']):
+            return _COST_EQUALITY
+        return _COST_FIELD
+
+    return _COST_EQUALITY
+
+
+def _get_canonical_key(value):
+    if isinstance(value, dict):
+        return ('dict', tuple(sorted((key, _get_canonical_key(item)) for key, item in value.items())))
+    if isinstance(value, list):
+        return ('list', tuple(_get_canonical_key(item) for item in value))
+
+    return (type(value).__name__, repr(value))
@@ -0,0 +1,524 @@
+# -*- coding: utf-8 -*-
+"""
+Client-side evaluation of the subset of the MongoDB query and aggregation expression language that MongoProcessing
+uses to build change stream filters.
+"""
+import calendar
+import datetime
+import hashlib
+import math
+import re
+import struct
+
+from bson.objectid import ObjectId
+from bson.timestamp import Timestamp
+
+try:
+    string_types = (str, unicode)
+except NameError:
+    string_types = (str,)
+
+try:
+    integer_types = (int, long)
+except NameError:
+    integer_types = (int,)
+
+
+class _Missing(object):
+    def __repr__(self):
+        return 'MISSING'
+
+
+MISSING = _Missing()
+
+
+def matches(query, document):
+    """
+    Check whether a document is matched by a query in the same way a MongoDB $match stage would.
+    :param query: A query document, e.g. as built by MongoWatch._get_filter
+    :param document: The document to test, e.g. a change stream event
+    :return: True if the document matches the query, False otherwise
+    """
+    for key, condition in query.items():
+        if key == '$and':
+            if not all(matches(sub_query, document) for sub_query in condition):
+                return False
+        elif key == '$or':
+            if not any(matches(sub_query, document) for sub_query in condition):
+                return False
+        elif key == '$nor':
+            if any(matches(sub_query, document) for sub_query in condition):
+                return False
+        elif key == '$expr':
+            if not _truthy(evaluate(condition, document)):
+                return False
+        elif not _match_field(get_values(document, key), condition):
+            return False
+
+    return True
+
+
+def get_values(document, path):
+    """
+    Resolve a dotted path in a document. Arrays along the path are traversed element-wise.
+    :param document: The document
+    :param path: A dotted path like "fullDocument.one.success"
+    :return: A list of all values found at the path (empty if the path does not exist)
+    """
+    values = [document]
+    for part in path.split('.'):
+        next_values = []
+        for value in values:
+            if _is_mapping(value):
+                if part in value:
+                    next_values.append(value[part])
+            elif isinstance(value, list):
+                if part.isdigit():
+                    index = int(part)
+                    if index < len(value):
+                        next_values.append(value[index])
+                else:
+                    for element in value:
+                        if _is_mapping(element) and part in element:
+                            next_values.append(element[part])
+        values = next_values
+
+    return values
+
+
+def get_value(document, path, default=MISSING):
+    """
+    Resolve a dotted path in a document without traversing arrays.
+    :param document: The document
+    :param path: A dotted path
+    :param default: The value to return if the path does not exist
+    :return: The value at the path
+    """
+    value = document
+    for part in path.split('.'):
+        if _is_mapping(value) and part in value:
+            value = value[part]
+        elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return default
+
+    return value
+
+
+def evaluate(expression, root, variables=None):
+    """
+    Evaluate an aggregation expression.
+    :param expression: The expression, e.g. the content of an $expr
+    :param root: The document that "$field" paths refer to
+    :param variables: Variables that "$$name" refers to
+    :return: The result of the expression (MISSING if it refers to a field that does not exist)
+    """
+    if variables is None:
+        variables = {}
+
+    if isinstance(expression, string_types) and expression.startswith('$$'):
+        name, _, path = expression[2:].partition('.')
+        if name == 'ROOT' or name == 'CURRENT':
+            value = root
+        else:
+            value = variables.get(name, MISSING)
+        return get_value(value, path) if path else value
+
+    if isinstance(expression, string_types) and expression.startswith('$'):
+        return get_value(root, expression[1:])
+
+    if isinstance(expression, list):
+        return [evaluate(element, root, variables) for element in expression]
+
+    if _is_mapping(expression):
+        if len(expression) == 1:
+            operator = list(expression.keys())[0]
+            if operator.startswith('$'):
+                if operator not in _OPERATORS:
+                    raise ValueError('Unsupported expression operator {}'.format(operator))
+                return _OPERATORS[operator](expression[operator], root, variables)
+
+        return dict((key, evaluate(value, root, variables)) for key, value in expression.items())
+
+    return expression
+
+
+def compare(a, b):
+    """
+    Compare two values using the BSON comparison order.
+    :return: A negative number if a < b, 0 if a == b and a positive number if a > b
+    """
+    rank_a = _type_rank(a)
+    rank_b = _type_rank(b)
+
+    if rank_a != rank_b:
+        return rank_a - rank_b
+
+    if rank_a <= 1:
+        return 0
+
+    if rank_a == 4:
+        return compare(sorted(a.items()), sorted(b.items()))
+
+    if rank_a == 5:
+        for element_a, element_b in zip(a, b):
+            result = compare(element_a, element_b)
+            if result != 0:
+                return result
+        return len(a) - len(b)
+
+    if a == b:
+        return 0
+    return -1 if a < b else 1
+
+
+def _is_mapping(value):
+    return isinstance(value, dict) or (hasattr(value, 'keys') and hasattr(value, '__getitem__'))
+
+
+def _type_rank(value):
+    if value is MISSING:
+        return 0
+    if value is None:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, integer_types) or isinstance(value, float):
+        return 2
+    if isinstance(value, string_types):
+        return 3
+    if _is_mapping(value):
+        return 4
+    if isinstance(value, list):
+        return 5
+    if isinstance(value, bytes):
+        return 6
+    if isinstance(value, ObjectId):
+        return 7
+    if isinstance(value, datetime.datetime):
+        return 9
+    if isinstance(value, Timestamp):
+        return 10
+    return 11
+
+
+def _truthy(value):
+    return value not in (False, None, 0) and value is not MISSING
+
+
+def _match_field(values, condition):
+    if _is_mapping(condition) and len(condition) > 0 and all(key.startswith('$') for key in condition):
+        for operator, argument in condition.items():
+            if operator == '$exists':
+                if bool(values) != bool(argument):
+                    return False
+            elif operator == '$not':
+                if _match_field(values, argument):
+                    return False
+            elif operator == '$ne':
+                if _match_field(values, {'$eq': argument}):
+                    return False
+            elif operator == '$nin':
+                if _match_field(values, {'$in': argument}):
+                    return False
+            elif operator in _QUERY_OPERATORS:
+                if not any(_QUERY_OPERATORS[operator](candidate, argument) for candidate in _candidates(values)):
+                    if not (operator in ('$eq', '$in') and len(values) == 0 and _matches_null(operator, argument)):
+                        return False
+            else:
+                raise ValueError('Unsupported query operator {}'.format(operator))
+        return True
+
+    if len(values) == 0:
+        return condition is None
+
+    return any(_equals(candidate, condition) for candidate in _candidates(values))
+
+
+def _matches_null(operator, argument):
+    if operator == '$eq':
+        return argument is None
+    return None in argument
+
+
+def _candidates(values):
+    for value in values:
+        yield value
+        if isinstance(value, list):
+            for element in value:
+                yield element
+
+
+def _equals(a, b):
+    return _type_rank(a) == _type_rank(b) and compare(a, b) == 0
+
+
+def _same_type_compare(a, b):
+    if _type_rank(a) != _type_rank(b):
+        return None
+    return compare(a, b)
+
+
+def _query_gt(value, argument):
+    result = _same_type_compare(value, argument)
+    return result is not None and result > 0
+
+
+def _query_gte(value, argument):
+    result = _same_type_compare(value, argument)
+    return result is not None and result >= 0
+
+
+def _query_lt(value, argument):
+    result = _same_type_compare(value, argument)
+    return result is not None and result < 0
+
+
+def _query_lte(value, argument):
+    result = _same_type_compare(value, argument)
+    return result is not None and result <= 0
+
+
+def _query_in(value, argument):
+    for element in argument:
+        if isinstance(element, type(re.compile(''))):
+            if isinstance(value, string_types) and element.search(value):
+                return True
+        elif _equals(value, element):
+            return True
+    return False
+
+
+def _truncated_mod(dividend, divisor):
+    # Like the server (and C), the remainder has the sign of the dividend, unlike Python's %
+    if isinstance(dividend, integer_types) and isinstance(divisor, integer_types):
+        remainder = abs(dividend) % abs(divisor)
+        return -remainder if dividend < 0 else remainder
+    return math.fmod(dividend, divisor)
+
+
+def _hashed_index_key(value):
+    # Mirrors the server's hash of scalar values: the first 8 bytes (little endian) of the MD5 digest of the seed, the
+    # canonical type and the value
+    if value is MISSING or value is None:
+        data = struct.pack('<i', 5)
+    elif isinstance(value, bool):
+        data = struct.pack('<i?', 40, value)
+    elif isinstance(value, integer_types + (float,)):
+        data = struct.pack('<iq', 10, int(value))
+    elif isinstance(value, string_types):
+        encoded = value.encode('utf-8')
+        data = struct.pack('<ii', 15, len(encoded) + 1) + encoded + b'\x00'
+    elif isinstance(value, ObjectId):
+        data = struct.pack('<i', 35) + value.binary
+    elif isinstance(value, datetime.datetime):
+        milliseconds = calendar.timegm(value.utctimetuple()) * 1000 + value.microsecond // 1000
+        data = struct.pack('<iq', 45, milliseconds)
+    else:
+        raise Exception('Unable to hash value {!r}'.format(value))
+
+    digest = hashlib.md5(struct.pack('<i', 0) + data).digest()
+    return struct.unpack('<q', digest[:8])[0]
+
+
+def _query_mod(value, argument):
+    divisor, remainder = argument
+    return isinstance(value, integer_types + (float,)) and not isinstance(value, bool) and \
+        _truncated_mod(int(value), int(divisor)) == remainder
+
+
+def _query_type(value, argument):
+    names = argument if isinstance(argument, list) else [argument]
+    return _type_name(value) in names
+
+
+_QUERY_OPERATORS = {
+    '$eq': _equals,
+    '$gt': _query_gt,
+    '$gte': _query_gte,
+    '$lt': _query_lt,
+    '$lte': _query_lte,
+    '$in': _query_in,
+    '$mod': _query_mod,
+    '$type': _query_type,
+}
+
+
+def _type_name(value):
+    if value is MISSING:
+        return 'missing'
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, integer_types):
+        return 'int' if -2 ** 31 <= value < 2 ** 31 else 'long'
+    if isinstance(value, float):
+        return 'double'
+    if isinstance(value, string_types):
+        return 'string'
+    if _is_mapping(value):
+        return 'object'
+    if isinstance(value, list):
+        return 'array'
+    if isinstance(value, bytes):
+        return 'binData'
+    if isinstance(value, ObjectId):
+        return 'objectId'
+    if isinstance(value, datetime.datetime):
+        return 'date'
+    if isinstance(value, Timestamp):
+        return 'timestamp'
+    return 'unknown'
+
+
+def _arguments(arguments, root, variables):
+    if not isinstance(arguments, list):
+        arguments = [arguments]
+    return [evaluate(argument, root, variables) for argument in arguments]
+
+
+def _comparison(predicate):
+    def operator(arguments, root, variables):
+        a, b = _arguments(arguments, root, variables)
+        return predicate(compare(a, b))
+    return operator
+
+
+def _op_and(arguments, root, variables):
+    return all(_truthy(evaluate(argument, root, variables)) for argument in arguments)
+
+
+def _op_or(arguments, root, variables):
+    return any(_truthy(evaluate(argument, root, variables)) for argument in arguments)
+
+
+def _op_not(arguments, root, variables):
+    return not _truthy(_arguments(arguments, root, variables)[0])
+
+
+def _op_let(arguments, root, variables):
+    scope = dict(variables)
+    for name, expression in arguments['vars'].items():
+        scope[name] = evaluate(expression, root, variables)
+    return evaluate(arguments['in'], root, scope)
+
+
+def _op_array_elem_at(arguments, root, variables):
+    array, index = _arguments(arguments, root, variables)
+    if not isinstance(array, list):
+        return MISSING if array in (MISSING, None) else None
+    if -len(array) <= index < len(array):
+        return array[index]
+    return MISSING
+
+
+def _op_filter(arguments, root, variables):
+    array = evaluate(arguments['input'], root, variables)
+    if not isinstance(array, list):
+        return None
+    name = arguments.get('as', 'this')
+    result = []
+    for element in array:
+        scope = dict(variables)
+        scope[name] = element
+        if _truthy(evaluate(arguments['cond'], root, scope)):
+            result.append(element)
+    return result
+
+
+def _op_object_to_array(arguments, root, variables):
+    value = _arguments(arguments, root, variables)[0]
+    if not _is_mapping(value):
+        return None
+    return [{'k': key, 'v': value[key]} for key in value.keys()]
+
+
+def _op_in(arguments, root, variables):
+    value, array = _arguments(arguments, root, variables)
+    return any(compare(value, element) == 0 for element in array)
+
+
+def _op_cond(arguments, root, variables):
+    if _is_mapping(arguments):
+        arguments = [arguments['if'], arguments['then'], arguments['else']]
+    condition, then, otherwise = arguments
+    if _truthy(evaluate(condition, root, variables)):
+        return evaluate(then, root, variables)
+    return evaluate(otherwise, root, variables)
+
+
+def _op_type(arguments, root, variables):
+    return _type_name(_arguments(arguments, root, variables)[0])
+
+
+def _op_to_string(arguments, root, variables):
+    value = _arguments(arguments, root, variables)[0]
+    if value is MISSING or value is None:
+        return None
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, string_types):
+        return value
+    return str(value)
+
+
+def _op_to_long(arguments, root, variables):
+    value = _arguments(arguments, root, variables)[0]
+    if value is MISSING or value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        epoch = datetime.datetime(1970, 1, 1, tzinfo=value.tzinfo)
+        return int((value - epoch).total_seconds() * 1000)
+    return int(value)
+
+
+def _op_mod(arguments, root, variables):
+    dividend, divisor = _arguments(arguments, root, variables)
+    if dividend in (MISSING, None) or divisor in (MISSING, None):
+        return None
+    return _truncated_mod(dividend, divisor)
+
+
+def _op_substr_bytes(arguments, root, variables):
+    value, start, length = _arguments(arguments, root, variables)
+    if value is MISSING or value is None:
+        return ''
+    if length < 0:
+        return value[start:]
+    return value[start:start + length]
+
+
+def _op_to_hashed_index_key(arguments, root, variables):
+    return _hashed_index_key(_arguments(arguments, root, variables)[0])
+
+
+def _op_literal(arguments, root, variables):
+    return arguments
+
+
+_OPERATORS = {
+    '$eq': _comparison(lambda result: result == 0),
+    '$ne': _comparison(lambda result: result != 0),
+    '$gt': _comparison(lambda result: result > 0),
+    '$gte': _comparison(lambda result: result >= 0),
+    '$lt': _comparison(lambda result: result < 0),
+    '$lte': _comparison(lambda result: result <= 0),
+    '$and': _op_and,
+    '$or': _op_or,
+    '$not': _op_not,
+    '$let': _op_let,
+    '$arrayElemAt': _op_array_elem_at,
+    '$filter': _op_filter,
+    '$objectToArray': _op_object_to_array,
+    '$in': _op_in,
+    '$cond': _op_cond,
+    '$type': _op_type,
+    '$toString': _op_to_string,
+    '$toLong': _op_to_long,
+    '$mod': _op_mod,
+    '$substrBytes': _op_substr_bytes,
+    '$toHashedIndexKey': _op_to_hashed_index_key,
+    '$literal': _op_literal,
+}
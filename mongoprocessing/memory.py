@@ -0,0 +1,765 @@
+import copy
+import datetime
+import time
+from functools import cmp_to_key
+from threading import Condition
+
+from bson import BSON, ObjectId, Timestamp
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo import DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, WriteError
+from pymongo.results import BulkWriteResult, DeleteResult, InsertOneResult, UpdateResult
+
+from .matching import MISSING, compare, get_value, matches
+
+
+def _sort_documents(documents, sort):
+    for key, direction in reversed(sort):
+        def compare_documents(a, b, key=key):
+            return compare(get_value(a, key), get_value(b, key))
+
+        documents.sort(key=cmp_to_key(compare_documents), reverse=direction < 0)
+
+    return documents
+
+
+def _include_path(source, target, parts):
+    if not isinstance(source, dict) or parts[0] not in source:
+        return
+
+    value = source[parts[0]]
+    if len(parts) == 1:
+        target[parts[0]] = value
+    elif isinstance(value, dict):
+        child = target.setdefault(parts[0], {})
+        _include_path(value, child, parts[1:])
+
+
+def _exclude_path(document, parts):
+    if not isinstance(document, dict) or parts[0] not in document:
+        return document
+
+    result = dict(document)
+    if len(parts) == 1:
+        del result[parts[0]]
+    else:
+        result[parts[0]] = _exclude_path(result[parts[0]], parts[1:])
+
+    return result
+
+
+def _project(document, projection):
+    if document is None or not projection:
+        return document
+
+    include_id = projection.get('_id', True)
+    fields = dict((key, value) for key, value in projection.items() if key != '_id')
+
+    if len(fields) > 0 and all(fields.values()):
+        result = {}
+        for path in fields:
+            _include_path(document, result, path.split('.'))
+    else:
+        result = document
+        for path in fields:
+            result = _exclude_path(result, path.split('.'))
+        result = dict(result)
+
+    if include_id and '_id' in document:
+        result['_id'] = document['_id']
+    else:
+        result.pop('_id', None)
+
+    return result
+
+
+def _get_current_date():
+    # MongoDB stores dates with millisecond precision
+    now = datetime.datetime.utcnow()
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
+def _set_field(document, path, value, updated_fields):
+    parts = path.split('.')
+    target = document
+    created = None
+
+    for index, part in enumerate(parts[:-1]):
+        child = target.get(part)
+        if child is None:
+            child = target[part] = {}
+            if created is None:
+                created = '.'.join(parts[:index + 1])
+        elif not isinstance(child, dict):
+            raise WriteError("Cannot create field '{}' in element {{{}: {!r}}}".format(parts[index + 1], part, child),
+                             28)
+        target = child
+
+    target[parts[-1]] = value
+
+    # Change events report new sub-documents as a whole and changes of existing ones with dotted keys
+    reported = created if created is not None else path
+    prefix_parts = reported.split('.')
+    for index in range(1, len(prefix_parts)):
+        if '.'.join(prefix_parts[:index]) in updated_fields:
+            return
+    updated_fields[reported] = get_value(document, reported)
+
+
+def _unset_field(document, path):
+    parts = path.split('.')
+    target = document
+
+    for part in parts[:-1]:
+        target = target.get(part)
+        if not isinstance(target, dict):
+            return False
+
+    if parts[-1] not in target:
+        return False
+
+    del target[parts[-1]]
+    return True
+
+
+def _apply_update(document, update, is_insert):
+    updated_fields = {}
+    removed_fields = []
+
+    for operator, fields in update.items():
+        if not operator.startswith('$'):
+            raise WriteError('Update documents must only contain update operators, got "{}"'.format(operator), 9)
+
+        for path, value in fields.items():
+            if operator == '$set':
+                _set_field(document, path, value, updated_fields)
+            elif operator == '$setOnInsert':
+                if is_insert:
+                    _set_field(document, path, value, updated_fields)
+            elif operator == '$unset':
+                if _unset_field(document, path):
+                    removed_fields.append(path)
+            elif operator == '$inc':
+                current = get_value(document, path)
+                _set_field(document, path, value if current is MISSING else current + value, updated_fields)
+            elif operator == '$currentDate':
+                _set_field(document, path, _get_current_date(), updated_fields)
+            elif operator in ('$addToSet', '$push'):
+                current = get_value(document, path)
+                values = value['$each'] if isinstance(value, dict) and '$each' in value else [value]
+                current = [] if current is MISSING else list(current)
+                for item in values:
+                    if operator == '$push' or item not in current:
+                        current.append(item)
+                _set_field(document, path, current, updated_fields)
+            else:
+                raise WriteError('Unsupported update operator {}'.format(operator), 9)
+
+    # A field can not be both updated and removed
+    for path in removed_fields:
+        updated_fields.pop(path, None)
+
+    return updated_fields, removed_fields
+
+
+def _get_upsert_document(query):
+    document = {}
+
+    for key, value in query.items():
+        if key.startswith('$') or '.' in key:
+            continue
+        if isinstance(value, dict) and any(operator.startswith('$') for operator in value):
+            if '$eq' in value:
+                document[key] = copy.deepcopy(value['$eq'])
+            continue
+        document[key] = copy.deepcopy(value)
+
+    return document
+
+
+def _get_index_value(document, fields, equality_only=False):
+    # Returns None for values that cannot be looked up in a dictionary
+    values = []
+    for field in fields:
+        # Queries use dotted keys instead of nested documents
+        value = document.get(field, MISSING) if equality_only else get_value(document, field)
+        if value is MISSING:
+            if equality_only:
+                return None
+            value = None
+        elif isinstance(value, dict) and equality_only:
+            return None
+        values.append(value)
+
+    values = tuple(values)
+    try:
+        hash(values)
+    except TypeError:
+        return None
+
+    return values
+
+
+class MemoryCursor(object):
+    def __init__(self, collection, query, projection=None):
+        """
+        Cursor of a MemoryCollection. The query is evaluated lazily when the cursor is iterated.
+        """
+        self.collection = collection
+        self.query = query
+        self.projection = projection
+        self._sort = []
+        self._skip = 0
+        self._limit = 0
+        self._documents = None
+
+    def sort(self, key_or_list, direction=1):
+        self._sort = key_or_list if isinstance(key_or_list, list) else [(key_or_list, direction)]
+        return self
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def batch_size(self, batch_size):
+        return self
+
+    def close(self):
+        self._documents = iter([])
+
+    def _get_documents(self):
+        if self._documents is None:
+            documents = self.collection._find_documents(self.query)
+            documents = _sort_documents(documents, self._sort)
+            documents = documents[self._skip:]
+            if self._limit > 0:
+                documents = documents[:self._limit]
+            self._documents = iter([_project(document, self.projection) for document in documents])
+
+        return self._documents
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._get_documents())
+
+    next = __next__
+
+    def __getitem__(self, index):
+        documents = list(self._get_documents())
+        self._documents = iter(documents)
+        return documents[index]
+
+
+class MemoryChangeStream(object):
+    def __init__(self, collection, pipeline, full_document, position, max_await_time_ms):
+        """
+        Change stream of a MemoryCollection. Use MemoryCollection.watch to open one. Supports $match and $project
+        stages.
+        """
+        self.collection = collection
+        self.pipeline = pipeline
+        self.full_document = full_document
+        self.position = position
+        self.codec_options = collection.codec_options
+        self.max_await_time = (max_await_time_ms if max_await_time_ms is not None else 1000) / 1000.0
+        self.resume_token = None
+        self.alive = True
+
+        for stage in pipeline:
+            if list(stage.keys()) not in (['$match'], ['$project']):
+                raise OperationFailure('MemoryChangeStream does not support the stage {}'.format(list(stage.keys())))
+
+    def close(self):
+        self.alive = False
+        with self.collection.condition:
+            self.collection.condition.notify_all()
+
+    def try_next(self):
+        """
+        Get the next matching event.
+        :return: The event or None if no event arrived within max_await_time_ms
+        """
+        deadline = time.time() + self.max_await_time
+
+        while self.alive:
+            event = self.collection._get_event(self.position, deadline, self)
+            if event is None:
+                return None
+
+            self.position += 1
+            self.resume_token = event['_id']
+
+            event = self._apply_pipeline(self._lookup(event))
+            if event is not None:
+                # Only copy events that pass the filter
+                if issubclass(self.codec_options.document_class, RawBSONDocument):
+                    return RawBSONDocument(BSON.encode(event), self.codec_options)
+                return copy.deepcopy(event)
+
+        return None
+
+    def _apply_pipeline(self, event):
+        for stage in self.pipeline:
+            if '$match' in stage:
+                if not matches(stage['$match'], event):
+                    return None
+            else:
+                event = _project(event, stage['$project'])
+
+        return event
+
+    def _lookup(self, event):
+        if event['operationType'] != 'update' or self.full_document != 'updateLookup':
+            return event
+
+        # Stored documents are never modified in place, so they can be shared until the event is copied
+        event = dict(event)
+        event['fullDocument'] = self.collection.documents.get(event['documentKey']['_id'])
+        return event
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while self.alive:
+            event = self.try_next()
+            if event is not None:
+                return event
+
+        raise StopIteration
+
+    next = __next__
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class MemoryCollection(object):
+    def __init__(self, name='collection', database='memory', history_size=100000):
+        """
+        An in-memory stand-in for a pymongo collection with change streams, e.g. for tests and benchmarks without a
+        replica set. Queries and change stream filters are evaluated with the matching module, so only the operators
+        supported there can be used.
+        :param name: Name of the collection (reported in the "ns" field of change events)
+        :param database: Name of the database (reported in the "ns" field of change events)
+        :param history_size: Number of change events kept for resuming change streams
+        """
+        self.name = name
+        self.database = database
+        self.history_size = history_size
+        self.codec_options = CodecOptions(document_class=dict)
+
+        self.documents = {}
+        # Unique indexes map the values of their fields to the _id of the document
+        self.unique_indexes = {}
+        self.condition = Condition()
+
+        self.history = []
+        self.history_start = 0
+        self.last_time = 0
+        self.last_increment = 0
+
+    def with_options(self, codec_options=None, **kwargs):
+        """
+        Get a view of the collection with other codec options. Only the document class of change events is
+        honoured, e.g. RawBSONDocument.
+        """
+        return _MemoryCollectionView(self, codec_options if codec_options is not None else self.codec_options)
+
+    def insert_one(self, document):
+        with self.condition:
+            if '_id' not in document:
+                document['_id'] = ObjectId()
+
+            self._insert(copy.deepcopy(document))
+
+        return InsertOneResult(document['_id'], True)
+
+    def find(self, filter=None, projection=None, **kwargs):
+        cursor = MemoryCursor(self, filter or {}, projection)
+        if 'sort' in kwargs:
+            cursor.sort(kwargs['sort'])
+
+        return cursor
+
+    def find_one(self, filter=None, projection=None, **kwargs):
+        for document in self.find(filter, projection, **kwargs).limit(1):
+            return document
+
+        return None
+
+    def update_one(self, filter, update, upsert=False):
+        with self.condition:
+            return self._update(filter, update, upsert, multi=False)
+
+    def update_many(self, filter, update, upsert=False):
+        with self.condition:
+            return self._update(filter, update, upsert, multi=True)
+
+    def replace_one(self, filter, replacement, upsert=False):
+        with self.condition:
+            return self._replace(filter, replacement, upsert)
+
+    def delete_one(self, filter):
+        with self.condition:
+            return self._delete(filter, multi=False)
+
+    def delete_many(self, filter):
+        with self.condition:
+            return self._delete(filter, multi=True)
+
+    def find_one_and_update(self, filter, update, projection=None, upsert=False, return_document=False, **kwargs):
+        with self.condition:
+            documents = self._find_documents(filter, copy_documents=False)
+            if 'sort' in kwargs:
+                documents = _sort_documents(documents, kwargs['sort'])
+
+            if len(documents) == 0:
+                if upsert:
+                    result = self._update(filter, update, upsert=True, multi=False)
+                    if return_document:
+                        return _project(copy.deepcopy(self.documents[result.upserted_id]), projection)
+                return None
+
+            before = copy.deepcopy(documents[0])
+            self._update({'_id': before['_id']}, update, upsert=False, multi=False)
+
+            if return_document:
+                return _project(copy.deepcopy(self.documents[before['_id']]), projection)
+            return _project(before, projection)
+
+    def bulk_write(self, requests, ordered=True):
+        counts = {'nInserted': 0, 'nUpserted': 0, 'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'upserted': []}
+        write_errors = []
+
+        with self.condition:
+            for index, request in enumerate(requests):
+                try:
+                    self._apply_request(request, index, counts)
+                except (WriteError, DuplicateKeyError) as e:
+                    write_errors.append({'index': index, 'code': e.code, 'errmsg': str(e), 'op': request})
+                    if ordered:
+                        break
+
+        counts['writeErrors'] = write_errors
+        counts['writeConcernErrors'] = []
+
+        if len(write_errors) > 0:
+            raise BulkWriteError(counts)
+
+        return BulkWriteResult(counts, True)
+
+    def aggregate(self, pipeline, **kwargs):
+        documents = self._find_documents({})
+
+        for stage in pipeline:
+            operator, argument = list(stage.items())[0]
+
+            if operator == '$match':
+                documents = [document for document in documents if matches(argument, document)]
+            elif operator == '$sort':
+                documents = _sort_documents(documents, list(argument.items()))
+            elif operator == '$skip':
+                documents = documents[argument:]
+            elif operator == '$limit':
+                documents = documents[:argument]
+            elif operator == '$project':
+                documents = [_project(document, argument) for document in documents]
+            elif operator == '$bucketAuto':
+                documents = self._bucket_auto(documents, argument)
+            else:
+                raise OperationFailure('MemoryCollection does not support the stage {}'.format(operator))
+
+        return iter(documents)
+
+    def create_index(self, keys, **kwargs):
+        """
+        Only unique indexes are created. They are enforced and used for queries with an equality condition on all of
+        their fields.
+        """
+        if not isinstance(keys, list):
+            keys = [(keys, 1)]
+
+        fields = tuple(key for key, _ in keys)
+        if kwargs.get('unique') and fields not in self.unique_indexes:
+            with self.condition:
+                index = {}
+                for document in self.documents.values():
+                    value = _get_index_value(document, fields)
+                    if value is not None:
+                        if value in index:
+                            raise DuplicateKeyError('E11000 duplicate key error collection: {}.{}'
+                                                    .format(self.database, self.name), 11000)
+                        index[value] = document['_id']
+                self.unique_indexes[fields] = index
+
+        return kwargs.get('name', '_'.join('{}_{}'.format(key, direction) for key, direction in keys))
+
+    def count_documents(self, filter, **kwargs):
+        with self.condition:
+            return len(self._find_documents(filter, copy_documents=False))
+
+    def watch(self, pipeline=None, full_document=None, resume_after=None, start_after=None, max_await_time_ms=None,
+              **kwargs):
+        """
+        Open a change stream. Supports $match and $project stages, full_document='updateLookup' and resuming after
+        a token that is still in the history.
+        """
+        token = resume_after if resume_after is not None else start_after
+
+        with self.condition:
+            if token is None:
+                position = self.history_start + len(self.history)
+            else:
+                position = int(token['_data'], 16) + 1
+                if position < self.history_start:
+                    raise OperationFailure('Resume of change stream was not possible, as the resume point may no '
+                                           'longer be in the oplog', 286)
+
+        return MemoryChangeStream(self, pipeline or [], full_document, position, max_await_time_ms)
+
+    def _get_event(self, position, deadline, stream):
+        with self.condition:
+            while stream.alive and position >= self.history_start + len(self.history):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+            if not stream.alive:
+                return None
+
+            if position < self.history_start:
+                stream.alive = False
+                raise OperationFailure('Change stream history lost', 286)
+
+            return self.history[position - self.history_start]
+
+    def _find_documents(self, query, copy_documents=True):
+        with self.condition:
+            documents = [document for document in self._get_candidates(query) if matches(query, document)]
+
+            if copy_documents:
+                documents = copy.deepcopy(documents)
+
+        return documents
+
+    def _get_candidates(self, query):
+        # Avoid a collection scan for queries by _id
+        doc_id = query.get('_id', MISSING)
+
+        if doc_id is MISSING:
+            for fields, index in self.unique_indexes.items():
+                value = _get_index_value(query, fields, equality_only=True)
+                if value is not None:
+                    doc_id = index.get(value)
+                    return [self.documents[doc_id]] if doc_id is not None else []
+
+            return self.documents.values()
+
+        if isinstance(doc_id, dict) and list(doc_id.keys()) == ['$in']:
+            doc_ids = doc_id['$in']
+        elif isinstance(doc_id, dict) and any(key.startswith('$') for key in doc_id):
+            return self.documents.values()
+        else:
+            doc_ids = [doc_id]
+
+        candidates = []
+        for value in doc_ids:
+            try:
+                document = self.documents.get(value)
+            except TypeError:
+                # Unhashable IDs (e.g. sub-documents) need a scan
+                return self.documents.values()
+            if document is not None:
+                candidates.append(document)
+
+        return candidates
+
+    def _apply_request(self, request, index, counts):
+        if isinstance(request, InsertOne):
+            self._insert(copy.deepcopy(request._doc))
+            counts['nInserted'] += 1
+            return
+
+        if isinstance(request, (UpdateOne, UpdateMany)):
+            result = self._update(request._filter, request._doc, request._upsert, isinstance(request, UpdateMany))
+        elif isinstance(request, ReplaceOne):
+            result = self._replace(request._filter, request._doc, request._upsert)
+        elif isinstance(request, (DeleteOne, DeleteMany)):
+            counts['nRemoved'] += self._delete(request._filter, isinstance(request, DeleteMany)).deleted_count
+            return
+        else:
+            raise WriteError('Unsupported request {!r}'.format(request), 2)
+
+        if result.upserted_id is not None:
+            counts['nUpserted'] += 1
+            counts['upserted'].append({'index': index, '_id': result.upserted_id})
+        else:
+            counts['nMatched'] += result.matched_count
+            counts['nModified'] += result.modified_count
+
+    def _insert(self, document):
+        if document['_id'] in self.documents:
+            raise DuplicateKeyError('E11000 duplicate key error collection: {}.{} index: _id_ dup key: {{ _id: {!r} }}'
+                                    .format(self.database, self.name, document['_id']), 11000)
+
+        self._store(document)
+        self._emit('insert', document['_id'], fullDocument=copy.deepcopy(document))
+
+    def _update(self, query, update, upsert, multi):
+        documents = self._find_documents(query, copy_documents=False)
+        if not multi:
+            documents = documents[:1]
+
+        if len(documents) == 0:
+            if not upsert:
+                return UpdateResult({'n': 0, 'nModified': 0}, True)
+
+            document = _get_upsert_document(query)
+            _apply_update(document, update, is_insert=True)
+            if '_id' not in document:
+                document['_id'] = ObjectId()
+
+            self._insert(document)
+            return UpdateResult({'n': 1, 'nModified': 0, 'upserted': document['_id']}, True)
+
+        modified = 0
+        for document in documents:
+            updated = copy.deepcopy(document)
+            updated_fields, removed_fields = _apply_update(updated, update, is_insert=False)
+
+            if updated == document:
+                continue
+
+            modified += 1
+            self._store(updated, document)
+            self._emit('update', document['_id'], updateDescription={
+                'updatedFields': copy.deepcopy(updated_fields),
+                'removedFields': removed_fields
+            })
+
+        return UpdateResult({'n': len(documents), 'nModified': modified}, True)
+
+    def _replace(self, query, replacement, upsert):
+        if any(key.startswith('$') for key in replacement):
+            raise WriteError('The replacement document must not contain update operators', 9)
+
+        documents = self._find_documents(query, copy_documents=False)[:1]
+
+        if len(documents) == 0:
+            if not upsert:
+                return UpdateResult({'n': 0, 'nModified': 0}, True)
+
+            document = _get_upsert_document(query)
+            document.update(copy.deepcopy(replacement))
+            if '_id' not in document:
+                document['_id'] = ObjectId()
+
+            self._insert(document)
+            return UpdateResult({'n': 1, 'nModified': 0, 'upserted': document['_id']}, True)
+
+        document = copy.deepcopy(replacement)
+        document['_id'] = documents[0]['_id']
+        self._store(document, documents[0])
+        self._emit('replace', document['_id'], fullDocument=copy.deepcopy(document))
+
+        return UpdateResult({'n': 1, 'nModified': 1}, True)
+
+    def _delete(self, query, multi):
+        documents = self._find_documents(query, copy_documents=False)
+        if not multi:
+            documents = documents[:1]
+
+        for document in documents:
+            del self.documents[document['_id']]
+            self._unindex(document)
+            self._emit('delete', document['_id'])
+
+        return DeleteResult({'n': len(documents)}, True)
+
+    def _store(self, document, previous=None):
+        for fields, index in self.unique_indexes.items():
+            value = _get_index_value(document, fields)
+            if value is not None and index.get(value, document['_id']) != document['_id']:
+                raise DuplicateKeyError('E11000 duplicate key error collection: {}.{} index: {} dup key: {!r}'
+                                        .format(self.database, self.name, '_'.join(fields), value), 11000)
+
+        if previous is not None:
+            self._unindex(previous)
+
+        self.documents[document['_id']] = document
+        for fields, index in self.unique_indexes.items():
+            value = _get_index_value(document, fields)
+            if value is not None:
+                index[value] = document['_id']
+
+    def _unindex(self, document):
+        for fields, index in self.unique_indexes.items():
+            value = _get_index_value(document, fields)
+            if value is not None and index.get(value) == document['_id']:
+                del index[value]
+
+    def _bucket_auto(self, documents, argument):
+        group_by = argument['groupBy']
+        values = sorted([get_value(document, group_by[1:]) for document in documents], key=cmp_to_key(compare))
+        num_buckets = min(argument['buckets'], len(values))
+
+        buckets = []
+        for index in range(num_buckets):
+            start = index * len(values) // num_buckets
+            end = (index + 1) * len(values) // num_buckets
+            maximum = values[end] if end < len(values) else values[-1]
+            buckets.append({'_id': {'min': values[start], 'max': maximum}, 'count': end - start})
+
+        return buckets
+
+    def _emit(self, operation_type, doc_id, **fields):
+        now = int(time.time())
+        if now == self.last_time:
+            self.last_increment += 1
+        else:
+            self.last_time = now
+            self.last_increment = 1
+
+        position = self.history_start + len(self.history)
+        event = {
+            '_id': {'_data': '{:016x}'.format(position)},
+            'operationType': operation_type,
+            'clusterTime': Timestamp(now, self.last_increment),
+            'ns': {'db': self.database, 'coll': self.name},
+            'documentKey': {'_id': doc_id}
+        }
+        event.update(fields)
+
+        self.history.append(event)
+        if len(self.history) > 2 * self.history_size:
+            trimmed = len(self.history) - self.history_size
+            del self.history[:trimmed]
+            self.history_start += trimmed
+
+        self.condition.notify_all()
+
+
+class _MemoryCollectionView(object):
+    def __init__(self, collection, codec_options):
+        self.collection = collection
+        self.codec_options = codec_options
+
+    def watch(self, *args, **kwargs):
+        stream = self.collection.watch(*args, **kwargs)
+        stream.codec_options = self.codec_options
+        return stream
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
@@ -0,0 +1,169 @@
+from threading import Lock
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _get_label_key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def _format_labels(label_key, extra=()):
+    items = list(label_key) + list(extra)
+    if len(items) == 0:
+        return ''
+
+    escaped = ['{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for key, value in items]
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class NullMetrics(object):
+    """
+    Discards all measurements. Used by default, so instrumentation costs no more than a few no-op calls.
+    """
+    enabled = False
+
+    def increment(self, name, labels=None, value=1):
+        pass
+
+    def observe(self, name, labels=None, value=0):
+        pass
+
+    def set_gauge(self, name, labels=None, value=0):
+        pass
+
+
+class Metrics(object):
+    enabled = True
+
+    def __init__(self, callback=None, buckets=DEFAULT_BUCKETS, prefix='mongoprocessing_'):
+        """
+        Collects counters, gauges and histograms of workers and repositories (see MongoRepository.set_metrics).
+        The collected values can be exported in the Prometheus text format with to_prometheus.
+        :param callback: A function (kind, name, labels, value) that is called for every measurement, kind being
+        "counter", "gauge" or "histogram". Use it to forward measurements to other monitoring systems.
+        :param buckets: Upper bounds of the histogram buckets in seconds
+        :param prefix: Prefix of all metric names in the Prometheus output
+        """
+        self.callback = callback
+        self.buckets = tuple(sorted(buckets))
+        self.prefix = prefix
+
+        self.lock = Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def increment(self, name, labels=None, value=1):
+        """
+        Increment a counter.
+        :param name: The name of the counter, e.g. "events_received_total"
+        :param labels: A dictionary of labels, e.g. {"worker": "two_update"}
+        :param value: The increment
+        """
+        key = (name, _get_label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+        if self.callback is not None:
+            self.callback('counter', name, labels, value)
+
+    def observe(self, name, labels=None, value=0):
+        """
+        Add a value (usually a duration in seconds) to a histogram.
+        :param name: The name of the histogram, e.g. "process_seconds"
+        :param labels: A dictionary of labels
+        :param value: The observed value
+        """
+        key = (name, _get_label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(self.buckets), 0, 0.0]
+
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][index] += 1
+                    break
+            histogram[1] += 1
+            histogram[2] += value
+
+        if self.callback is not None:
+            self.callback('histogram', name, labels, value)
+
+    def set_gauge(self, name, labels=None, value=0):
+        """
+        Set the current value of a gauge.
+        :param name: The name of the gauge, e.g. "queue_depth"
+        :param labels: A dictionary of labels
+        :param value: The current value
+        """
+        key = (name, _get_label_key(labels))
+        with self.lock:
+            self.gauges[key] = value
+
+        if self.callback is not None:
+            self.callback('gauge', name, labels, value)
+
+    def get_counter(self, name, labels=None):
+        return self.counters.get((name, _get_label_key(labels)), 0)
+
+    def get_gauge(self, name, labels=None):
+        return self.gauges.get((name, _get_label_key(labels)))
+
+    def get_histogram(self, name, labels=None):
+        """
+        Get the count and sum of a histogram.
+        :param name: The name of the histogram
+        :param labels: A dictionary of labels
+        :return: A tuple (count, sum)
+        """
+        histogram = self.histograms.get((name, _get_label_key(labels)))
+        if histogram is None:
+            return 0, 0.0
+
+        return histogram[1], histogram[2]
+
+    def to_prometheus(self):
+        """
+        Export all metrics in the Prometheus text exposition format, e.g. to serve them on a /metrics endpoint.
+        :return: The metrics as a string
+        """
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted((key, (list(value[0]), value[1], value[2])) for key, value in self.histograms.items())
+
+        lines = []
+        last_name = None
+
+        for kind, items in (('counter', counters), ('gauge', gauges)):
+            for (name, label_key), value in items:
+                full_name = self.prefix + name
+                if full_name != last_name:
+                    lines.append('# TYPE {} {}'.format(full_name, kind))
+                    last_name = full_name
+                lines.append('{}{} {}'.format(full_name, _format_labels(label_key), _format_value(value)))
+
+        for (name, label_key), (bucket_counts, count, total) in histograms:
+            full_name = self.prefix + name
+            if full_name != last_name:
+                lines.append('# TYPE {} histogram'.format(full_name))
+                last_name = full_name
+
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), bucket_counts + [count]):
+                cumulative = count if bound == float('inf') else cumulative + bucket_count
+                bucket_labels = _format_labels(label_key, [('le', _format_value(bound))])
+                lines.append('{}_bucket{} {}'.format(full_name, bucket_labels, cumulative))
+            lines.append('{}_sum{} {}'.format(full_name, _format_labels(label_key), _format_value(total)))
+            lines.append('{}_count{} {}'.format(full_name, _format_labels(label_key), count))
+
+        return '\n'.join(lines) + '\n'
@@ -11,4 +11,5 @@ setup(name='mongoprocessing',
       author_email='a.seipel@immowelt.de',
       license='Apache2',
       packages=['mongoprocessing'],
+      extras_require={'async': ['motor']},
       zip_safe=False)
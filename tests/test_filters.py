@@ -0,0 +1,157 @@
+import datetime
+import random
+import unittest
+
+from bson.objectid import ObjectId
+
+from mongoprocessing import (KeyValueDependency, MemoryMongoRepository, MongoWatch, OperationTypeDependency,
+                             ProcessDependency, RequiredKeyDependency)
+from mongoprocessing.dependencies import PartitionCondition
+from mongoprocessing.filters import compile_filter, split_filter
+from mongoprocessing.matching import _hashed_index_key, matches
+
+TIMES = [datetime.datetime(2020, 1, 1, 0, 0, second) for second in range(4)]
+
+
+def create_watch(dependencies):
+    watch = MongoWatch(MemoryMongoRepository())
+    for dependency in dependencies:
+        watch.add_dependency(dependency)
+    return watch
+
+
+def random_process(rng):
+    if rng.random() < 0.2:
+        return None
+
+    process = {'success': rng.random() < 0.8, 'isRunning': rng.choice([True, False])}
+    for field in ('startTime', 'endTime'):
+        if rng.random() < 0.9:
+            process[field] = rng.choice(TIMES)
+    for result in ('a', 'b'):
+        if rng.random() < 0.5:
+            process[result] = 1
+    return process
+
+
+def random_id(rng):
+    return rng.choice([
+        ObjectId(),
+        rng.randint(-100, 100),
+        rng.uniform(-100, 100),
+        u'doc-{}'.format(rng.randint(0, 1000))
+    ])
+
+
+def random_event(rng):
+    document = {'_id': random_id(rng)}
+    for name in ('zero', 'one', 'two'):
+        process = random_process(rng)
+        if process is not None:
+            document[name] = process
+    if rng.random() < 0.6:
+        document['key'] = 1
+    if rng.random() < 0.6:
+        document['value'] = rng.choice([3, 4])
+
+    updated_fields = {}
+    for name in ('zero', 'one'):
+        choice = rng.random()
+        if name in document and choice < 0.4:
+            updated_fields[name + '.success'] = document[name]['success']
+        elif name in document and choice < 0.7:
+            updated_fields[name] = document[name]
+
+    return {
+        'operationType': rng.choice(['insert', 'update', 'replace']),
+        'documentKey': {'_id': document['_id']},
+        'fullDocument': document,
+        'updateDescription': {'updatedFields': updated_fields, 'removedFields': []}
+    }
+
+
+class FilterTest(unittest.TestCase):
+    configurations = [
+        [ProcessDependency('one')],
+        [ProcessDependency('one'), ProcessDependency('one')],
+        [ProcessDependency('one', ['update'], False, 'a')],
+        [ProcessDependency('one'), ProcessDependency('zero', ['update'], True, 'b'),
+         RequiredKeyDependency('key', ['update']), KeyValueDependency('value', 3, ['update'])],
+        [OperationTypeDependency(['insert', 'update']), RequiredKeyDependency('key', ['insert'])],
+    ]
+
+    @classmethod
+    def setUpClass(cls):
+        rng = random.Random(1)
+        cls.events = [random_event(rng) for _ in range(2000)]
+
+    def get_filters(self, dependencies=None):
+        for dependencies in [dependencies] if dependencies is not None else self.configurations:
+            watch = create_watch(dependencies)
+            for partition in (None, PartitionCondition(0, 3), PartitionCondition(2, 3), PartitionCondition(2, 3, True)):
+                for op_type in set(watch.dependency.operation_types):
+                    yield watch._build_filter('two', op_type, partition)
+
+    def assert_equivalent(self, original, compiled):
+        for event in self.events:
+            self.assertEqual(matches(original, event), compiled(event), (original, event))
+
+    def test_compiled_filter_matches_same_events(self):
+        for original in self.get_filters():
+            compiled = compile_filter(original)
+            self.assert_equivalent(original, lambda event: matches(compiled, event))
+
+    def test_split_filter_matches_same_events(self):
+        for original in self.get_filters():
+            server_query, client_query = split_filter(original)
+            self.assertFalse('$expr' in repr(server_query))
+            self.assert_equivalent(original, lambda event: matches(server_query, event) and
+                                   (client_query is None or matches(client_query, event)))
+
+    def test_filters_match_some_events(self):
+        for dependencies in self.configurations:
+            filters = list(self.get_filters(dependencies))
+            self.assertTrue(any(matches(original, event) for original in filters for event in self.events))
+
+    def test_rerun_condition(self):
+        watch = create_watch([ProcessDependency('one')])
+        compiled = compile_filter(watch._build_filter('two', 'update'))
+        event = {
+            'operationType': 'update',
+            'documentKey': {'_id': 1},
+            'fullDocument': {
+                '_id': 1,
+                'one': {'success': True, 'startTime': TIMES[2], 'endTime': TIMES[3]},
+                'two': {'success': True, 'startTime': TIMES[0], 'endTime': TIMES[1]}
+            },
+            'updateDescription': {'updatedFields': {'one.success': True}, 'removedFields': []}
+        }
+        self.assertTrue(matches(compiled, event))
+
+        event['fullDocument']['two']['startTime'] = TIMES[2]
+        self.assertFalse(matches(compiled, event))
+
+    def test_partitions_are_disjoint(self):
+        rng = random.Random(2)
+        doc_ids = [random_id(rng) for _ in range(500)]
+
+        for hashed in (False, True):
+            for count in (1, 2, 3, 7):
+                conditions = [compile_filter(PartitionCondition(index, count, hashed)._get_condition('$_id'))
+                              for index in range(count)]
+                for doc_id in doc_ids:
+                    partitions = [condition for condition in conditions if matches(condition, {'_id': doc_id})]
+                    self.assertEqual(len(partitions), 1, doc_id)
+
+    def test_partitions_only_hash_if_enabled(self):
+        self.assertFalse('$toHashedIndexKey' in repr(PartitionCondition(1, 3)._get_condition('$_id')))
+        self.assertTrue('$toHashedIndexKey' in repr(PartitionCondition(1, 3, True)._get_condition('$_id')))
+
+    def test_hashed_index_key_matches_server(self):
+        # Outputs of $toHashedIndexKey (and convertShardKeyToHashed) on a MongoDB server
+        self.assertEqual(_hashed_index_key(u'string to hash'), 763543691661428748)
+        self.assertEqual(_hashed_index_key(1), 5902408780260971510)
+        self.assertEqual(_hashed_index_key(1.0), 5902408780260971510)
+
+if __name__ == '__main__':
+    unittest.main()